@@ -0,0 +1,137 @@
+"""
+Aggregation pipelines behind the /api/analytics endpoints.
+
+Every report is computed by MongoDB and only the grouped rows come back;
+nothing here iterates raw documents. Each pipeline opens with a `$match`
+on fields covered by the indexes created in server.py's startup hook.
+Time buckets use `$dateTrunc`, which needs MongoDB 5.0 or newer.
+
+ResultCache keeps recent results for a short TTL. Reports scoped to one
+user also key on that user's version marks (see changes.py), so a write
+makes their cached rows unreachable at once instead of after the TTL.
+"""
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Hashable, Optional
+
+BUCKETS = ("day", "week", "month")
+SPEND_GROUPS = {"merchant": "$merchant_name", "website": "$website_name"}
+DEPOSIT_GROUPS = {"category": "$category", "brand": "$brand"}
+
+
+def _time_range(field: str, start: Optional[datetime], end: Optional[datetime]) -> dict:
+    bounds = {}
+    if start:
+        bounds["$gte"] = start
+    if end:
+        bounds["$lt"] = end
+    return {field: bounds} if bounds else {}
+
+
+def _bucket(field: str, unit: str) -> dict:
+    return {"$dateTrunc": {"date": f"${field}", "unit": unit, "startOfWeek": "monday"}}
+
+
+def spend_pipeline(group_by: str, bucket: str, user_id: Optional[str] = None,
+                   start: Optional[datetime] = None, end: Optional[datetime] = None) -> list:
+    """Completed payments summed per merchant or website per time bucket."""
+    match = {"type": "payment", "status": "completed", **_time_range("created_at", start, end)}
+    if user_id:
+        match["user_id"] = user_id
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"bucket": _bucket("created_at", bucket), "name": SPEND_GROUPS[group_by]},
+            "total": {"$sum": "$amount"},
+            "count": {"$sum": 1},
+        }},
+        {"$sort": {"_id.bucket": 1, "total": -1}},
+        {"$project": {"_id": 0, "bucket": "$_id.bucket", "name": "$_id.name", "total": 1, "count": 1}},
+    ]
+
+
+def deposit_pipeline(group_by: str, bucket: str, user_id: Optional[str] = None,
+                     start: Optional[datetime] = None, end: Optional[datetime] = None) -> list:
+    """Deposited items (count and value) per category or brand per time bucket."""
+    match = _time_range("created_at", start, end)
+    if user_id:
+        match["owner_id"] = user_id
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"bucket": _bucket("created_at", bucket), "name": DEPOSIT_GROUPS[group_by]},
+            "total_value": {"$sum": "$value"},
+            "count": {"$sum": 1},
+        }},
+        {"$sort": {"_id.bucket": 1, "total_value": -1}},
+        {"$project": {"_id": 0, "bucket": "$_id.bucket", "name": "$_id.name", "total_value": 1, "count": 1}},
+    ]
+
+
+def trade_volume_pipeline(start: Optional[datetime] = None, end: Optional[datetime] = None,
+                          limit: int = 100) -> list:
+    """Value each user sent and received through trades, busiest first."""
+    return [
+        {"$match": {"status": "completed", **_time_range("timestamp", start, end)}},
+        {"$project": {"sides": [
+            {"user_id": "$payer_id", "sent": "$total_value", "received": {"$literal": 0}},
+            {"user_id": "$payee_id", "sent": {"$literal": 0}, "received": "$total_value"},
+        ]}},
+        {"$unwind": "$sides"},
+        {"$group": {
+            "_id": "$sides.user_id",
+            "sent": {"$sum": "$sides.sent"},
+            "received": {"$sum": "$sides.received"},
+            "trades": {"$sum": 1},
+        }},
+        {"$addFields": {"volume": {"$add": ["$sent", "$received"]}}},
+        {"$sort": {"volume": -1, "_id": 1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "user_id": "$_id", "sent": 1, "received": 1, "volume": 1, "trades": 1}},
+    ]
+
+
+def value_by_condition_pipeline(category: Optional[str] = None) -> list:
+    """Average, min and max item value per condition."""
+    return [
+        {"$match": {"category": category} if category else {}},
+        {"$group": {
+            "_id": "$condition",
+            "average_value": {"$avg": "$value"},
+            "min_value": {"$min": "$value"},
+            "max_value": {"$max": "$value"},
+            "count": {"$sum": 1},
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "condition": "$_id", "average_value": 1, "min_value": 1, "max_value": 1, "count": 1}},
+    ]
+
+
+class ResultCache:
+    """Small LRU of aggregation results that expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float = 60.0, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
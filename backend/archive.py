@@ -0,0 +1,218 @@
+"""
+Archival of old transaction and trade history.
+
+`transactions` and `trades` hold only recent documents. A mover running in
+each worker moves anything older than the archive horizon into
+`<collection>_archive`, which has the same shape and its own indexes. Hot
+collections and their indexes then stay sized to the horizon however long
+the platform runs.
+
+Each move goes archive-first (upsert by _id) then deletes from the hot
+collection, so a crash mid-batch only leaves duplicates that the next run
+removes. Companion documents (a trade's per-party entries) move the same
+way, ahead of the documents they belong to. Per-user monthly summaries of archived periods are rebuilt from
+the archive with `$merge` after each batch, which is idempotent for the
+same reason. Users whose history moved get their version marks raised,
+so ETags for both the hot and archived views change.
+
+Only one worker moves at a time, guarded by a lease in the `locks`
+collection.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+import money
+from changes import mark_changed, next_change_seq
+
+logger = logging.getLogger(__name__)
+
+# collection -> (time field, user id fields)
+ARCHIVED = {
+    "transactions": ("created_at", ("user_id",)),
+    "trades": ("timestamp", ("payer_id", "payee_id")),
+}
+
+# collection -> (companion collection, join field): documents that move with it
+COMPANIONS = {"trades": ("trade_parties", "trade_id")}
+
+LEASE = timedelta(minutes=5)
+
+
+def archive_name(collection: str) -> str:
+    return f"{collection}_archive"
+
+
+def _month(field: str) -> dict:
+    return {"$dateToString": {"format": "%Y-%m", "date": f"${field}"}}
+
+
+def summary_pipeline(collection: str, user_ids: list, start: datetime, end: datetime) -> list:
+    """Rebuild monthly summaries for some users over [start, end) from the archive."""
+    field, user_fields = ARCHIVED[collection]
+    match = {field: {"$gte": start, "$lt": end}, "$or": [{f: {"$in": user_ids}} for f in user_fields]}
+
+    if collection == "transactions":
+        grouped = [
+            {"$group": {
+                "_id": {"user_id": "$user_id", "month": _month(field), "type": "$type"},
+                "count": {"$sum": 1},
+                "total": {"$sum": "$amount"},
+            }},
+            {"$group": {
+                "_id": {"user_id": "$_id.user_id", "month": "$_id.month"},
+                "count": {"$sum": "$count"},
+                "by_type": {"$push": {"k": "$_id.type", "v": {"count": "$count", "total": "$total"}}},
+            }},
+            {"$set": {"by_type": {"$arrayToObject": "$by_type"}}},
+        ]
+    else:
+        grouped = [
+            {"$project": {field: 1, "sides": [
+                {"user_id": "$payer_id", "sent": "$total_value", "received": {"$literal": 0}},
+                {"user_id": "$payee_id", "sent": {"$literal": 0}, "received": "$total_value"},
+            ]}},
+            {"$unwind": "$sides"},
+            {"$match": {"sides.user_id": {"$in": user_ids}}},
+            {"$group": {
+                "_id": {"user_id": "$sides.user_id", "month": _month(field)},
+                "count": {"$sum": 1},
+                "sent": {"$sum": "$sides.sent"},
+                "received": {"$sum": "$sides.received"},
+            }},
+        ]
+
+    return [
+        {"$match": match},
+        *grouped,
+        {"$project": {
+            "_id": {"$concat": [f"{collection}:", "$_id.user_id", ":", "$_id.month"]},
+            "collection": {"$literal": collection},
+            "user_id": "$_id.user_id",
+            "month": "$_id.month",
+            "count": 1,
+            "by_type": 1,
+            "sent": 1,
+            "received": 1,
+        }},
+        {"$merge": {"into": "history_summaries", "on": "_id", "whenMatched": "replace"}},
+    ]
+
+
+def month_bounds(first: datetime, last: datetime) -> tuple:
+    """[start of first's month, start of the month after last's)."""
+    return datetime(first.year, first.month, 1), datetime(last.year + last.month // 12, last.month % 12 + 1, 1)
+
+
+async def move_batch(db, collection: str, cutoff: datetime, batch_size: int = 1000) -> list:
+    """
+    Copy up to `batch_size` documents older than `cutoff` (and their
+    companions) into the archive, then delete them; returns the moved documents.
+    """
+    field, _ = ARCHIVED[collection]
+    docs = await db[collection].find({field: {"$lt": cutoff}}).sort(field, 1).limit(batch_size).to_list(batch_size)
+    if not docs:
+        return []
+
+    await db[archive_name(collection)].bulk_write(
+        # Read back as floats, so money goes back to Decimal128 on the way over
+        [ReplaceOne({"_id": doc["_id"]}, money.encode(collection, doc), upsert=True) for doc in docs], ordered=False
+    )
+    if collection in COMPANIONS:
+        # Moved before their documents leave, so a crash can't strand them in the hot collection
+        companion, join = COMPANIONS[collection]
+        moving = {join: {"$in": [doc[join] for doc in docs]}}
+        companions = await db[companion].find(moving).to_list(None)
+        if companions:
+            await db[archive_name(companion)].bulk_write(
+                [ReplaceOne({"_id": doc["_id"]}, money.encode(companion, doc), upsert=True) for doc in companions],
+                ordered=False
+            )
+            await db[companion].delete_many(moving)
+    await db[collection].delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+    return docs
+
+
+async def archive_batch(db, collection: str, cutoff: datetime, batch_size: int = 1000) -> int:
+    """Move up to `batch_size` documents older than `cutoff`; returns how many moved."""
+    field, user_fields = ARCHIVED[collection]
+    docs = await move_batch(db, collection, cutoff, batch_size)
+    if not docs:
+        return 0
+
+    user_ids = sorted({doc.get(f) for doc in docs for f in user_fields} - {None})
+    month_start, month_end = month_bounds(docs[0][field], docs[-1][field])
+    await db[archive_name(collection)].aggregate(
+        summary_pipeline(collection, user_ids, month_start, month_end)
+    ).to_list(None)
+
+    seq = await next_change_seq(db)
+    await mark_changed(db, collection, user_ids, seq)
+    await mark_changed(db, archive_name(collection), user_ids, seq)
+    return len(docs)
+
+
+async def acquire_lease(db, name: str, holder: str, duration: timedelta = LEASE) -> bool:
+    now = datetime.utcnow()
+    try:
+        await db.locks.find_one_and_update(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"holder": holder}]},
+            {"$set": {"holder": holder, "expires_at": now + duration}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        # Someone else holds an unexpired lease
+        return False
+
+
+class ArchiveMover:
+    """Background task that periodically archives history past `after`."""
+
+    def __init__(self, db, after: timedelta, interval: float = 3600, batch_size: int = 1000):
+        self.db = db
+        self.after = after
+        self.interval = interval
+        self.batch_size = batch_size
+        self.holder = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self) -> dict:
+        cutoff = datetime.utcnow() - self.after
+        moved = {}
+        for collection in ARCHIVED:
+            moved[collection] = 0
+            while await acquire_lease(self.db, "archive", self.holder):
+                count = await archive_batch(self.db, collection, cutoff, self.batch_size)
+                moved[collection] += count
+                if count < self.batch_size:
+                    break
+        return moved
+
+    async def _run(self):
+        while True:
+            try:
+                moved = await self.run_once()
+                if any(moved.values()):
+                    logger.info(f"Archived history older than {self.after.days} days: {moved}")
+            except PyMongoError as e:
+                logger.warning(f"Archive run failed: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,132 @@
+"""
+Signed session tokens and PIN hashing.
+
+Login issues two JWTs (HS256): a short-lived access token carrying the
+claims most requests need (user_id as `sub`, username) and a longer-lived
+refresh token that can only be traded for a new pair. Access tokens are
+checked in-process, with a signature and an expiry check and no database
+read, which costs microseconds. Refresh goes back to the database once,
+so a deleted user can't renew.
+
+Signing keys come from AUTH_SIGNING_KEYS as `kid:secret` pairs separated
+by commas. The first pair signs, and every listed pair verifies. To rotate,
+put a new pair first and drop the old one once the refresh TTL has passed.
+Each token names its key in the `kid` header. Without AUTH_SIGNING_KEYS a
+random per-process key is used, so tokens don't survive a restart or work
+across workers.
+
+PINs arrive already hashed by the client (SHA-256 of the PIN). That value
+is what a stolen database would otherwise hand over, so it's stored under
+bcrypt. bcrypt is deliberately slow (tens of milliseconds), so it runs on a
+worker thread and never on the event loop. Accounts created before this
+still hold the client hash in plain form. They are checked by constant-time
+comparison and rehashed on their next successful login.
+"""
+import asyncio
+import hmac
+import logging
+import secrets
+import time
+import uuid
+from typing import Dict, Optional
+
+import bcrypt
+import jwt
+from starlette.exceptions import HTTPException
+
+logger = logging.getLogger(__name__)
+
+ALGORITHM = "HS256"
+ACCESS = "access"
+REFRESH = "refresh"
+BCRYPT_PREFIX = "$2"
+
+
+class InvalidToken(HTTPException):
+    def __init__(self, detail: str = "Invalid or expired token"):
+        super().__init__(status_code=401, detail=detail, headers={"WWW-Authenticate": "Bearer"})
+
+
+def parse_keys(spec: Optional[str]) -> Dict[str, bytes]:
+    """`kid:secret,kid:secret` to an ordered {kid: secret}; the first signs."""
+    keys = {}
+    for pair in filter(None, (part.strip() for part in (spec or "").split(","))):
+        kid, sep, secret = pair.partition(":")
+        if not sep or not kid or not secret:
+            raise ValueError(f"AUTH_SIGNING_KEYS entry {kid!r} is not kid:secret")
+        keys[kid] = secret.encode()
+    return keys
+
+
+class TokenIssuer:
+    def __init__(self, keys: Dict[str, bytes], access_ttl: int = 900, refresh_ttl: int = 30 * 86400):
+        if not keys:
+            logger.warning("AUTH_SIGNING_KEYS not set; tokens are signed with a per-process key")
+            keys = {"ephemeral": secrets.token_bytes(32)}
+        self.keys = keys
+        self.signing_kid = next(iter(keys))
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+
+    def issue(self, user: dict, kind: str = ACCESS) -> str:
+        now = int(time.time())
+        claims = {
+            "sub": user["user_id"],
+            "typ": kind,
+            "iat": now,
+            "exp": now + (self.access_ttl if kind == ACCESS else self.refresh_ttl),
+            "jti": uuid.uuid4().hex,
+        }
+        if kind == ACCESS:
+            claims["username"] = user["username"]
+        return jwt.encode(claims, self.keys[self.signing_kid], algorithm=ALGORITHM,
+                          headers={"kid": self.signing_kid})
+
+    def pair(self, user: dict) -> dict:
+        return {
+            "access_token": self.issue(user, ACCESS),
+            "refresh_token": self.issue(user, REFRESH),
+            "token_type": "bearer",
+            "expires_in": self.access_ttl,
+        }
+
+    def verify(self, token: str, kind: str = ACCESS) -> dict:
+        """The token's claims; raises InvalidToken if it is forged, expired, or the wrong kind."""
+        try:
+            key = self.keys.get(jwt.get_unverified_header(token).get("kid"))
+            if key is None:
+                raise InvalidToken("Token signed with an unknown key")
+            claims = jwt.decode(token, key, algorithms=[ALGORITHM], options={"require": ["exp", "sub", "typ"]})
+        except jwt.PyJWTError:
+            raise InvalidToken()
+        if claims["typ"] != kind:
+            raise InvalidToken(f"Expected an {kind} token")
+        return claims
+
+
+def bearer(authorization: Optional[str]) -> Optional[str]:
+    """The token in an `Authorization: Bearer ...` header, if any."""
+    scheme, _, token = (authorization or "").partition(" ")
+    return token.strip() or None if scheme.lower() == "bearer" else None
+
+
+def _hash(pin_hash: str, rounds: int) -> str:
+    return bcrypt.hashpw(pin_hash.encode(), bcrypt.gensalt(rounds)).decode()
+
+
+def _check(stored: str, pin_hash: str) -> bool:
+    if stored.startswith(BCRYPT_PREFIX):
+        return bcrypt.checkpw(pin_hash.encode(), stored.encode())
+    return hmac.compare_digest(stored.encode(), pin_hash.encode())
+
+
+async def hash_pin(pin_hash: str, rounds: int = 12) -> str:
+    return await asyncio.to_thread(_hash, pin_hash, rounds)
+
+
+async def check_pin(stored: str, pin_hash: str) -> bool:
+    return await asyncio.to_thread(_check, stored, pin_hash)
+
+
+def needs_upgrade(stored: str) -> bool:
+    return not stored.startswith(BCRYPT_PREFIX)
@@ -0,0 +1,262 @@
+"""
+Backend performance benchmarks.
+
+    python benchmarks.py workers --workers 4 --duration 15
+    python benchmarks.py tag-codec
+    python benchmarks.py search --items 1000000
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from pathlib import Path
+
+import requests
+import typer
+
+ROOT_DIR = Path(__file__).parent
+
+cli = typer.Typer(help="Backend performance benchmarks")
+
+
+@cli.callback()
+def main():
+    """Run one of the benchmark suites below."""
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# ============ HTTP Load Generation ============
+def _client_process(args):
+    """Hammer one endpoint from a single client process; returns latencies in seconds."""
+    url, method, body, deadline, threads = args
+    session = requests.Session()
+    latencies = []
+    errors = 0
+
+    def loop():
+        nonlocal errors
+        local = []
+        while time.time() < deadline:
+            started = time.perf_counter()
+            try:
+                response = session.request(method, url, json=body, timeout=10)
+                if response.status_code >= 500:
+                    errors += 1
+            except requests.RequestException:
+                errors += 1
+                continue
+            local.append(time.perf_counter() - started)
+        return local
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for result in pool.map(lambda _: loop(), range(threads)):
+            latencies.extend(result)
+    return latencies, errors
+
+
+def drive_load(url, method, body, duration, clients, threads):
+    deadline = time.time() + duration
+    with Pool(clients) as pool:
+        results = pool.map(_client_process, [(url, method, body, deadline, threads)] * clients)
+
+    latencies = [lat for lats, _ in results for lat in lats]
+    errors = sum(err for _, err in results)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.25)
+    raise RuntimeError(f"Server at {url} did not come up within {timeout}s")
+
+
+@cli.command()
+def workers(
+    workers: int = typer.Option(os.cpu_count() or 1, help="Worker count for the multi-process run"),
+    port: int = 8099,
+    duration: float = 15.0,
+    clients: int = typer.Option(4, help="Client processes generating load"),
+    threads: int = typer.Option(16, help="Concurrent connections per client process"),
+    path: str = "/api/valuations/mock",
+):
+    """Compare throughput of a single worker against the multi-worker runner."""
+    body = {"category": "electronics", "subcategory": "phone", "brand": "Apple", "condition": "good"}
+    url = f"http://127.0.0.1:{port}{path}"
+    results = {}
+
+    for count in sorted({1, workers}):
+        server = subprocess.Popen(
+            [sys.executable, str(ROOT_DIR / "run.py"), "--workers", str(count),
+             "--port", str(port), "--host", "127.0.0.1", "--log-level", "warning"],
+            cwd=ROOT_DIR,
+        )
+        try:
+            wait_until_up(f"http://127.0.0.1:{port}/docs")
+            drive_load(url, "POST", body, 2.0, clients, threads)  # warm-up
+            results[f"{count}_workers"] = drive_load(url, "POST", body, duration, clients, threads)
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+
+    print(json.dumps(results, indent=2))
+
+
+# ============ NFC Tag Codec ============
+@cli.command("tag-codec")
+def tag_codec_bench(iterations: int = 100_000):
+    """Encode/decode throughput and payload size of the binary tag format."""
+    import uuid
+    from datetime import datetime
+
+    import tag_codec
+
+    key = b"benchmark-key"
+    payloads = [
+        tag_codec.TagPayload(
+            item_id=str(uuid.uuid4()),
+            owner_id=str(uuid.uuid4()),
+            category="shoes",
+            subcategory="sneakers",
+            brand="Nike" if i % 2 else "Some Boutique Label",
+            condition="good",
+            value=89.99 + i,
+            is_fractional=bool(i % 3),
+            share_percentage=0.25,
+            timestamp=datetime.utcnow(),
+        )
+        for i in range(1000)
+    ]
+
+    started = time.perf_counter()
+    encoded = [tag_codec.encode(payloads[i % len(payloads)], key) for i in range(iterations)]
+    encode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for data in encoded:
+        tag_codec.decode(data, key)
+    decode_seconds = time.perf_counter() - started
+
+    sizes = [len(data) for data in encoded[:len(payloads)]]
+    print(json.dumps({
+        "encode_per_sec": round(iterations / encode_seconds),
+        "decode_verify_per_sec": round(iterations / decode_seconds),
+        "payload_bytes": {"min": min(sizes), "max": max(sizes), "mean": round(statistics.fmean(sizes), 1)},
+        "ntag215_user_bytes": tag_codec.NTAG215_USER_BYTES,
+    }, indent=2))
+
+
+
+# ============ Item Search ============
+def _timed(collection, pipeline, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        rows = list(collection.aggregate(pipeline))
+        samples.append(time.perf_counter() - started)
+    return rows, {"p50_ms": round(percentile(samples, 50) * 1000, 2), "max_ms": round(max(samples) * 1000, 2)}
+
+
+@cli.command("search")
+def search_bench(
+    items: int = 1_000_000,
+    runs: int = 20,
+    database: str = typer.Option(None, help="Scratch database (default: <DB_NAME>_bench); its items are replaced"),
+    reseed: bool = typer.Option(False, help="Drop and reseed even if the database already holds enough items"),
+):
+    """Latency of item search pages, deep keyset paging and facet counts over a seeded catalogue."""
+    import random
+    import uuid
+    from datetime import datetime, timedelta
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    import search
+    from valuations import BRANDS, CONDITIONS, VALUATIONS
+
+    load_dotenv(ROOT_DIR / ".env")
+    db = MongoClient(os.environ["MONGO_URL"])[database or f"{os.environ['DB_NAME']}_bench"]
+    collection = db.items
+
+    if reseed or collection.estimated_document_count() < items:
+        collection.drop()
+        rng = random.Random(0)
+        start = datetime.utcnow() - timedelta(days=365)
+        pairs = [(category, sub) for category, subs in VALUATIONS.items() for sub in subs]
+        batch = []
+        for i in range(items):
+            category, subcategory = rng.choice(pairs)
+            brand = rng.choice(BRANDS)
+            batch.append({
+                "item_id": str(uuid.uuid4()), "owner_id": f"user-{rng.randrange(50_000)}",
+                "category": category, "subcategory": subcategory, "brand": brand,
+                "condition": rng.choice(CONDITIONS), "photo": "", "value": round(rng.lognormvariate(4, 1), 2),
+                "name": f"{brand} {subcategory}", "description": f"A {subcategory} by {brand}.",
+                "created_at": start + timedelta(seconds=rng.randrange(365 * 86400)),
+            })
+            if len(batch) == 10_000:
+                collection.insert_many(batch, ordered=False)
+                batch = []
+        if batch:
+            collection.insert_many(batch, ordered=False)
+
+    keys, options = search.text_index_spec()
+    collection.create_index(keys, **options)
+    collection.create_index([("created_at", -1), ("item_id", -1)])
+    collection.create_index([("value", 1), ("item_id", 1)])
+    collection.create_index([("category", 1), ("created_at", -1), ("item_id", -1)])
+    collection.create_index([("category", 1), ("value", 1), ("item_id", 1)])
+
+    shoes = search.filters(category="shoes")
+    cases = {
+        "browse_newest": (None, {}, "newest"),
+        "category_by_value": (None, shoes, "value_asc"),
+        "text_relevance": ("nike sneakers", {}, "relevance"),
+        "text_with_filters": ("nike", search.filters(category="shoes", condition="good", max_value=100), "relevance"),
+    }
+    results = {"items": collection.estimated_document_count()}
+    for name, (q, clauses, sort) in cases.items():
+        _, results[f"{name}_page"] = _timed(collection, search.results_pipeline(q, clauses, sort, 20), runs)
+        _, results[f"{name}_facets"] = _timed(collection, search.facet_pipeline(q, clauses), max(1, runs // 5))
+
+    # Walk 50 pages deep; a keyset page should cost the same as the first
+    field, _ = search.SORTS["newest"]
+    after, samples = None, []
+    for _ in range(50):
+        started = time.perf_counter()
+        rows = list(collection.aggregate(search.results_pipeline(None, shoes, "newest", 20, after)))
+        samples.append(time.perf_counter() - started)
+        if len(rows) <= 20:
+            break
+        after = (rows[19][field], rows[19]["item_id"])
+    results["first_page_ms"] = round(samples[0] * 1000, 2)
+    results[f"page_{len(samples)}_ms"] = round(samples[-1] * 1000, 2)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,254 @@
+"""
+Sampled capture of production traffic for replay.
+
+With CAPTURE_DIR set, a sampled fraction of API requests is recorded with
+its response as one JSON line in rolling NDJSON files
+(`capture-<pid>-<time>-<suffix>.ndjson`). Files roll over at a size limit and only
+the newest few are kept. `replay.py` re-drives the files against a local
+server.
+
+Nothing sensitive leaves the process:
+
+- PINs, PIN hashes, signatures and access/refresh tokens are replaced
+  with a fixed marker (delta sync's continuation `token` is kept, since
+  replay needs it);
+- personal details (names, email, phone, address, username) become a
+  keyed hash, stable within one capture run, so repeated values still
+  repeat and cache behaviour replays faithfully;
+- photos become a size marker, which replay swaps for a generated image;
+- other bodies that aren't JSON keep only their size;
+- only headers that shape the response (content type, encodings,
+  conditional GET) are kept.
+
+Keys are scrubbed wherever they appear: JSON bodies, NDJSON lines, the
+query string and paths that embed a username. Serialising and writing
+happen on a writer thread behind a bounded queue; when it falls behind,
+records are dropped and counted, never waited for. Server-sent event streams aren't captured.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_KEYS = {
+    "pin", "pin_hash", "payer_signature", "payee_signature", "signature", "password",
+    "access_token", "refresh_token", "__profile",
+}
+PERSONAL_KEYS = {
+    "username", "first_name", "last_name", "email", "phone", "street_address", "street_address_2",
+    "city", "state", "zip_code",
+}
+PHOTO_KEYS = {"photo", "image_base64"}
+# Paths whose last segment is a personal detail
+PERSONAL_PATHS = ("/api/users/by-username/",)
+KEPT_HEADERS = {"content-type", "accept", "accept-encoding", "if-none-match"}
+
+SCRUBBED = "[scrubbed]"
+PHOTO_MARKER = "<photo:"
+
+
+class Scrubber:
+    def __init__(self, key: Optional[bytes] = None):
+        self.key = key or os.urandom(16)
+
+    def pseudonym(self, value) -> str:
+        digest = hmac.new(self.key, str(value).encode(), hashlib.sha256).hexdigest()[:16]
+        return f"anon-{digest}"
+
+    def value(self, key: str, value):
+        if isinstance(value, (dict, list)):
+            return self.document(value)
+        if value is None:
+            return None
+        if key in SECRET_KEYS:
+            return SCRUBBED
+        if key in PERSONAL_KEYS:
+            return self.pseudonym(value)
+        if key in PHOTO_KEYS and isinstance(value, str):
+            return f"{PHOTO_MARKER}{len(value)}>"
+        return value
+
+    def document(self, doc):
+        if isinstance(doc, dict):
+            return {key: self.value(key, inner) for key, inner in doc.items()}
+        if isinstance(doc, list):
+            return [self.document(inner) for inner in doc]
+        return doc
+
+    def path(self, path: str) -> str:
+        for prefix in PERSONAL_PATHS:
+            if path.startswith(prefix) and len(path) > len(prefix):
+                return prefix + self.pseudonym(path[len(prefix):])
+        return path
+
+    def query(self, query_string: str) -> str:
+        return urlencode([(key, self.value(key, value)) for key, value in parse_qsl(query_string, keep_blank_values=True)])
+
+    def body(self, raw: bytes, content_type: str) -> dict:
+        """A body as stored: scrubbed JSON where possible, otherwise just its size."""
+        if not raw:
+            return {"empty": True}
+        if "json" in content_type:
+            try:
+                if "ndjson" in content_type:
+                    return {"ndjson": [self.document(json.loads(line)) for line in raw.splitlines() if line.strip()]}
+                return {"json": self.document(json.loads(raw))}
+            except (ValueError, UnicodeDecodeError):
+                pass
+        # Anything unparsed may hold anything; keep only its size
+        return {"bytes": len(raw)}
+
+
+class RollingWriter:
+    """Writes NDJSON lines on its own thread, rolling files at `max_bytes` and keeping `max_files`."""
+
+    def __init__(self, directory: str, max_bytes: int, max_files: int, scrubber: Scrubber, queue_size: int = 1000):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.scrubber = scrubber
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._thread.start()
+
+    def put(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("capture_dropped_total")
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            try:
+                self._write(json.dumps(self._finish(record), default=str) + "\n")
+            except Exception:
+                logger.exception("Could not write a captured request")
+        if self._file is not None:
+            self._file.close()
+
+    def _finish(self, record: dict) -> dict:
+        """Scrub and decode bodies here rather than on the event loop."""
+        scrub = self.scrubber
+        record["path"] = scrub.path(record["path"])
+        record["query"] = scrub.query(record["query"])
+        if record.pop("request_truncated"):
+            # Replay skips these; a partial body would only replay as an error
+            record["request_body"] = {"bytes": len(record["request_body"]), "truncated": True}
+        else:
+            record["request_body"] = scrub.body(record["request_body"], record["request_headers"].get("content-type", ""))
+        response_body = record["response_body"]
+        if record.pop("response_truncated"):
+            record["response_body"] = {"bytes": len(response_body), "truncated": True}
+        else:
+            record["response_body"] = scrub.body(response_body, record["response_headers"].get("content-type", ""))
+        return record
+
+    def _write(self, line: str):
+        if self._file is None or self._file.tell() >= self.max_bytes:
+            self._roll()
+        self._file.write(line)
+        self._file.flush()
+
+    def _roll(self):
+        if self._file is not None:
+            self._file.close()
+        name = f"capture-{os.getpid()}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}.ndjson"
+        self._file = open(self.directory / name, "a", encoding="utf-8")
+        files = sorted(self.directory.glob(f"capture-{os.getpid()}-*.ndjson"), key=lambda path: path.stat().st_mtime)
+        for old in files[:-self.max_files]:
+            old.unlink(missing_ok=True)
+        metrics.inc("capture_files_total")
+
+
+class CaptureMiddleware:
+    """Record a sample of API requests and their responses."""
+
+    def __init__(self, app, writer: RollingWriter, sample_rate: float = 0.01, max_body_bytes: int = 256 * 1024,
+                 max_request_bytes: int = 16 * 1024 * 1024, path_prefix: str = "/api"):
+        self.app = app
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.max_body_bytes = max_body_bytes
+        # Photo uploads are large but scrub down to a marker, so requests get more room
+        self.max_request_bytes = max_request_bytes
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefix) \
+                or random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+
+        request_body = bytearray()
+        response = {"status": None, "headers": {}, "body": bytearray(), "truncated": False, "streaming": False}
+
+        async def recording_receive():
+            message = await receive()
+            if message["type"] == "http.request" and len(request_body) <= self.max_request_bytes:
+                request_body.extend(message.get("body", b""))
+            return message
+
+        async def recording_send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                headers = {name.decode("latin-1").lower(): value.decode("latin-1")
+                           for name, value in message.get("headers", [])}
+                response["headers"] = {name: value for name, value in headers.items()
+                                       if name in KEPT_HEADERS | {"content-encoding", "etag"}}
+                response["streaming"] = headers.get("content-type", "").startswith("text/event-stream")
+            elif message["type"] == "http.response.body" and not response["truncated"]:
+                response["body"].extend(message.get("body", b""))
+                if len(response["body"]) > self.max_body_bytes:
+                    response["truncated"] = True
+            await send(message)
+
+        started_at = time.time()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, recording_receive, recording_send)
+        finally:
+            if not response["streaming"] and response["status"] is not None:
+                request_headers = {
+                    name.decode("latin-1").lower(): value.decode("latin-1")
+                    for name, value in scope.get("headers", [])
+                    if name.decode("latin-1").lower() in KEPT_HEADERS
+                }
+                metrics.inc("requests_captured_total")
+                self.writer.put({
+                    "id": str(uuid.uuid4()),
+                    "at": started_at,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "query": scope.get("query_string", b"").decode("latin-1"),
+                    "request_headers": request_headers,
+                    "request_body": bytes(request_body),
+                    "request_truncated": len(request_body) > self.max_request_bytes,
+                    "status": response["status"],
+                    "response_headers": response["headers"],
+                    "response_body": bytes(response["body"]),
+                    "response_truncated": response["truncated"] or "content-encoding" in response["headers"],
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                })
+
@@ -0,0 +1,180 @@
+"""
+Change tracking for delta sync.
+
+Every write to `items`, `transactions` and `trades` is stamped with a
+`change_seq` drawn from a global monotonic counter plus an `updated_at`
+time. Deletes (and items leaving an owner through a trade) leave a
+tombstone so clients can drop their local copy. An item traded back to a
+former owner clears that owner's tombstone first, otherwise a client
+catching up would receive both and delete the item it now holds.
+
+A sync token carries the highest sequence the client has seen and the time
+its sync began. Two writers can commit out of sequence order, so the next
+sync also re-reads anything updated within SETTLE_WINDOW of that time;
+clients apply results as idempotent upserts, so the overlap is harmless.
+Continuation tokens (handed out while a sync is still paging) page strictly
+by sequence and carry the original start time through to the final token.
+
+Documents written before change tracking existed are stamped at startup
+(or by running `python changes.py`): paging relies on every document having
+a sequence, and unstamped ones would all sort at 0 behind a continuation
+token that skips them.
+
+Each write also raises a per-user version mark (`versions` collection,
+keyed "<collection>:<user_id>") to the sequence it used. Those marks give
+list endpoints a strong ETag with a single indexed read, so a conditional
+GET can answer 304 without touching the documents themselves. Marks must be
+raised after the write they describe: a reader then never pairs a newer
+body with an ETag that would later match it.
+"""
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Tuple
+
+from pymongo import ReturnDocument, UpdateOne
+
+SETTLE_WINDOW = timedelta(seconds=5)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+async def next_change_seq(db, count: int = 1) -> int:
+    """
+    Reserve `count` consecutive sequence numbers and return the first.
+
+    Each document written gets its own number so sync pages can break on
+    any sequence boundary without splitting a group.
+    """
+    counter = await db.counters.find_one_and_update(
+        {"_id": "change_seq"},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return counter["seq"] - count + 1
+
+
+def stamp(fields: dict, seq: int, now: Optional[datetime] = None) -> dict:
+    """Add the change sequence and update time to a document or `$set` body."""
+    fields["change_seq"] = seq
+    fields["updated_at"] = now or datetime.utcnow()
+    return fields
+
+
+async def record_tombstones(db, collection: str, doc_id: str, user_ids: Iterable[str]):
+    user_ids = sorted(set(user_ids) - {None})
+    if not user_ids:
+        return
+    seq = await next_change_seq(db, len(user_ids))
+    now = datetime.utcnow()
+    await db.tombstones.insert_many([
+        {
+            "collection": collection,
+            "doc_id": doc_id,
+            "user_id": user_id,
+            "change_seq": seq + offset,
+            "updated_at": now,
+            "deleted_at": now,
+        }
+        for offset, user_id in enumerate(user_ids)
+    ])
+
+
+async def clear_tombstones(db, collection: str, doc_id: str, user_ids: Iterable[str]):
+    """Drop tombstones for users a document has come back to."""
+    user_ids = list(set(user_ids) - {None})
+    if user_ids:
+        await db.tombstones.delete_many({
+            "collection": collection, "doc_id": doc_id, "user_id": {"$in": user_ids},
+        })
+
+
+async def backfill_change_seq(db, batch_size: int = 1000) -> int:
+    """
+    Give documents written before change tracking a sequence number so full
+    syncs can page through them. Safe to re-run; returns documents stamped.
+    """
+    stamped = 0
+    for name in ("items", "transactions", "trades"):
+        while True:
+            ids = [doc["_id"] for doc in await db[name].find(
+                {"change_seq": {"$exists": False}}, {"_id": 1}
+            ).to_list(batch_size)]
+            if not ids:
+                break
+            first = await next_change_seq(db, len(ids))
+            await db[name].bulk_write([
+                UpdateOne({"_id": _id}, {"$set": {"change_seq": first + offset}})
+                for offset, _id in enumerate(ids)
+            ], ordered=False)
+            stamped += len(ids)
+    return stamped
+
+
+async def mark_changed(db, collection: str, user_ids: Iterable[str], seq: int):
+    for user_id in set(user_ids) - {None}:
+        await db.versions.update_one(
+            {"_id": f"{collection}:{user_id}"},
+            {"$max": {"seq": seq}},
+            upsert=True,
+        )
+
+
+async def current_etag(db, user_id: str, collections: Iterable[str]) -> str:
+    """Strong ETag over the named per-user collection versions."""
+    collections = list(collections)
+    marks = {
+        doc["_id"]: doc["seq"]
+        for doc in await db.versions.find(
+            {"_id": {"$in": [f"{name}:{user_id}" for name in collections]}}
+        ).to_list(len(collections))
+    }
+    versions = "-".join(str(marks.get(f"{name}:{user_id}", 0)) for name in collections)
+    return f'"{"+".join(collections)}.{versions}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison is what If-None-Match calls for
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def format_token(seq: int, started_at: datetime, continuation: bool = False) -> str:
+    token = f"{seq}.{(started_at - EPOCH) // timedelta(milliseconds=1)}"
+    return f"{token}.more" if continuation else token
+
+
+def parse_token(token: str) -> Tuple[int, datetime, bool]:
+    """Raises ValueError for anything that isn't a token we issued."""
+    parts = token.split(".")
+    continuation = len(parts) == 3 and parts[2] == "more"
+    if len(parts) != 2 and not continuation:
+        raise ValueError("malformed token")
+    seq, millis = int(parts[0]), int(parts[1])
+    if seq < 0 or millis < 0:
+        raise ValueError("negative token component")
+    return seq, EPOCH + timedelta(milliseconds=millis), continuation
+
+
+def since_filter(seq: int, started_at: datetime, continuation: bool = False) -> dict:
+    if continuation:
+        return {"change_seq": {"$gt": seq}}
+    return {"$or": [
+        {"change_seq": {"$gt": seq}},
+        {"updated_at": {"$gte": started_at - SETTLE_WINDOW}},
+    ]}
+
+
+if __name__ == "__main__":
+    import asyncio
+    import os
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / ".env")
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    count = asyncio.run(backfill_change_seq(client[os.environ["DB_NAME"]]))
+    print(f"Stamped {count} documents with a change sequence")
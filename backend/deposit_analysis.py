@@ -0,0 +1,169 @@
+"""
+Structured output for AI deposit analysis.
+
+The model is asked for JSON matching ANALYSIS_SCHEMA. Whatever comes back
+is parsed once, repaired locally if it isn't clean JSON, and normalized
+against the vocabularies in valuations.py before validation. Repairing
+here is much cheaper than asking the model again.
+
+Anything that still can't be mapped raises AnalysisParseError naming the
+field, rather than quietly becoming "accessories" or 10.0. Each parse is
+counted in `ai_analysis_parse_total` by outcome (ok, repaired, failed).
+"""
+import json
+import re
+from typing import Type
+
+from pydantic import BaseModel, ValidationError
+
+import metrics
+from valuations import BRANDS, CATEGORIES, CONDITIONS, SUBCATEGORIES, VALUATIONS
+
+FIELDS = ("name", "description", "category", "subcategory", "brand", "condition", "estimated_value")
+
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string", "description": "Clear, concise item name"},
+        "description": {"type": "string", "description": "Detailed 2-3 sentence description"},
+        "category": {"type": "string", "enum": list(CATEGORIES)},
+        "subcategory": {
+            "type": "string",
+            "description": "Specific type, e.g. " + ", ".join(SUBCATEGORIES[:-1]),
+        },
+        "brand": {"type": "string", "description": 'Brand if visible or identifiable, otherwise "Generic"'},
+        "condition": {"type": "string", "enum": list(CONDITIONS)},
+        "estimated_value": {"type": "number", "description": "Realistic current market value in USD"},
+    },
+    "required": list(FIELDS),
+    "additionalProperties": False,
+}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "deposit_analysis", "strict": True, "schema": ANALYSIS_SCHEMA},
+}
+
+CATEGORY_ALIASES = {
+    "clothes": "clothing", "apparel": "clothing", "shoe": "shoes", "footwear": "shoes",
+    "accessory": "accessories", "electronic": "electronics", "tech": "electronics",
+    "jewellery": "jewelry", "sport": "sports", "sporting goods": "sports", "tool": "tools",
+    "book": "books", "toy": "toys",
+}
+
+CONDITION_ALIASES = {
+    "brand new": "new", "mint": "new", "like new": "excellent", "very good": "excellent",
+    "used": "good", "worn": "fair", "damaged": "poor", "broken": "poor",
+}
+
+_BRANDS_BY_KEY = {brand.lower(): brand for brand in BRANDS}
+_CATEGORY_BY_SUBCATEGORY = {sub: category for category, subs in VALUATIONS.items() for sub in subs}
+_LINE_FIELD = re.compile(r"^\s*[*-]?\s*\**([a-z_ ]+?)\**\s*:\s*(.*)$", re.IGNORECASE)
+
+
+class AnalysisParseError(ValueError):
+    """The model's answer can't be turned into a valid analysis."""
+
+
+def _key(text) -> str:
+    return " ".join(str(text).strip().lower().replace("_", " ").split())
+
+
+def _repair_json(text: str):
+    """Common drift: code fences, prose around the object, trailing commas."""
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    candidate = re.sub(r",\s*([}\]])", r"\1", text[start:end + 1])
+    try:
+        data = json.loads(candidate)
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _from_labelled_lines(text: str) -> dict:
+    """The pre-JSON `FIELD: value` answer format, read in one pass over the lines."""
+    data = {}
+    current = None
+    for line in text.splitlines():
+        match = _LINE_FIELD.match(line)
+        field = _key(match.group(1)).replace(" ", "_") if match else None
+        if field == "value":
+            field = "estimated_value"
+        if field in FIELDS:
+            current = field
+            data[field] = match.group(2).strip()
+        elif current == "description" and line.strip():
+            # Only the description runs over several lines
+            data[current] += " " + line.strip()
+    return data
+
+
+def _normalize(data: dict) -> dict:
+    category = _key(data.get("category", ""))
+    category = CATEGORY_ALIASES.get(category, category)
+    subcategory = _key(data.get("subcategory", ""))
+    for singular in (subcategory[:-1], subcategory[:-2]):
+        if subcategory not in SUBCATEGORIES and subcategory.endswith("s") and singular in SUBCATEGORIES:
+            subcategory = singular
+    if category not in CATEGORIES:
+        # The subcategory often pins it down even when the category drifted
+        category = _CATEGORY_BY_SUBCATEGORY.get(subcategory, category)
+    if category not in CATEGORIES:
+        raise AnalysisParseError(f"unknown category {data.get('category')!r}")
+
+    condition = _key(data.get("condition", ""))
+    condition = CONDITION_ALIASES.get(condition, condition)
+    if condition not in CONDITIONS:
+        raise AnalysisParseError(f"unknown condition {data.get('condition')!r}")
+
+    brand = str(data.get("brand") or "").strip()
+    brand = _BRANDS_BY_KEY.get(brand.lower(), brand) if brand and _key(brand) not in ("unknown", "none", "n/a") else "Generic"
+
+    value = data.get("estimated_value")
+    if isinstance(value, str):
+        number = re.search(r"[0-9][0-9,]*\.?[0-9]*", value)
+        value = float(number.group(0).replace(",", "")) if number else None
+    if not isinstance(value, (int, float)) or value < 0:
+        raise AnalysisParseError(f"unusable estimated_value {data.get('estimated_value')!r}")
+
+    return {
+        "name": str(data.get("name") or "").strip(),
+        "description": str(data.get("description") or "").strip(),
+        "category": category,
+        "subcategory": subcategory or "item",
+        "brand": brand,
+        "condition": condition,
+        "estimated_value": round(float(value), 2),
+    }
+
+
+def parse_analysis(text: str, model: Type[BaseModel]) -> BaseModel:
+    """Turn the model's reply into `model`, repairing it if needed."""
+    outcome = "ok"
+    try:
+        try:
+            data = json.loads(text)
+            if not isinstance(data, dict):
+                raise ValueError("not an object")
+        except ValueError:
+            outcome = "repaired"
+            data = _repair_json(text) or _from_labelled_lines(text)
+
+        missing = [
+            field for field in ("name", "category", "condition", "estimated_value")
+            if data.get(field) in (None, "")
+        ]
+        if missing:
+            raise AnalysisParseError(f"missing {', '.join(missing)}")
+        try:
+            result = model.model_validate(_normalize(data))
+        except ValidationError as e:
+            raise AnalysisParseError(str(e))
+    except AnalysisParseError:
+        metrics.inc("ai_analysis_parse_total", outcome="failed")
+        raise
+
+    metrics.inc("ai_analysis_parse_total", outcome=outcome)
+    return result
@@ -0,0 +1,158 @@
+"""
+Perceptual hashes of item photos for near-duplicate detection.
+
+Each item stores a 64-bit difference hash (dHash) of its photo. Two photos
+of the same thing, even re-encoded, resized or lightly edited, land within
+a few bits of each other.
+
+Lookups use multi-index hashing. The hash is cut into CHUNKS 16-bit pieces,
+stored as "<position>:<hex>" strings in a multikey-indexed array. If two
+hashes differ in at most MAX_DISTANCE bits, then by pigeonhole at least
+one piece differs in at most MAX_DISTANCE // CHUNKS bits. A query
+therefore asks the index for every piece within that radius and checks
+exact distance only on the few candidates that come back. This stays a
+handful of index seeks however many items exist.
+
+Items deposited before hashing existed are hashed by running
+`python image_hash.py`.
+"""
+import base64
+import binascii
+import io
+from itertools import combinations
+from typing import List, Optional
+
+import numpy as np
+
+from changes import next_change_seq, stamp
+
+try:
+    from PIL import Image
+except ImportError:  # optional
+    Image = None
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+MAX_DISTANCE = 7
+
+
+class UnreadablePhoto(ValueError):
+    pass
+
+
+def decode_photo(photo: str, mode: str = "L", size=(64, 64)) -> "Image.Image":
+    """Decode a base64 photo (with or without a data: prefix) to `mode`, at least `size` large."""
+    if "base64," in photo:
+        photo = photo.split("base64,", 1)[1]
+    try:
+        image = Image.open(io.BytesIO(base64.b64decode(photo)))
+        # JPEG can decode straight to a small image, skipping most of the work
+        image.draft(mode, size)
+        return image.convert(mode)
+    except (binascii.Error, OSError, ValueError) as e:
+        raise UnreadablePhoto(str(e))
+
+
+def dhash(image: "Image.Image") -> int:
+    """Row-wise gradient hash over a 9x8 grayscale thumbnail."""
+    pixels = np.asarray(image.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def photo_hash(photo: str) -> Optional[int]:
+    """Hash a base64 photo, or None if Pillow isn't installed."""
+    if Image is None:
+        return None
+    return dhash(decode_photo(photo))
+
+
+def chunks(value: int) -> List[int]:
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (CHUNK_BITS * (CHUNKS - 1 - i))) & mask for i in range(CHUNKS)]
+
+
+def chunk_keys(value: int) -> List[str]:
+    return [f"{i}:{chunk:04x}" for i, chunk in enumerate(chunks(value))]
+
+
+def query_keys(value: int, max_distance: int = MAX_DISTANCE) -> List[str]:
+    """Every chunk key within the per-chunk radius of `value`'s chunks."""
+    radius = max_distance // CHUNKS
+    keys = []
+    for i, chunk in enumerate(chunks(value)):
+        for flips in range(radius + 1):
+            for positions in combinations(range(CHUNK_BITS), flips):
+                variant = chunk
+                for bit in positions:
+                    variant ^= 1 << bit
+                keys.append(f"{i}:{variant:04x}")
+    return keys
+
+
+def to_signed(value: int) -> int:
+    """MongoDB integers are signed 64-bit."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def distance(a: int, b: int) -> int:
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count("1")
+
+
+def hash_fields(value: int) -> dict:
+    return {"photo_hash": to_signed(value), "photo_hash_chunks": chunk_keys(value)}
+
+
+async def find_near_duplicates(db, value: int, max_distance: int = MAX_DISTANCE,
+                               exclude_item_id: Optional[str] = None, limit: int = 10) -> List[dict]:
+    """Items whose photo hash is within `max_distance` bits, closest first."""
+    query = {"photo_hash_chunks": {"$in": query_keys(value, max_distance)}}
+    if exclude_item_id:
+        query["item_id"] = {"$ne": exclude_item_id}
+    matches = []
+    async for doc in db.items.find(query, {"_id": 0, "item_id": 1, "owner_id": 1, "photo_hash": 1}):
+        bits = distance(value, doc["photo_hash"])
+        if bits <= max_distance:
+            matches.append({"item_id": doc["item_id"], "owner_id": doc["owner_id"], "distance": bits})
+    matches.sort(key=lambda match: match["distance"])
+    return matches[:limit]
+
+
+async def backfill_photo_hashes(db, batch_size: int = 200) -> int:
+    hashed = 0
+    while True:
+        docs = await db.items.find(
+            {"photo_hash": {"$exists": False}}, {"_id": 1, "photo": 1}
+        ).to_list(batch_size)
+        if not docs:
+            return hashed
+        for doc in docs:
+            try:
+                fields = hash_fields(photo_hash(doc.get("photo") or ""))
+            except UnreadablePhoto:
+                # Keep it out of the next batch
+                fields = {"photo_hash": None, "photo_hash_chunks": []}
+            # Stamped like any other item write, so sync and change polling see it
+            await db.items.update_one({"_id": doc["_id"]}, {"$set": stamp(fields, await next_change_seq(db))})
+            hashed += 1
+
+
+if __name__ == "__main__":
+    import asyncio
+    import os
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    if Image is None:
+        raise SystemExit("Pillow is required to hash photos")
+    load_dotenv(Path(__file__).parent / ".env")
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    count = asyncio.run(backfill_photo_hashes(client[os.environ["DB_NAME"]]))
+    print(f"Hashed {count} item photos")
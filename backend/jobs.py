@@ -0,0 +1,205 @@
+"""
+Durable background jobs stored in MongoDB.
+
+Submitting a job inserts a `jobs` document and returns its id at once.
+Every worker process runs a small pool of consumers that claim queued jobs
+with an atomic find-and-update, so a job runs in exactly one place at a
+time. A claim is a lease: if the worker dies, the lease runs out and
+another worker picks the job up again.
+
+A handler that raises is retried with exponential backoff and jitter up to
+`max_attempts`. PermanentJobError skips the retries. Finished jobs keep
+their result or error for JOB_RETENTION before a TTL index removes them;
+the input payload is dropped as soon as the job finishes, since it can be
+large (e.g. a base64 photo).
+
+Clients poll `get`. A job submitted with a `callback_url` also has its
+final state POSTed there, best effort.
+"""
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+import requests
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+FINISHED = (SUCCEEDED, FAILED)
+
+JOB_RETENTION = timedelta(days=1)
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying can't help."""
+
+
+def public_view(job: dict) -> dict:
+    return {
+        "job_id": job["_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "attempts": job.get("attempts", 0),
+        "result": job.get("result"),
+        "error": job.get("error"),
+        "created_at": job["created_at"],
+        "updated_at": job.get("updated_at"),
+    }
+
+
+class JobQueue:
+    def __init__(
+        self,
+        db,
+        handlers: Dict[str, Callable[[dict], Awaitable[dict]]],
+        concurrency: int = 4,
+        max_attempts: int = 3,
+        backoff: float = 2.0,
+        lease: timedelta = timedelta(minutes=5),
+        poll_interval: float = 1.0,
+    ):
+        self.db = db
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    async def ensure_indexes(self):
+        await self.db.jobs.create_index([("status", 1), ("run_after", 1)])
+        await self.db.jobs.create_index("finished_at", expireAfterSeconds=int(JOB_RETENTION.total_seconds()))
+
+    # ---- client side ----
+    async def submit(self, kind: str, payload: dict, callback_url: Optional[str] = None) -> dict:
+        if kind not in self.handlers:
+            raise ValueError(f"no handler for job kind {kind!r}")
+        now = datetime.utcnow()
+        job = {
+            "_id": str(uuid.uuid4()),
+            "kind": kind,
+            "status": QUEUED,
+            "payload": payload,
+            "callback_url": callback_url,
+            "attempts": 0,
+            "run_after": now,
+            "created_at": now,
+            "updated_at": now,
+        }
+        await self.db.jobs.insert_one(job)
+        metrics.inc("jobs_submitted_total", kind=kind)
+        # Wake a local consumer now rather than at its next poll
+        self._wakeup.set()
+        return job
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await self.db.jobs.find_one({"_id": job_id}, {"payload": 0})
+
+    # ---- lifecycle ----
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # ---- worker side ----
+    async def claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self.db.jobs.find_one_and_update(
+            {"$or": [
+                {"status": QUEUED, "run_after": {"$lte": now}},
+                # A worker died holding this one
+                {"status": RUNNING, "lease_until": {"$lt": now}},
+            ]},
+            {"$set": {"status": RUNNING, "lease_until": now + self.lease, "updated_at": now}, "$inc": {"attempts": 1}},
+            sort=[("run_after", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def run(self, job: dict):
+        handler = self.handlers[job["kind"]]
+        try:
+            result = await handler(job["payload"])
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back without charging an attempt
+            await self.db.jobs.update_one(
+                {"_id": job["_id"], "status": RUNNING},
+                {"$set": {"status": QUEUED, "run_after": datetime.utcnow()}, "$inc": {"attempts": -1}},
+            )
+            raise
+        except Exception as e:
+            permanent = isinstance(e, PermanentJobError)
+            if permanent or job["attempts"] >= self.max_attempts:
+                logger.warning(f"Job {job['_id']} ({job['kind']}) failed after {job['attempts']} attempts: {e}")
+                await self._finish(job, FAILED, error=str(e))
+            else:
+                delay = self.backoff * 2 ** (job["attempts"] - 1) * random.uniform(0.8, 1.2)
+                logger.info(f"Job {job['_id']} ({job['kind']}) attempt {job['attempts']} failed, retrying in {delay:.1f}s: {e}")
+                metrics.inc("jobs_retried_total", kind=job["kind"])
+                await self.db.jobs.update_one({"_id": job["_id"]}, {"$set": {
+                    "status": QUEUED,
+                    "error": str(e),
+                    "run_after": datetime.utcnow() + timedelta(seconds=delay),
+                    "updated_at": datetime.utcnow(),
+                }})
+            return
+        await self._finish(job, SUCCEEDED, result=result)
+
+    async def _finish(self, job: dict, status: str, result: dict = None, error: str = None):
+        now = datetime.utcnow()
+        finished = await self.db.jobs.find_one_and_update(
+            {"_id": job["_id"]},
+            {
+                "$set": {"status": status, "result": result, "error": error, "updated_at": now, "finished_at": now},
+                "$unset": {"payload": "", "lease_until": ""},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+        metrics.inc("jobs_finished_total", kind=job["kind"], status=status)
+        metrics.observe("job_seconds", (now - job["created_at"]).total_seconds(), kind=job["kind"])
+        if finished and finished.get("callback_url"):
+            asyncio.create_task(self._callback(finished))
+
+    async def _callback(self, job: dict):
+        body = public_view(job)
+        body["created_at"] = body["created_at"].isoformat()
+        body["updated_at"] = body["updated_at"].isoformat()
+        try:
+            await asyncio.to_thread(requests.post, job["callback_url"], json=body, timeout=10)
+        except requests.RequestException as e:
+            logger.warning(f"Callback for job {job['_id']} failed: {e}")
+
+    async def _consume(self):
+        while True:
+            try:
+                job = await self.claim()
+            except PyMongoError as e:
+                logger.warning(f"Claiming a job failed: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self.run(job)
+            except PyMongoError as e:
+                # The lease expires and another consumer retries it
+                logger.warning(f"Recording job {job['_id']} failed: {e}")
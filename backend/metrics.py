@@ -0,0 +1,66 @@
+"""
+In-process metrics.
+
+Counters and summaries are kept per worker process and keyed by name plus
+a sorted label tuple. `snapshot()` is what the /api/metrics endpoint serves.
+"""
+import threading
+from collections import defaultdict
+
+
+class Summary:
+    __slots__ = ("count", "total", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "mean": round(self.total / self.count, 6) if self.count else 0.0,
+            "min": self.min,
+            "max": self.max,
+        }
+
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_summaries = defaultdict(Summary)
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, amount: float = 1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += amount
+
+
+def observe(name: str, value: float, **labels):
+    with _lock:
+        _summaries[_key(name, labels)].observe(value)
+
+
+def snapshot() -> dict:
+    def render(key):
+        name, labels = key
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+    with _lock:
+        return {
+            "counters": {render(key): value for key, value in sorted(_counters.items())},
+            "summaries": {render(key): summary.as_dict() for key, summary in sorted(_summaries.items())},
+        }
@@ -0,0 +1,315 @@
+"""ASGI middleware shared by the API app."""
+import json
+import re
+import time
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.exceptions import HTTPException
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+
+class RequestBodyTooLarge(HTTPException):
+    def __init__(self, limit: int):
+        super().__init__(status_code=413, detail=f"Request body exceeds {limit} bytes")
+
+
+class BodySizeLimitMiddleware:
+    """
+    Reject request bodies above a byte limit with a 413.
+
+    Declared Content-Length is checked up front; chunked bodies are counted
+    as they stream in so an oversized upload never gets fully buffered.
+
+    Larger limits for particular routes go in `path_limits`, keyed by route
+    template: "/api/items", "PUT /api/items/{item_id}". A template matches
+    the whole path, `{name}` stands for one segment, and an optional method
+    narrows it further. Literal routes win over templates, so
+    "/api/items/import" isn't caught by "/api/items/{item_id}".
+    """
+
+    def __init__(self, app, max_body_bytes: int, path_limits: dict = None):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+        routes = []
+        for route, limit in (path_limits or {}).items():
+            method, _, template = route.rpartition(" ")
+            pattern = re.sub(r"\\{[^/]+?\\}", "[^/]+", re.escape(template))
+            routes.append((template.count("{"), -len(template), method.upper() or None, re.compile(pattern + "$"), limit))
+        self.path_limits = [route[2:] for route in sorted(routes, key=lambda route: route[:2])]
+
+    def limit_for(self, path: str, method: str = "POST") -> int:
+        for route_method, pattern, limit in self.path_limits:
+            if route_method in (None, method) and pattern.match(path):
+                return limit
+        return self.max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.limit_for(scope["path"], scope.get("method", "GET"))
+        for name, value in scope.get("headers", []):
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > limit:
+                    await self._reject(send, limit)
+                    return
+                break
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise RequestBodyTooLarge(limit)
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except RequestBodyTooLarge:
+            if response_started:
+                raise
+            await self._reject(send, limit)
+
+    @staticmethod
+    async def _reject(send, limit: int):
+        body = json.dumps({"detail": f"Request body exceeds {limit} bytes"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+# ============ Response Compression ============
+class GzipEncoder:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ZstdEncoder:
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+# Preferred first when the client accepts several at the same q-value
+ENCODERS = {"gzip": (GzipEncoder, 5)}
+if brotli is not None:
+    ENCODERS = {"br": (BrotliEncoder, 4), **ENCODERS}
+if zstandard is not None:
+    ENCODERS = {"zstd": (ZstdEncoder, 3), **ENCODERS}
+
+# Already-compressed or latency-sensitive content goes out untouched
+INCOMPRESSIBLE_TYPES = (
+    "image/", "video/", "audio/", "font/woff",
+    "application/zip", "application/gzip", "application/x-gzip",
+    "application/zstd", "application/octet-stream", "application/vnd.apache.parquet",
+    "text/event-stream",
+)
+
+
+def negotiate_encoding(accept_encoding: str):
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for name in ENCODERS:
+        q = accepted.get(name, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with zstd, brotli or gzip, whichever the client
+    prefers among those installed.
+
+    Bodies under `minimum_size` and already-compressed content types pass
+    through. Larger bodies are encoded chunk by chunk as the app streams
+    them, so a big export never has to sit in memory twice, and each chunk
+    is flushed to the client as soon as it is encoded so streamed progress
+    is not held back in the compressor's window. Encode time and
+    compression ratio are recorded per encoding in the metrics registry.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, levels: dict = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = levels or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _CompressingResponder(self, encoding, send)
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressingResponder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start_message = None
+        self.encoder = None
+        self.passthrough = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.encode_seconds = 0.0
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "")
+            if (
+                message["status"] < 200 or message["status"] in (204, 304)
+                or "content-encoding" in headers
+                or content_type.startswith(INCOMPRESSIBLE_TYPES)
+            ):
+                self.passthrough = True
+                metrics.inc("compression_skipped_total", reason="content")
+            elif int(headers.get("content-length", self.middleware.minimum_size)) < self.middleware.minimum_size:
+                self.passthrough = True
+                metrics.inc("compression_skipped_total", reason="size")
+            return
+
+        if message["type"] != "http.response.body":
+            await self._send(message)
+            return
+
+        if self.passthrough:
+            await self._flush_start()
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.encoder is None:
+            if not more_body and len(body) < self.middleware.minimum_size:
+                self.passthrough = True
+                metrics.inc("compression_skipped_total", reason="size")
+                await self._flush_start()
+                await self._send(message)
+                return
+            await self._begin()
+
+        self.bytes_in += len(body)
+        started = time.perf_counter()
+        chunk = self.encoder.compress(body)
+        if more_body:
+            if body:
+                chunk += self.encoder.flush()
+        else:
+            chunk += self.encoder.finish()
+        self.encode_seconds += time.perf_counter() - started
+        self.bytes_out += len(chunk)
+
+        await self._send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        if not more_body:
+            metrics.observe("compression_encode_seconds", self.encode_seconds, encoding=self.encoding)
+            if self.bytes_in:
+                metrics.observe("compression_ratio", self.bytes_out / self.bytes_in, encoding=self.encoding)
+            metrics.inc("compression_bytes_in_total", self.bytes_in, encoding=self.encoding)
+            metrics.inc("compression_bytes_out_total", self.bytes_out, encoding=self.encoding)
+
+    async def _begin(self):
+        encoder_cls, default_level = ENCODERS[self.encoding]
+        self.encoder = encoder_cls(self.middleware.levels.get(self.encoding, default_level))
+
+        headers = MutableHeaders(raw=self.start_message["headers"])
+        del headers["content-length"]
+        headers["content-encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        # The encoded bytes differ from the identity body, so the tag can only be weak
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            headers["etag"] = f"W/{etag}"
+
+        start, self.start_message = self.start_message, None
+        await self._send(start)
+
+    async def _flush_start(self):
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            await self._send(start)
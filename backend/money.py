@@ -0,0 +1,132 @@
+"""
+How money is stored.
+
+Balances, item values, transaction amounts and trade totals are stored as
+Decimal128 rounded to the cent, not as doubles. A double can't hold 0.10
+exactly, so every `balance + amount` drifted a little. MongoDB adds
+Decimal128 exactly, so balances now change with `$inc` of a Decimal128 in
+one atomic update instead of read, add and `$set`.
+
+The codec sits at the data-access boundary, in two halves:
+
+- reads: TYPE_REGISTRY, installed on the Motor client, decodes every
+  Decimal128 back to a float. Models, aggregation results (`$sum` over
+  Decimal128 is Decimal128), sync, and export see the same numbers as
+  before. MongoDB compares Decimal128 and doubles by exact value, so
+  NumberDecimal("19.99") never equals the double 19.99: amounts used in
+  filters or keyset cursors must go through `decimal()` too.
+- writes: `encode(collection, doc)` rewrites the money fields of a
+  document on its way in, and `decimal()` / `from_cents()` build `$inc`
+  operands.
+
+Documents written before this still hold doubles, which decode unchanged
+and sum alongside the new ones, though a filter at exactly their amount
+can miss them. `python money.py` converts them in place, hot and archived
+collections alike.
+
+UUIDs stay strings. Every filter, index, pipeline, and client compares them
+as strings, so storing them as binary would mean rewriting all of those at
+once. Field names stay as they are for the same reason.
+"""
+from decimal import Decimal
+from typing import Optional
+
+from bson.codec_options import TypeCodec, TypeRegistry
+from bson.decimal128 import Decimal128
+from pymongo import UpdateOne
+
+CENT = Decimal("0.01")
+
+# Money fields per collection; archives use their hot collection's entry
+FIELDS = {
+    "users": ("balance",),
+    "items": ("value",),
+    "transactions": ("amount",),
+    "trades": ("total_value", "items.value"),
+    "trade_parties": ("total_value",),
+}
+
+
+class MoneyCodec(TypeCodec):
+    python_type = Decimal
+    bson_type = Decimal128
+
+    def transform_python(self, value: Decimal) -> Decimal128:
+        return Decimal128(value)
+
+    def transform_bson(self, value: Decimal128) -> float:
+        return float(value.to_decimal())
+
+
+TYPE_REGISTRY = TypeRegistry([MoneyCodec()])
+
+
+def decimal(value) -> Optional[Decimal128]:
+    """An amount as stored, rounded to the cent; None stays None."""
+    if value is None or isinstance(value, Decimal128):
+        return value
+    # str() first: Decimal(0.1) is the double's full binary expansion, str(0.1) is "0.1"
+    return Decimal128(Decimal(str(value)).quantize(CENT))
+
+
+def from_cents(cents: int) -> Decimal128:
+    return Decimal128(Decimal(int(cents)).scaleb(-2))
+
+
+def load(value):
+    """A stored amount as a float, for readers without TYPE_REGISTRY."""
+    return float(value.to_decimal()) if isinstance(value, Decimal128) else value
+
+
+def _encode_path(doc, keys):
+    if isinstance(doc, list):
+        for element in doc:
+            _encode_path(element, keys)
+    elif isinstance(doc, dict) and keys[0] in doc:
+        if len(keys) == 1:
+            doc[keys[0]] = decimal(doc[keys[0]])
+        else:
+            _encode_path(doc[keys[0]], keys[1:])
+
+
+def encode(collection: str, doc: dict) -> dict:
+    """Convert `doc`'s money fields for storage in place; returns it for chaining."""
+    for path in FIELDS.get(collection, ()):
+        _encode_path(doc, path.split("."))
+    return doc
+
+
+async def migrate(db, batch_size: int = 1000) -> dict:
+    """
+    Convert every stored amount to Decimal128, hot and archived. Converted
+    documents stop matching, so it's safe to stop and re-run.
+    """
+    from archive import archive_name
+
+    converted = {}
+    for collection, paths in FIELDS.items():
+        unconverted = {"$or": [{path: {"$type": kind}} for path in paths for kind in ("double", "int", "long")]}
+        projection = {path.split(".")[0]: 1 for path in paths}
+        for name in (collection, archive_name(collection)):
+            while docs := await db[name].find(unconverted, projection).limit(batch_size).to_list(batch_size):
+                await db[name].bulk_write([
+                    UpdateOne({"_id": doc.pop("_id")}, {"$set": encode(collection, doc)}) for doc in docs
+                ], ordered=False)
+                converted[name] = converted.get(name, 0) + len(docs)
+    return converted
+
+
+if __name__ == "__main__":
+    import asyncio
+    import os
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / ".env")
+    database = AsyncIOMotorClient(os.environ["MONGO_URL"])[os.environ["DB_NAME"]]
+    converted = asyncio.run(migrate(database))
+    for name, count in converted.items():
+        print(f"{name}: {count} documents")
+    print(f"Converted {sum(converted.values())} documents")
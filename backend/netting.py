@@ -0,0 +1,246 @@
+"""
+Periodic multilateral netting of balance changes.
+
+With a settlement window configured, `create_transaction` no longer writes
+the user's balance. It records an obligation instead: who owes whom how
+much, pointing back at the transaction. Deposits and refunds are owed to
+the user by the platform (or the named merchant); payments and withdrawals
+are owed by the user. Non-user parties are prefixed with EXTERNAL so they
+never collide with user ids.
+
+Every window a runner (one worker at a time, under a lease) settles all
+obligations created before the cut-off:
+
+1. A `settlements` document is opened and the pending obligations are
+   claimed by stamping them with its id, which is the audit link from
+   each source transaction to the settlement that applied it.
+2. Net positions are summed per party in integer cents with NumPy, so a
+   user with thousands of payments in the window nets to one number.
+3. The positions are reduced to transfers by matching debtors against
+   creditors, largest first. Both sides are laid out as cumulative sums on
+   one axis and every boundary becomes one transfer, which is at most
+   one fewer transfer than there are parties with a non-zero position.
+4. The user balances change in a single `bulk_write` of exact Decimal128
+   `$inc`s (see money.py), one per user whatever their transaction count,
+   and the settlement is closed with its positions and transfers.
+
+Balances are guarded by `settled_through`: settlements are applied one at
+a time, so a settlement re-run after a crash skips users it already
+updated. A settlement still open when the runner starts is finished first.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+import numpy as np
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+import metrics
+import money
+from archive import acquire_lease
+from changes import mark_changed, next_change_seq
+
+logger = logging.getLogger(__name__)
+
+EXTERNAL = "ext:"
+PLATFORM = EXTERNAL + "platform"
+
+OPEN, APPLIED = "open", "applied"
+
+# transaction type -> whether the user is paid (True) or pays (False)
+CREDITS = {"deposit": True, "refund": True, "payment": False, "withdrawal": False}
+
+
+def counterparty(merchant_name: Optional[str]) -> str:
+    return f"{EXTERNAL}merchant:{merchant_name}" if merchant_name else PLATFORM
+
+
+def is_user(party: str) -> bool:
+    return not party.startswith(EXTERNAL)
+
+
+def obligation_for(transaction: dict) -> Optional[dict]:
+    """The obligation a transaction creates, or None if it doesn't move a balance."""
+    credit = CREDITS.get(transaction["type"])
+    if credit is None or not transaction["amount"]:
+        return None
+    other = counterparty(transaction.get("merchant_name"))
+    payer, payee = (other, transaction["user_id"]) if credit else (transaction["user_id"], other)
+    return {
+        "_id": transaction["transaction_id"],
+        "transaction_id": transaction["transaction_id"],
+        "payer": payer,
+        "payee": payee,
+        "amount": transaction["amount"],
+        "created_at": transaction["created_at"],
+        "settlement_id": None,
+    }
+
+
+def to_cents(amounts) -> np.ndarray:
+    return np.rint(np.asarray(amounts, dtype=np.float64) * 100).astype(np.int64)
+
+
+def net_positions(payers: np.ndarray, payees: np.ndarray, cents: np.ndarray, parties: int) -> np.ndarray:
+    """Net cents per party index: received minus paid."""
+    net = np.zeros(parties, dtype=np.int64)
+    np.add.at(net, payees, cents)
+    np.subtract.at(net, payers, cents)
+    return net
+
+
+def reduce_transfers(net: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (from, to, cents) transfers that settle `net`, which must sum to zero.
+    Debtors and creditors are each sorted largest first and their running
+    totals merged; each cut between consecutive totals is paid by the
+    debtor and to the creditor whose running interval covers it.
+    """
+    debtors = np.flatnonzero(net < 0)
+    creditors = np.flatnonzero(net > 0)
+    debtors = debtors[np.argsort(net[debtors], kind="stable")]
+    creditors = creditors[np.argsort(-net[creditors], kind="stable")]
+    owed = np.cumsum(-net[debtors])
+    due = np.cumsum(net[creditors])
+    cuts = np.union1d(owed, due)
+    amounts = np.diff(cuts, prepend=0)
+    return (
+        debtors[np.searchsorted(owed, cuts)],
+        creditors[np.searchsorted(due, cuts)],
+        amounts,
+    )
+
+
+# ============ Settling ============
+async def settle(db, cutoff: datetime) -> Optional[dict]:
+    """Open a settlement for obligations created before `cutoff` and apply it."""
+    settlement_id = str(uuid.uuid4())
+    await db.settlements.insert_one({
+        "_id": settlement_id, "status": OPEN, "cutoff": cutoff, "created_at": datetime.utcnow(),
+    })
+    claimed = await db.obligations.update_many(
+        {"settlement_id": None, "created_at": {"$lt": cutoff}},
+        {"$set": {"settlement_id": settlement_id}},
+    )
+    if not claimed.modified_count:
+        await db.settlements.delete_one({"_id": settlement_id})
+        return None
+    return await apply_settlement(db, settlement_id)
+
+
+def balance_updates(settlement_id: str, changes) -> List[UpdateOne]:
+    """One exact Decimal128 `$inc` per (user_id, cents), skipped if this settlement already reached the user."""
+    return [
+        UpdateOne(
+            {"user_id": user_id, "settled_through": {"$ne": settlement_id}},
+            {"$inc": {"balance": money.from_cents(change)}, "$set": {"settled_through": settlement_id}},
+        )
+        for user_id, change in changes
+    ]
+
+
+async def apply_settlement(db, settlement_id: str) -> dict:
+    """Net the obligations claimed by a settlement and write the balances once."""
+    payers, payees, amounts = [], [], []
+    async for obligation in db.obligations.find(
+        {"settlement_id": settlement_id}, {"_id": 0, "payer": 1, "payee": 1, "amount": 1}
+    ):
+        payers.append(obligation["payer"])
+        payees.append(obligation["payee"])
+        amounts.append(obligation["amount"])
+
+    parties, index = np.unique(np.array(payers + payees, dtype=object), return_inverse=True)
+    net = net_positions(index[:len(payers)], index[len(payers):], to_cents(amounts), len(parties))
+    senders, receivers, cents = reduce_transfers(net)
+
+    users = [(parties[i], int(net[i])) for i in np.flatnonzero(net) if is_user(parties[i])]
+    if users:
+        await db.users.bulk_write(balance_updates(settlement_id, users), ordered=False)
+        seq = await next_change_seq(db)
+        await mark_changed(db, "users", [user_id for user_id, _ in users], seq)
+
+    summary = {
+        "status": APPLIED,
+        "obligations": len(amounts),
+        "total": int(to_cents(amounts).sum()) / 100,
+        "positions": [{"party": parties[i], "net": int(net[i]) / 100} for i in np.flatnonzero(net)],
+        "transfers": [
+            {"from": parties[s], "to": parties[r], "amount": int(c) / 100}
+            for s, r, c in zip(senders, receivers, cents)
+        ],
+        "balance_writes": len(users),
+        "applied_at": datetime.utcnow(),
+    }
+    await db.settlements.update_one({"_id": settlement_id}, {"$set": summary})
+    metrics.inc("settlement_obligations_total", len(amounts))
+    metrics.inc("settlement_balance_writes_total", len(users))
+    return {"_id": settlement_id, **summary}
+
+
+async def pending_net(db, user_id: str) -> float:
+    """A user's balance change still waiting for the next settlement."""
+    cents = 0
+    async for obligation in db.obligations.find(
+        {"settlement_id": None, "$or": [{"payer": user_id}, {"payee": user_id}]}, {"payer": 1, "amount": 1}
+    ):
+        change = int(to_cents([obligation["amount"]])[0])
+        cents += -change if obligation["payer"] == user_id else change
+    return cents / 100
+
+
+async def ensure_indexes(db):
+    await db.obligations.create_index([("settlement_id", 1), ("created_at", 1)])
+    await db.obligations.create_index([("payer", 1), ("settlement_id", 1)])
+    await db.obligations.create_index([("payee", 1), ("settlement_id", 1)])
+    await db.settlements.create_index([("status", 1), ("created_at", 1)])
+
+
+class SettlementRunner:
+    """Background task that settles pending obligations every `window`."""
+
+    def __init__(self, db, window: timedelta):
+        self.db = db
+        self.window = window
+        self.holder = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self) -> List[dict]:
+        if not await acquire_lease(self.db, "settlement", self.holder, self.window * 2):
+            return []
+        settled = []
+        # Finish anything a crashed run left open before claiming more
+        async for unfinished in self.db.settlements.find({"status": OPEN}).sort("created_at", 1):
+            settled.append(await apply_settlement(self.db, unfinished["_id"]))
+        settlement = await settle(self.db, datetime.utcnow())
+        if settlement is not None:
+            settled.append(settlement)
+        return settled
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.window.total_seconds())
+            try:
+                for settlement in await self.run_once():
+                    logger.info(
+                        f"Settled {settlement['obligations']} obligations with "
+                        f"{settlement['balance_writes']} balance writes ({settlement['_id']})"
+                    )
+            except PyMongoError as e:
+                logger.warning(f"Settlement run failed: {e}")
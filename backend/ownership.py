@@ -0,0 +1,298 @@
+"""
+Append-only ownership log for items.
+
+Every deposit, trade transfer, share change and delete appends an event to
+`ownership_events`, numbered per item (`version` 1, 2, ...). Events are
+written before the item document changes, so the log is never behind
+`items` and can always rebuild it. `ownership_heads` holds each item's
+latest version and state; bumping it hands out the next version
+atomically, so concurrent writers never reuse a number.
+
+Every SNAPSHOT_EVERY events an item also gets a snapshot: its folded state
+at that version, including the provenance chain so far. "Owner at time T"
+and provenance queries load the newest snapshot at or before T and replay
+only the events after it, so their cost is bounded by SNAPSHOT_EVERY
+rather than by the item's history, and nothing scans `trades`.
+
+    python ownership.py backfill   # once, before serving: seed the log for existing items from their trades
+    python ownership.py rebuild    # re-derive heads and snapshots in one pass; --apply fixes items.owner_id
+"""
+import logging
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+DEPOSIT, TRANSFER, SHARE_CHANGE, DELETE = "deposit", "transfer", "share_change", "delete"
+
+SNAPSHOT_EVERY = 20
+
+
+def event_id(item_id: str, version: int) -> str:
+    return f"{item_id}:{version}"
+
+
+def empty_state(item_id: str) -> dict:
+    return {
+        "item_id": item_id, "version": 0, "owner_id": None, "share_percentage": None,
+        "deleted": False, "at": None, "owners": [],
+    }
+
+
+def apply(state: dict, event: dict) -> dict:
+    """Fold one event into an item's state; returns a new state."""
+    state = {**state, "owners": list(state["owners"])}
+    state["version"] = event["version"]
+    state["at"] = event["at"]
+    if event.get("share_percentage") is not None:
+        state["share_percentage"] = event["share_percentage"]
+
+    if event["type"] == DELETE:
+        state["deleted"] = True
+    elif event["owner_id"] != state["owner_id"]:
+        if state["owners"]:
+            state["owners"][-1] = {**state["owners"][-1], "until": event["at"]}
+        state["owners"].append({
+            "owner_id": event["owner_id"], "since": event["at"], "until": None,
+            "via": event["type"], "trade_id": event.get("trade_id"),
+        })
+        state["owner_id"] = event["owner_id"]
+    return state
+
+
+def replay(state: dict, events: Iterable[dict]) -> dict:
+    for event in events:
+        state = apply(state, event)
+    return state
+
+
+# ============ Writing ============
+async def append(db, item_id: str, type: str, owner_id: Optional[str], at: Optional[datetime] = None,
+                 share_percentage: Optional[float] = None, trade_id: Optional[str] = None,
+                 snapshot_every: int = SNAPSHOT_EVERY) -> dict:
+    """Record one ownership event; call it before changing the item itself."""
+    at = at or datetime.utcnow()
+    head_fields = {"at": at, "deleted": type == DELETE}
+    if owner_id is not None:
+        head_fields["owner_id"] = owner_id
+    if share_percentage is not None:
+        head_fields["share_percentage"] = share_percentage
+    head = await db.ownership_heads.find_one_and_update(
+        {"_id": item_id},
+        {"$inc": {"version": 1}, "$set": head_fields},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    event = {
+        "_id": event_id(item_id, head["version"]),
+        "item_id": item_id,
+        "version": head["version"],
+        "type": type,
+        # A delete or share change keeps the owner it had
+        "owner_id": head.get("owner_id"),
+        "share_percentage": share_percentage,
+        "trade_id": trade_id,
+        "at": at,
+    }
+    await db.ownership_events.insert_one(event)
+    if head["version"] % snapshot_every == 0:
+        await write_snapshot(db, item_id, head["version"])
+    return event
+
+
+async def append_deposits(db, items: List[dict]):
+    """Version 1 for a batch of newly created items (bulk import)."""
+    if not items:
+        return
+    await db.ownership_heads.bulk_write([
+        UpdateOne({"_id": item["item_id"]}, {
+            "$setOnInsert": {"version": 1},
+            "$set": {"owner_id": item["owner_id"], "share_percentage": item.get("share_percentage"),
+                     "at": item["created_at"], "deleted": False},
+        }, upsert=True)
+        for item in items
+    ], ordered=False)
+    await db.ownership_events.bulk_write([
+        ReplaceOne({"_id": event_id(item["item_id"], 1)}, {
+            "_id": event_id(item["item_id"], 1), "item_id": item["item_id"], "version": 1, "type": DEPOSIT,
+            "owner_id": item["owner_id"], "share_percentage": item.get("share_percentage"),
+            "trade_id": None, "at": item["created_at"],
+        }, upsert=True)
+        for item in items
+    ], ordered=False)
+
+
+async def write_snapshot(db, item_id: str, version: int):
+    state = await state_at(db, item_id, version=version)
+    await db.ownership_snapshots.replace_one(
+        {"_id": event_id(item_id, version)}, {"_id": event_id(item_id, version), **state}, upsert=True
+    )
+
+
+# ============ Reading ============
+async def state_at(db, item_id: str, when: Optional[datetime] = None, version: Optional[int] = None) -> dict:
+    """
+    Item state as of a time and/or version: the newest snapshot at or
+    before it plus the events after that snapshot.
+    """
+    bound = {}
+    if when is not None:
+        bound["at"] = {"$lte": when}
+    if version is not None:
+        bound["version"] = {"$lte": version}
+
+    snapshot = await db.ownership_snapshots.find_one(
+        {"item_id": item_id, **bound}, {"_id": 0}, sort=[("version", -1)]
+    )
+    state = snapshot or empty_state(item_id)
+    tail = {"item_id": item_id, **bound, "version": {**bound.get("version", {}), "$gt": state["version"]}}
+    return replay(state, [event async for event in db.ownership_events.find(tail, {"_id": 0}).sort("version", 1)])
+
+
+async def owner_at(db, item_id: str, when: datetime) -> Optional[dict]:
+    """Who held the item at `when`; None if it didn't exist yet or was deleted."""
+    state = await state_at(db, item_id, when=when)
+    if state["version"] == 0 or state["deleted"]:
+        return None
+    return state
+
+
+async def events(db, item_id: str, limit: int = 1000) -> List[dict]:
+    return await db.ownership_events.find({"item_id": item_id}, {"_id": 0}).sort("version", 1).to_list(limit)
+
+
+async def ensure_indexes(db):
+    await db.ownership_events.create_index([("item_id", 1), ("version", 1)], unique=True)
+    await db.ownership_events.create_index("trade_id", partialFilterExpression={"trade_id": {"$type": "string"}})
+    await db.ownership_snapshots.create_index([("item_id", 1), ("version", -1)])
+    await db.ownership_snapshots.create_index([("item_id", 1), ("at", -1)])
+
+
+# ============ Maintenance ============
+async def backfill(db) -> int:
+    """
+    Seed the log for items that predate it. Each gets a deposit by its
+    first known owner, then a transfer per trade that moved it. This is the
+    one place that reads trade history, in a single pass over `trades` and
+    its archive; re-running skips items already seeded.
+    """
+    from archive import archive_name
+
+    transfers = {}
+    for name in ("trades", archive_name("trades")):
+        async for trade in db[name].find({}, {"trade_id": 1, "timestamp": 1, "items": 1}):
+            for moved in trade.get("items", []):
+                if moved["previous_owner"] != moved["new_owner"]:
+                    transfers.setdefault(moved["item_id"], []).append((trade["timestamp"], trade["trade_id"], moved))
+
+    seeded = 0
+    async for item in db.items.find({}, {"item_id": 1, "owner_id": 1, "created_at": 1, "share_percentage": 1}):
+        if await db.ownership_heads.find_one({"_id": item["item_id"]}, {"_id": 1}):
+            continue
+        moves = sorted(transfers.get(item["item_id"], []), key=lambda move: move[0])
+        log = [{
+            "type": DEPOSIT, "owner_id": moves[0][2]["previous_owner"] if moves else item["owner_id"],
+            "share_percentage": item.get("share_percentage"), "trade_id": None,
+            "at": item.get("created_at") or datetime.utcnow(),
+        }]
+        log += [
+            {"type": TRANSFER, "owner_id": moved["new_owner"], "share_percentage": None, "trade_id": trade_id, "at": at}
+            for at, trade_id, moved in moves
+        ]
+        if log[-1]["owner_id"] != item["owner_id"]:
+            # Moved outside any recorded trade; the item document wins
+            log.append({"type": TRANSFER, "owner_id": item["owner_id"], "share_percentage": None,
+                        "trade_id": None, "at": datetime.utcnow()})
+
+        docs = [
+            {"_id": event_id(item["item_id"], version), "item_id": item["item_id"], "version": version, **entry}
+            for version, entry in enumerate(log, start=1)
+        ]
+        await db.ownership_events.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs])
+        state = replay(empty_state(item["item_id"]), docs)
+        await db.ownership_heads.replace_one({"_id": item["item_id"]}, head_doc(state), upsert=True)
+        seeded += 1
+    return seeded
+
+
+def head_doc(state: dict) -> dict:
+    return {
+        "version": state["version"], "owner_id": state["owner_id"], "share_percentage": state["share_percentage"],
+        "at": state["at"], "deleted": state["deleted"],
+    }
+
+
+async def rebuild(db, apply_to_items: bool = False, snapshot_every: int = SNAPSHOT_EVERY,
+                  batch_size: int = 1000) -> dict:
+    """
+    Re-derive heads and snapshots from the log in one pass over events
+    sorted by (item_id, version). Items whose owner_id disagrees with the
+    log are counted, and corrected with `apply_to_items`.
+    """
+    stats = {"items": 0, "events": 0, "snapshots": 0, "owner_mismatches": 0, "owners_fixed": 0}
+    states, snapshots = [], []
+
+    async def write_batch():
+        if states:
+            await db.ownership_heads.bulk_write(
+                [ReplaceOne({"_id": state["item_id"]}, head_doc(state), upsert=True) for state in states],
+                ordered=False,
+            )
+            owners = {state["item_id"]: state["owner_id"] for state in states if not state["deleted"]}
+            fixes = [
+                UpdateOne({"_id": item["_id"]}, {"$set": {"owner_id": owners[item["item_id"]]}})
+                async for item in db.items.find({"item_id": {"$in": list(owners)}}, {"item_id": 1, "owner_id": 1})
+                if item.get("owner_id") != owners[item["item_id"]]
+            ]
+            stats["owner_mismatches"] += len(fixes)
+            if fixes and apply_to_items:
+                await db.items.bulk_write(fixes, ordered=False)
+                stats["owners_fixed"] += len(fixes)
+            states.clear()
+        if snapshots:
+            await db.ownership_snapshots.bulk_write(snapshots, ordered=False)
+            snapshots.clear()
+
+    state = None
+    async for event in db.ownership_events.find({}, {"_id": 0}).sort([("item_id", 1), ("version", 1)]):
+        if state is None or event["item_id"] != state["item_id"]:
+            if state is not None:
+                states.append(state)
+                stats["items"] += 1
+                if len(states) >= batch_size:
+                    await write_batch()
+            state = empty_state(event["item_id"])
+        state = apply(state, event)
+        stats["events"] += 1
+        if event["version"] % snapshot_every == 0:
+            snapshot_id = event_id(state["item_id"], state["version"])
+            snapshots.append(ReplaceOne({"_id": snapshot_id}, {"_id": snapshot_id, **state}, upsert=True))
+            stats["snapshots"] += 1
+    if state is not None:
+        states.append(state)
+        stats["items"] += 1
+    await write_batch()
+    return stats
+
+
+if __name__ == "__main__":
+    import asyncio
+    import json
+    import os
+    import sys
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    commands = {"backfill", "rebuild"}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        raise SystemExit("usage: python ownership.py backfill | rebuild [--apply]")
+    load_dotenv(Path(__file__).parent / ".env")
+    database = AsyncIOMotorClient(os.environ["MONGO_URL"])[os.environ["DB_NAME"]]
+    if sys.argv[1] == "backfill":
+        print(f"Seeded the ownership log for {asyncio.run(backfill(database))} items")
+    else:
+        print(json.dumps(asyncio.run(rebuild(database, apply_to_items="--apply" in sys.argv)), indent=2, default=str))
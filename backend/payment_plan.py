@@ -0,0 +1,167 @@
+"""
+Choosing which items pay for an amount.
+
+A plan covers the amount exactly with the payer's items, splitting as few
+as possible: none if some set of whole items adds up to the amount,
+otherwise exactly one. The owner can exclude items, name items to spend
+first, and name items that may be spent whole but never split.
+
+Whole items are chosen by subset-sum over a reachability table indexed by
+amount: `reach[s]` says whether some items sum to `s`, `parent[s]` which
+item got there first, so a plan is read back by walking parents down from
+the target. Each item is one vectorized NumPy pass over the table, stopping
+as soon as the target is reached. The table is kept small:
+
+- amounts are in cents divided by the GCD of all values and the target,
+  so whole-dollar prices need a table a hundredth the size;
+- items of equal value are one bounded group, entered as powers-of-two
+  bundles (1, 2, 4, ... items), so 500 identical items are 9 passes;
+- only items worth no more than the target take part.
+
+Preferred items go first and larger ones before smaller, so the first
+subset found leans towards them. The split candidate (the most valuable
+splittable item) is left out of the table. If no exact subset exists, the
+table then also answers whether the candidate completes one whole, and
+otherwise gives the largest whole-item total below the target, leaving
+the candidate to cover the rest with the smallest fraction of itself.
+Targets whose table would exceed MAX_CELLS fall back to spending
+largest-first.
+"""
+from math import gcd
+from typing import Iterable, List
+
+import numpy as np
+
+MAX_CELLS = 1 << 21
+
+
+class InsufficientValue(ValueError):
+    pass
+
+
+def to_cents(value: float) -> int:
+    return int(round(value * 100))
+
+
+def _bundles(count: int) -> List[int]:
+    """Split `count` into 1, 2, 4, ... and a remainder; any 0..count is a sum of a subset."""
+    sizes, size = [], 1
+    while count > 0:
+        sizes.append(min(size, count))
+        count -= sizes[-1]
+        size *= 2
+    return sizes
+
+
+def _subset_table(weights: np.ndarray, target: int, stop_at_target: bool = True):
+    """Reachability and first-parent tables over 0..target for the given weights, in order."""
+    reach = np.zeros(target + 1, dtype=bool)
+    reach[0] = True
+    parent = np.full(target + 1, -1, dtype=np.int32)
+    for index, weight in enumerate(weights):
+        if weight > target:
+            continue
+        new = reach[:target + 1 - weight] & ~reach[weight:]
+        if new.any():
+            sums = np.flatnonzero(new) + weight
+            reach[sums] = True
+            parent[sums] = index
+        if stop_at_target and reach[target]:
+            break
+    return reach, parent
+
+
+def _walk(parent: np.ndarray, weights: np.ndarray, total: int) -> List[int]:
+    chosen = []
+    while total > 0:
+        index = int(parent[total])
+        chosen.append(index)
+        total -= int(weights[index])
+    return chosen
+
+
+def plan(items: Iterable[dict], amount: float, prefer: Iterable[str] = (), no_split: Iterable[str] = ()) -> dict:
+    """
+    Items (dicts with item_id and value) to spend on `amount`. Returns
+    {"items": [(item, fraction, cents)], "splits": n}; raises
+    InsufficientValue if everything together isn't enough.
+    """
+    target = to_cents(amount)
+    prefer, no_split = set(prefer), set(no_split)
+    usable = [(item, to_cents(item["value"])) for item in items if to_cents(item["value"]) > 0]
+    if target <= 0:
+        return {"items": [], "splits": 0}
+    if sum(cents for _, cents in usable) < target:
+        raise InsufficientValue("Items are worth less than the amount")
+
+    splittable = [entry for entry in usable if entry[0]["item_id"] not in no_split]
+    candidate = max(splittable, key=lambda entry: (entry[1], entry[0]["item_id"] not in prefer), default=None)
+    whole = [entry for entry in usable if entry is not candidate and entry[1] <= target]
+
+    unit = gcd(target, *(cents for _, cents in whole), *([candidate[1]] if candidate and candidate[1] <= target else []))
+    if target // unit > MAX_CELLS:
+        return _largest_first(usable, target, no_split)
+
+    # Groups of equal value, preferred first, then by value descending
+    groups = {}
+    for item, cents in whole:
+        groups.setdefault((item["item_id"] not in prefer, -cents), []).append(item)
+    members, weights, sizes = [], [], []
+    for key in sorted(groups):
+        for size in _bundles(len(groups[key])):
+            members.append(key)
+            weights.append(-key[1] // unit * size)
+            sizes.append(size)
+    weights = np.array(weights, dtype=np.int64)
+    goal = target // unit
+
+    reach, parent = _subset_table(weights, goal)
+
+    def take(chosen_bundles) -> list:
+        taken, used = [], {}
+        for index in chosen_bundles:
+            key = members[index]
+            start = used.get(key, 0)
+            used[key] = start + sizes[index]
+            taken += [(item, 1.0, -key[1]) for item in groups[key][start:start + sizes[index]]]
+        return taken
+
+    if reach[goal]:
+        return {"items": take(_walk(parent, weights, goal)), "splits": 0}
+
+    if candidate is not None and candidate[1] <= target:
+        # Exact with the candidate whole: it is the one item still missing
+        rest = goal - candidate[1] // unit
+        if rest >= 0 and reach[rest]:
+            return {"items": take(_walk(parent, weights, rest)) + [(candidate[0], 1.0, candidate[1])], "splits": 0}
+
+    if candidate is None:
+        raise InsufficientValue("No whole-item combination matches and every item is marked not to split")
+
+    below = np.flatnonzero(reach[:goal])
+    below = below[below * unit >= target - candidate[1]]
+    if not len(below):
+        return _largest_first(usable, target, no_split)
+    covered = int(below[-1])
+    remainder = target - covered * unit
+    return {
+        "items": take(_walk(parent, weights, covered)) + [(candidate[0], remainder / candidate[1], remainder)],
+        "splits": 1,
+    }
+
+
+def _largest_first(usable: list, target: int, no_split: set) -> dict:
+    """Spend whole items largest first and split the first one that overshoots."""
+    chosen, remaining, splits = [], target, 0
+    for item, cents in sorted(usable, key=lambda entry: -entry[1]):
+        if remaining <= 0:
+            break
+        if cents <= remaining:
+            chosen.append((item, 1.0, cents))
+            remaining -= cents
+        elif item["item_id"] not in no_split:
+            chosen.append((item, remaining / cents, remaining))
+            remaining, splits = 0, 1
+    if remaining > 0:
+        raise InsufficientValue("No combination covers the amount without splitting a protected item")
+    return {"items": chosen, "splits": splits}
@@ -0,0 +1,252 @@
+"""
+On-demand profiling of single requests.
+
+A request carrying `X-Profile: <PROFILE_TOKEN>` (or `?__profile=<token>`)
+is profiled while it runs:
+
+- A sampling thread looks at the event loop every `interval` seconds. If
+  the request's coroutine is executing, the sample is its Python stack
+  ("on-cpu"). If it is suspended, the sample is the chain of awaits it is
+  parked on ("off-cpu"), ending at the future it waits for, which is how
+  time spent waiting on MongoDB shows up. Samples are wall-clock, weighted
+  in microseconds, and other requests running meanwhile are left out.
+  Work the request hands to threads (`asyncio.to_thread`) shows as a wait.
+- tracemalloc records allocations made during the request; the report
+  keeps the top-N lines by size still held at the end, the peak, and
+  allocation stacks. Allocations by concurrent requests are included.
+
+Stacks are written in folded format (`frame;frame;frame count`), which
+flamegraph.pl, speedscope and inferno read directly. Reports are stored in
+the `profiles` collection for PROFILE_RETENTION and the response carries
+`X-Profile-Id` to fetch them with.
+
+Without PROFILE_TOKEN the middleware isn't installed, so unprofiled
+requests cost nothing. With it, they cost one header lookup.
+"""
+import asyncio
+import hmac
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Optional
+from urllib.parse import parse_qs, parse_qsl, urlencode
+
+import metrics
+
+PROFILE_RETENTION = timedelta(days=3)
+HEADER = b"x-profile"
+QUERY_PARAM = "__profile"
+ALLOC_FRAMES = 16
+MAX_STACK_DEPTH = 128
+
+
+def frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def await_chain(awaitable) -> list:
+    """Labels along a suspended coroutine's await chain, outermost first."""
+    labels = []
+    while awaitable is not None and len(labels) < MAX_STACK_DEPTH:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None) \
+            or getattr(awaitable, "ag_frame", None)
+        if frame is None:
+            labels.append(f"[{type(awaitable).__name__}]")
+            break
+        labels.append(frame_label(frame.f_code))
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None) \
+            or getattr(awaitable, "ag_await", None)
+    return labels
+
+
+def running_stack(frame, root_frame) -> Optional[list]:
+    """Labels from `root_frame` down to `frame`, or None if root isn't on this stack."""
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(frame_label(frame.f_code))
+        if frame is root_frame:
+            return labels[::-1]
+        frame = frame.f_back
+    return None
+
+
+class RequestProfiler:
+    """Samples one coroutine from a background thread and tracks its allocations."""
+
+    # Shared by overlapping profiled requests: tracing stops with the last of
+    # them, and only if a profiler (not PYTHONTRACEMALLOC) turned it on
+    _tracing_users = 0
+    _owns_tracing = False
+    _tracing_lock = threading.Lock()
+
+    def __init__(self, interval: float = 0.005, top_n: int = 25):
+        self.interval = interval
+        self.top_n = top_n
+        self.samples = Counter()  # stack -> microseconds
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_snapshot = None
+
+    def start(self, coro):
+        loop_thread = threading.get_ident()
+        self._start_tracemalloc()
+        self._thread = threading.Thread(target=self._sample, args=(coro, loop_thread), daemon=True)
+        self._thread.start()
+
+    def stop(self) -> dict:
+        self._stop.set()
+        self._thread.join()
+        return self._allocation_report()
+
+    def _sample(self, coro, loop_thread: int):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(loop_thread)
+            if coro.cr_frame is None:
+                break
+            # A busy loop holds the GIL for up to the switch interval, so
+            # samples are weighted by the time since the previous one
+            now = time.perf_counter()
+            weight, last = round((now - last) * 1_000_000), now
+            self.sample_count += 1
+            stack = running_stack(frame, coro.cr_frame) if coro.cr_running else None
+            if stack is not None:
+                self.samples[("on-cpu", *stack)] += weight
+            else:
+                self.samples[("off-cpu", *await_chain(coro))] += weight
+
+    # ---- allocations ----
+    def _start_tracemalloc(self):
+        with RequestProfiler._tracing_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(ALLOC_FRAMES)
+                RequestProfiler._owns_tracing = True
+            else:
+                # Someone (another request or PYTHONTRACEMALLOC) is already tracing
+                self._start_snapshot = tracemalloc.take_snapshot()
+            RequestProfiler._tracing_users += 1
+            tracemalloc.reset_peak()
+
+    def _allocation_report(self) -> dict:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        with RequestProfiler._tracing_lock:
+            RequestProfiler._tracing_users -= 1
+            if RequestProfiler._tracing_users == 0 and RequestProfiler._owns_tracing:
+                tracemalloc.stop()
+                RequestProfiler._owns_tracing = False
+
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        snapshot = snapshot.filter_traces(ignore)
+        if self._start_snapshot is not None:
+            by_line = snapshot.compare_to(self._start_snapshot.filter_traces(ignore), "lineno")
+            top = [{"line": str(stat.traceback[0]), "size": stat.size_diff, "count": stat.count_diff}
+                   for stat in by_line if stat.size_diff > 0][:self.top_n]
+        else:
+            top = [{"line": str(stat.traceback[0]), "size": stat.size, "count": stat.count}
+                   for stat in snapshot.statistics("lineno")[:self.top_n]]
+
+        folded = Counter()
+        for stat in snapshot.statistics("traceback"):
+            stack = ";".join(f"{os.path.basename(f.filename)}:{f.lineno}" for f in reversed(stat.traceback))
+            folded[stack] += stat.size
+        return {"top": top, "peak_bytes": peak, "folded": fold(folded)}
+
+
+def fold(counts: Counter) -> str:
+    lines = [f"{';'.join(stack) if isinstance(stack, tuple) else stack} {count}" for stack, count in counts.most_common()]
+    return "\n".join(lines) + ("\n" if lines else "")
+
+
+class ProfileStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("created_at", expireAfterSeconds=int(PROFILE_RETENTION.total_seconds()))
+
+    async def save(self, report: dict):
+        await self.collection.insert_one(report)
+
+    async def get(self, profile_id: str, fields: Optional[dict] = None) -> Optional[dict]:
+        return await self.collection.find_one({"_id": profile_id}, fields)
+
+    async def recent(self, limit: int = 50) -> list:
+        return await self.collection.find(
+            {}, {"cpu_folded": 0, "alloc_folded": 0, "alloc_top": 0}
+        ).sort("created_at", -1).to_list(limit)
+
+
+def token_matches(given: Optional[str], token: str) -> bool:
+    return bool(given) and hmac.compare_digest(given.encode(), token.encode())
+
+
+class ProfilingMiddleware:
+    """Profile requests that present the profiling token; pass everything else straight through."""
+
+    def __init__(self, app, token: str, store: ProfileStore, interval: float = 0.005, top_n: int = 25):
+        self.app = app
+        self.token = token
+        self.store = store
+        self.interval = interval
+        self.top_n = top_n
+
+    def requested(self, scope) -> bool:
+        for name, value in scope.get("headers", []):
+            if name == HEADER:
+                return token_matches(value.decode("latin-1"), self.token)
+        if QUERY_PARAM.encode() in scope.get("query_string", b""):
+            given = parse_qs(scope["query_string"].decode("latin-1")).get(QUERY_PARAM, [None])[0]
+            return token_matches(given, self.token)
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = str(uuid.uuid4())
+        status = None
+
+        async def tagged_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        profiler = RequestProfiler(self.interval, self.top_n)
+        coro = self.app(scope, receive, tagged_send)
+        started = time.perf_counter()
+        profiler.start(coro)
+        try:
+            await coro
+        finally:
+            duration = time.perf_counter() - started
+            allocations = await asyncio.to_thread(profiler.stop)
+            metrics.inc("requests_profiled_total")
+            await self.store.save({
+                "_id": profile_id,
+                "method": scope["method"],
+                "path": scope["path"],
+                "query": urlencode([
+                    (key, value) for key, value in parse_qsl(scope.get("query_string", b"").decode("latin-1"))
+                    if key != QUERY_PARAM
+                ]),
+                "status": status,
+                "duration_ms": round(duration * 1000, 2),
+                "interval_ms": self.interval * 1000,
+                "samples": profiler.sample_count,
+                "cpu_folded": fold(profiler.samples),
+                "alloc_top": allocations["top"],
+                "alloc_peak_bytes": allocations["peak_bytes"],
+                "alloc_folded": allocations["folded"],
+                "created_at": datetime.utcnow(),
+            })
@@ -0,0 +1,137 @@
+"""
+Per-client rate limiting and admission control for expensive endpoints.
+
+RateLimiter keeps one token bucket per (route, client). Buckets live in a
+store: MemoryStore for a single worker, or MongoStore to share them across
+workers and hosts. MongoStore refills and takes tokens in one pipeline
+update, so concurrent requests can't both spend the last token. Any other
+store only has to provide the same `take` coroutine.
+
+Admission wraps a semaphore around calls to a scarce upstream. A request
+that can't get a slot within `max_wait` is turned away instead of queuing
+behind everyone else's.
+
+Both reject with RateLimited: a 429 carrying Retry-After.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Tuple
+
+from pymongo import ReturnDocument
+from starlette.exceptions import HTTPException
+
+import metrics
+
+
+class RateLimited(HTTPException):
+    def __init__(self, retry_after: float, detail: str = "Too many requests"):
+        super().__init__(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+@dataclass(frozen=True)
+class Bucket:
+    rate: float   # tokens refilled per second
+    burst: float  # bucket capacity
+
+    def retry_after(self, tokens: float, cost: float) -> float:
+        return (cost - tokens) / self.rate
+
+
+class MemoryStore:
+    """
+    Buckets in a dict; only correct with a single worker process.
+
+    Bounded LRU: past `max_keys` the least recently used bucket is dropped,
+    so however many keys callers invent, memory and per-call work stay fixed.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, bucket: Bucket, cost: float = 1) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (bucket.burst, now))
+        tokens = min(bucket.burst, tokens + (now - updated) * bucket.rate)
+        granted = tokens >= cost
+        if granted:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return granted, tokens
+
+
+class MongoStore:
+    """Buckets in a collection, shared by every worker using the database."""
+
+    def __init__(self, collection, idle_ttl: timedelta = timedelta(hours=1)):
+        self.collection = collection
+        self.idle_ttl = idle_ttl
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("updated_at", expireAfterSeconds=int(self.idle_ttl.total_seconds()))
+
+    async def take(self, key: str, bucket: Bucket, cost: float = 1) -> Tuple[bool, float]:
+        now = datetime.utcnow()
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        refilled = {"$min": [bucket.burst, {"$add": [
+            {"$ifNull": ["$tokens", bucket.burst]}, {"$multiply": [elapsed, bucket.rate]},
+        ]}]}
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated_at": now}},
+                {"$set": {"granted": {"$gte": ["$tokens", cost]}}},
+                {"$set": {"tokens": {"$cond": ["$granted", {"$subtract": ["$tokens", cost]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return doc["granted"], doc["tokens"]
+
+
+class RateLimiter:
+    def __init__(self, store, buckets: Dict[str, Bucket]):
+        self.store = store
+        self.buckets = buckets
+
+    async def check(self, route: str, client: str, cost: float = 1):
+        """Spend `cost` tokens from the client's bucket for `route`, or raise RateLimited."""
+        bucket = self.buckets[route]
+        granted, tokens = await self.store.take(f"{route}:{client}", bucket, cost)
+        if not granted:
+            metrics.inc("rate_limited_total", route=route)
+            raise RateLimited(bucket.retry_after(tokens, cost))
+
+
+class Admission:
+    """Caps concurrent calls to an upstream; waits at most `max_wait` for a slot."""
+
+    def __init__(self, name: str, max_concurrent: int, max_wait: float):
+        self.name = name
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    @asynccontextmanager
+    async def slot(self):
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            metrics.inc("admission_rejected_total", upstream=self.name)
+            raise RateLimited(self.max_wait, detail=f"{self.name} is busy, try again shortly")
+        metrics.observe("admission_wait_seconds", time.perf_counter() - started, upstream=self.name)
+        try:
+            yield
+        finally:
+            self._semaphore.release()
@@ -0,0 +1,166 @@
+"""
+Real-time push of trades and transactions to connected clients.
+
+A single EventHub per worker watches the `trades` and `transactions`
+collections through a MongoDB change stream and fans each new or updated
+document out to the subscribers of the users it involves. Change streams
+need a replica set; on a standalone mongod the hub falls back to polling
+both collections, and only while someone is subscribed.
+
+Polling reads by the change tracking stamps (see changes.py) rather than
+creation time, so updates are pushed as well as inserts. Sequence numbers
+are reserved before the write commits, so a document can land with a lower
+`change_seq` than one already seen; each poll therefore also re-reads
+whatever was updated within SETTLE_WINDOW and skips (_id, change_seq) pairs
+it has already published.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from changes import SETTLE_WINDOW
+
+logger = logging.getLogger(__name__)
+
+WATCHED_COLLECTIONS = ("trades", "transactions")
+
+# Server error codes meaning "change streams are not available here"
+CHANGE_STREAMS_UNSUPPORTED = {40573, 40324}
+
+
+def parties(collection: str, doc: dict) -> set:
+    """User ids that should be told about a document."""
+    if collection == "trades":
+        return {doc.get("payer_id"), doc.get("payee_id")} - {None}
+    return {doc.get("user_id")} - {None}
+
+
+class EventHub:
+    def __init__(self, db, poll_interval: float = 0.5, queue_size: int = 100):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.mode = "stopped"
+        self._subscribers = defaultdict(set)
+        self._has_subscribers = asyncio.Event()
+        self._task = None
+
+    # ---- subscriptions ----
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers[user_id].add(queue)
+        self._has_subscribers.set()
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+        if not self._subscribers:
+            self._has_subscribers.clear()
+
+    def publish(self, collection: str, doc: dict):
+        for user_id in parties(collection, doc):
+            for queue in self._subscribers.get(user_id, ()):
+                if queue.full():
+                    # Slow consumer: drop the oldest event rather than block the hub
+                    queue.get_nowait()
+                queue.put_nowait((collection, doc))
+
+    # ---- lifecycle ----
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.mode = "stopped"
+
+    async def _run(self):
+        resume_token = None
+        while True:
+            try:
+                resume_token = await self._watch(resume_token)
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAMS_UNSUPPORTED:
+                    logger.info("Change streams unavailable, falling back to polling for real-time events")
+                    await self._poll()
+                    return
+                logger.warning(f"Change stream failed, restarting: {e}")
+                resume_token = None
+                await asyncio.sleep(1)
+            except PyMongoError as e:
+                logger.warning(f"Change stream interrupted, resuming: {e}")
+                await asyncio.sleep(1)
+
+    async def _watch(self, resume_token):
+        pipeline = [{"$match": {
+            "operationType": {"$in": ["insert", "update", "replace"]},
+            "ns.coll": {"$in": list(WATCHED_COLLECTIONS)},
+        }}]
+        async with self.db.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+            self.mode = "change_stream"
+            async for change in stream:
+                resume_token = stream.resume_token
+                doc = change.get("fullDocument")
+                if doc is not None:
+                    self.publish(change["ns"]["coll"], doc)
+        return resume_token
+
+    async def _poll(self):
+        self.mode = "polling"
+        last_seq, seen = await self._poll_marks()
+
+        while True:
+            if not self._has_subscribers.is_set():
+                await self._has_subscribers.wait()
+                # Nobody was listening; don't replay what happened meanwhile
+                last_seq, seen = await self._poll_marks()
+
+            polled_at = datetime.utcnow()
+            for name in WATCHED_COLLECTIONS:
+                try:
+                    docs = await self.db[name].find({"$or": [
+                        {"change_seq": {"$gt": last_seq[name]}},
+                        {"updated_at": {"$gte": polled_at - SETTLE_WINDOW}},
+                    ]}).sort("change_seq", 1).to_list(500)
+                except PyMongoError as e:
+                    logger.warning(f"Polling {name} failed: {e}")
+                    continue
+
+                for doc in docs:
+                    key = (doc["_id"], doc.get("change_seq"))
+                    if key in seen[name]:
+                        continue
+                    seen[name][key] = doc.get("updated_at") or polled_at
+                    last_seq[name] = max(last_seq[name], doc.get("change_seq") or 0)
+                    self.publish(name, doc)
+
+                # Anything older than the settle window can't be re-read
+                horizon = polled_at - 2 * SETTLE_WINDOW
+                seen[name] = {key: at for key, at in seen[name].items() if at >= horizon}
+
+            await asyncio.sleep(self.poll_interval)
+
+    async def _poll_marks(self):
+        """Start polling from now: current sequence and what the window already holds."""
+        counter = await self.db.counters.find_one({"_id": "change_seq"})
+        start = counter["seq"] if counter else 0
+        last_seq = {name: start for name in WATCHED_COLLECTIONS}
+        seen = {name: {} for name in WATCHED_COLLECTIONS}
+        cutoff = datetime.utcnow() - SETTLE_WINDOW
+        for name in WATCHED_COLLECTIONS:
+            async for doc in self.db[name].find({"updated_at": {"$gte": cutoff}}, {"change_seq": 1, "updated_at": 1}):
+                seen[name][(doc["_id"], doc.get("change_seq"))] = doc["updated_at"]
+        return last_seq, seen
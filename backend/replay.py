@@ -0,0 +1,246 @@
+"""
+Replay captured traffic (see capture.py) against a server.
+
+    python replay.py run captures/ --target http://127.0.0.1:8001 --speedup 4 --concurrency 32
+    python replay.py run captures/ --read-only --diff-out diffs.ndjson
+    python replay.py summary captures/
+
+Requests are sent at their captured offsets divided by `--speedup`, through
+a pool of `--concurrency` connections, so the replayed mix keeps the
+shape of the original: bursts, the share of item, trade and sync calls,
+and repeated conditional GETs. Each response is compared with the
+captured one. Statuses must match. JSON bodies are compared after masking
+what can't be expected to match: generated ids, times, change tokens and
+anything scrubbed at capture. The report gives, per route, the counts,
+mismatches and captured versus replayed latency percentiles.
+
+Writes are replayed too, so point it at a scratch database seeded to
+resemble production, or pass `--read-only`.
+"""
+import base64
+import io
+import json
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import requests
+import typer
+
+from benchmarks import percentile
+from capture import PERSONAL_KEYS, PHOTO_KEYS, PHOTO_MARKER, SECRET_KEYS
+
+cli = typer.Typer(help="Replay captured API traffic")
+
+ID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.I)
+TIME_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}")
+VOLATILE_KEYS = {"change_seq", "token", "next_cursor", "etag", "duration_ms"}
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+def load(paths: List[Path]) -> list:
+    """Captured records from files or directories, in capture order."""
+    files = []
+    for path in paths:
+        files.extend(sorted(path.glob("*.ndjson")) if path.is_dir() else [path])
+    records = []
+    for file in files:
+        with open(file, encoding="utf-8") as lines:
+            records.extend(json.loads(line) for line in lines if line.strip())
+    records.sort(key=lambda record: record["at"])
+    return records
+
+
+def route(record: dict) -> str:
+    """Method and path with ids collapsed, so /items/<uuid> calls group together."""
+    path = ID_PATTERN.sub("{id}", record["path"])
+    path = re.sub(r"/anon-[0-9a-f]+", "/{name}", path)
+    return f"{record['method']} {path}"
+
+
+def photo_placeholder(size: int = 64) -> str:
+    """A small JPEG standing in for scrubbed photos, so endpoints that decode them still work."""
+    try:
+        from PIL import Image
+    except ImportError:  # optional
+        return ""
+    buffer = io.BytesIO()
+    Image.new("RGB", (size, size), (128, 96, 64)).save(buffer, "JPEG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def restore_photos(doc, photo: str):
+    if isinstance(doc, dict):
+        return {
+            key: photo if key in PHOTO_KEYS and isinstance(value, str) and value.startswith(PHOTO_MARKER)
+            else restore_photos(value, photo)
+            for key, value in doc.items()
+        }
+    if isinstance(doc, list):
+        return [restore_photos(value, photo) for value in doc]
+    return doc
+
+
+def request_body(record: dict, photo: str) -> Optional[bytes]:
+    """The body to send, or None if the capture can't be replayed faithfully."""
+    body = record["request_body"]
+    if "json" in body:
+        return json.dumps(restore_photos(body["json"], photo)).encode()
+    if "ndjson" in body:
+        return "".join(json.dumps(restore_photos(line, photo)) + "\n" for line in body["ndjson"]).encode()
+    if body.get("empty"):
+        return b""
+    return None
+
+
+def mask(doc, key: Optional[str] = None):
+    """Replace what legitimately differs between two runs with placeholders."""
+    if isinstance(doc, dict):
+        return {k: mask(v, k) for k, v in doc.items() if k not in VOLATILE_KEYS}
+    if isinstance(doc, list):
+        return [mask(v, key) for v in doc]
+    if key in SECRET_KEYS or key in PERSONAL_KEYS or key in PHOTO_KEYS:
+        return "<scrubbed>"
+    if isinstance(doc, str):
+        if TIME_PATTERN.match(doc):
+            return "<time>"
+        return ID_PATTERN.sub("<id>", doc)
+    return doc
+
+
+def compare(record: dict, status: int, body: bytes) -> Optional[str]:
+    """None if the replayed response matches the capture, otherwise why not."""
+    if status != record["status"]:
+        return f"status {record['status']} -> {status}"
+    captured = record["response_body"]
+    if "json" not in captured:
+        return None
+    try:
+        replayed = json.loads(body)
+    except ValueError:
+        return "body is no longer JSON"
+    if mask(captured["json"]) != mask(replayed):
+        return "body differs"
+    return None
+
+
+def replay(records: list, target: str, speedup: float, concurrency: int, timeout: float,
+           diff_out: Optional[Path] = None) -> dict:
+    photo = photo_placeholder()
+    sessions = threading.local()
+    lock = threading.Lock()
+    stats = defaultdict(lambda: {"count": 0, "errors": 0, "mismatches": 0, "captured": [], "replayed": []})
+    late = []
+    diffs = open(diff_out, "w", encoding="utf-8") if diff_out else None
+
+    def send(record: dict, body: bytes):
+        session = getattr(sessions, "session", None) or requests.Session()
+        sessions.session = session
+        url = target.rstrip("/") + record["path"] + (f"?{record['query']}" if record["query"] else "")
+        started = time.perf_counter()
+        try:
+            response = session.request(record["method"], url, data=body or None,
+                                        headers=record["request_headers"], timeout=timeout)
+        except requests.RequestException as e:
+            problem, elapsed, content, status = f"error: {e}", None, b"", None
+        else:
+            elapsed = time.perf_counter() - started
+            content, status = response.content, response.status_code
+            problem = compare(record, status, content)
+        with lock:
+            stat = stats[route(record)]
+            stat["count"] += 1
+            stat["captured"].append(record["duration_ms"] / 1000)
+            if elapsed is None:
+                stat["errors"] += 1
+            else:
+                stat["replayed"].append(elapsed)
+            if problem:
+                stat["mismatches"] += 1
+                if diffs:
+                    diffs.write(json.dumps({
+                        "id": record["id"], "route": route(record), "problem": problem,
+                        "captured": record["response_body"],
+                        "replayed": content[:4096].decode("utf-8", "replace"), "status": status,
+                    }) + "\n")
+
+    start = time.perf_counter()
+    first = records[0]["at"] if records else 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record in records:
+            body = request_body(record, photo)
+            if body is None:
+                continue
+            due = (record["at"] - first) / speedup
+            wait = due - (time.perf_counter() - start)
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                late.append(-wait)
+            pool.submit(send, record, body)
+    if diffs:
+        diffs.close()
+
+    def summarize(stat):
+        return {
+            "count": stat["count"],
+            "errors": stat["errors"],
+            "mismatches": stat["mismatches"],
+            "captured_p50_ms": round(percentile(stat["captured"], 50) * 1000, 2),
+            "replayed_p50_ms": round(percentile(stat["replayed"], 50) * 1000, 2),
+            "captured_p99_ms": round(percentile(stat["captured"], 99) * 1000, 2),
+            "replayed_p99_ms": round(percentile(stat["replayed"], 99) * 1000, 2),
+        }
+
+    routes = {name: summarize(stat) for name, stat in sorted(stats.items(), key=lambda kv: -kv[1]["count"])}
+    return {
+        "requests": sum(r["count"] for r in routes.values()),
+        "mismatches": sum(r["mismatches"] for r in routes.values()),
+        "errors": sum(r["errors"] for r in routes.values()),
+        "wall_seconds": round(time.perf_counter() - start, 2),
+        # Sends that left later than scheduled: the pool was saturated
+        "late_sends": len([lag for lag in late if lag > 0.01]),
+        "routes": routes,
+    }
+
+
+@cli.command()
+def run(
+    paths: List[Path],
+    target: str = typer.Option("http://127.0.0.1:8001", help="Server to replay against"),
+    speedup: float = typer.Option(1.0, help="Divide captured gaps between requests by this"),
+    concurrency: int = typer.Option(16, help="Requests in flight at most"),
+    timeout: float = 30.0,
+    read_only: bool = typer.Option(False, help="Skip anything that isn't a GET"),
+    only: Optional[str] = typer.Option(None, help="Replay only paths starting with this"),
+    limit: Optional[int] = None,
+    diff_out: Optional[Path] = typer.Option(None, help="Write each mismatch as an NDJSON line here"),
+):
+    """Re-drive captured requests and diff responses and latencies."""
+    records = [
+        record for record in load(paths)
+        if (not read_only or record["method"] in READ_METHODS) and (not only or record["path"].startswith(only))
+    ][:limit]
+    print(json.dumps(replay(records, target, speedup, concurrency, timeout, diff_out), indent=2))
+
+
+@cli.command()
+def summary(paths: List[Path]):
+    """Count captured requests per route and the time span they cover."""
+    records = load(paths)
+    counts = defaultdict(int)
+    for record in records:
+        counts[route(record)] += 1
+    print(json.dumps({
+        "requests": len(records),
+        "seconds": round(records[-1]["at"] - records[0]["at"], 1) if records else 0,
+        "routes": dict(sorted(counts.items(), key=lambda kv: -kv[1])),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    cli()
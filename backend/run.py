@@ -0,0 +1,70 @@
+"""
+Production entry point.
+
+Runs the API under uvicorn with one worker process per CPU (override with
+WEB_CONCURRENCY or --workers), using uvloop and httptools when they are
+installed. On SIGTERM uvicorn stops accepting connections, lets in-flight
+requests finish for up to --graceful-timeout seconds, and the app's shutdown
+hook then drains any trade syncs still being applied before closing Mongo.
+X-Forwarded-For is honoured only from FORWARDED_ALLOW_IPS (default
+127.0.0.1); list the load balancer's addresses there when behind one.
+
+    python run.py --workers 4 --port 8002
+"""
+import importlib.util
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+import typer
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+
+def has_module(name: str) -> bool:
+    return importlib.util.find_spec(name) is not None
+
+
+def main(
+    host: str = typer.Option("0.0.0.0", envvar="HOST"),
+    port: int = typer.Option(8002, envvar="PORT"),
+    workers: Optional[int] = typer.Option(None, envvar="WEB_CONCURRENCY", help="Defaults to the CPU count"),
+    graceful_timeout: int = typer.Option(30, envvar="GRACEFUL_SHUTDOWN_SECONDS"),
+    keep_alive: int = typer.Option(5, envvar="KEEP_ALIVE_SECONDS"),
+    log_level: str = typer.Option("info", envvar="LOG_LEVEL"),
+    forwarded_allow_ips: str = typer.Option(
+        "127.0.0.1", envvar="FORWARDED_ALLOW_IPS",
+        help="Comma-separated proxy addresses whose X-Forwarded-For is trusted",
+    ),
+):
+    workers = workers or os.cpu_count() or 1
+    loop = "uvloop" if has_module("uvloop") else "asyncio"
+    http = "httptools" if has_module("httptools") else "h11"
+
+    logging.basicConfig(
+        level=log_level.upper(),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    logger.info(f"Starting {workers} worker(s) on {host}:{port} (loop={loop}, http={http})")
+
+    uvicorn.run(
+        "server:app",
+        app_dir=str(Path(__file__).parent),
+        host=host,
+        port=port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        timeout_graceful_shutdown=graceful_timeout,
+        timeout_keep_alive=keep_alive,
+        proxy_headers=True,
+        # Only these peers may set the client address, which keys rate limits and logs
+        forwarded_allow_ips=forwarded_allow_ips,
+        log_level=log_level,
+    )
+
+
+if __name__ == "__main__":
+    typer.run(main)
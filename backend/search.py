@@ -0,0 +1,162 @@
+"""
+Faceted item search behind /api/search/items.
+
+Free text goes through the `items` text index over brand, subcategory and
+the AI-written name and description, weighted towards brand and
+subcategory. Category, condition and value range are plain filters.
+Values are stored as Decimal128 (see money.py), and MongoDB compares that
+exactly with doubles, so Decimal128("19.99") is not 19.99. Value bounds and
+value cursors go through `money.decimal()` so they equal what's stored.
+
+A page of results is its own aggregation, sorted on (sort field, item_id)
+and paged by keyset: the cursor carries the last row's sort value and
+item_id, so page 50 costs the same as page 1 and rows written meanwhile
+don't shift the page boundaries.
+
+Facet counts come from one `$facet` aggregation. They are disjunctive:
+each facet counts matches under every filter except its own, so picking
+"shoes" still shows how many items the other categories would give. That
+means the facet stage sees everything the text query (if any) matched,
+which for an unfiltered 1M-item catalogue is a full pass, so facets are
+only computed for the first page and are cached briefly by the caller.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+
+import money
+
+TEXT_INDEX = "item_search"
+TEXT_FIELDS = {"brand": 5, "subcategory": 5, "name": 3, "description": 1}
+
+# sort name -> (field, direction); item_id breaks ties in the same direction
+SORTS = {
+    "relevance": ("score", -1),
+    "newest": ("created_at", -1),
+    "value_asc": ("value", 1),
+    "value_desc": ("value", -1),
+}
+
+VALUE_BUCKETS = [0, 25, 50, 100, 250, 500, 1000]
+BRAND_FACET_SIZE = 20
+
+
+def text_index_spec() -> Tuple[list, dict]:
+    """Keys and options for the single text index `items` may have."""
+    return [(field, "text") for field in TEXT_FIELDS], {"name": TEXT_INDEX, "weights": TEXT_FIELDS}
+
+
+def encode_cursor(sort: str, value, item_id: str) -> str:
+    if isinstance(value, datetime):
+        value = {"t": value.isoformat()}
+    raw = json.dumps([sort, value, item_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str) -> Tuple[object, str]:
+    """Raises ValueError for anything that isn't a cursor we issued for `sort`."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, item_id = json.loads(raw)
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value["t"])
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+        raise ValueError("malformed cursor")
+    if cursor_sort != sort or not isinstance(item_id, str):
+        raise ValueError("cursor belongs to a different sort")
+    return value, item_id
+
+
+def filters(category: Optional[str] = None, condition: Optional[str] = None,
+            min_value: Optional[float] = None, max_value: Optional[float] = None) -> dict:
+    """Filter clauses by facet name, so a facet can leave its own out."""
+    clauses = {}
+    if category:
+        clauses["category"] = {"category": category}
+    if condition:
+        clauses["condition"] = {"condition": condition}
+    bounds = {}
+    if min_value is not None:
+        bounds["$gte"] = money.decimal(min_value)
+    if max_value is not None:
+        bounds["$lte"] = money.decimal(max_value)
+    if bounds:
+        clauses["value"] = {"value": bounds}
+    return clauses
+
+
+def _all_but(clauses: dict, facet: Optional[str] = None) -> dict:
+    parts = [clause for name, clause in clauses.items() if name != facet]
+    return {"$and": parts} if len(parts) > 1 else (parts[0] if parts else {})
+
+
+def _text_match(q: Optional[str]) -> dict:
+    return {"$text": {"$search": q}} if q else {}
+
+
+def results_pipeline(q: Optional[str], clauses: dict, sort: str, limit: int,
+                     after: Optional[Tuple[object, str]] = None) -> list:
+    """One page of matching items; fetches `limit + 1` so the caller can tell if there's more."""
+    field, direction = SORTS[sort]
+    pipeline = [{"$match": {**_text_match(q), **_all_but(clauses)}}]
+    if sort == "relevance":
+        pipeline.append({"$set": {"score": {"$meta": "textScore"}}})
+    if after is not None:
+        value, item_id = after
+        if field == "value":
+            # The cursor holds the float the row was read back as
+            value = money.decimal(value)
+        op = "$gt" if direction > 0 else "$lt"
+        pipeline.append({"$match": {"$or": [
+            {field: {op: value}},
+            {field: value, "item_id": {op: item_id}},
+        ]}})
+    pipeline += [
+        {"$sort": {field: direction, "item_id": direction}},
+        {"$limit": limit + 1},
+        # Search results never need the matching internals
+        {"$project": {"_id": 0, "photo_hash": 0, "photo_hash_chunks": 0, "visual_descriptor": 0}},
+    ]
+    return pipeline
+
+
+def _count_by(field: str) -> list:
+    return [
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1, "_id": 1}},
+    ]
+
+
+def facet_pipeline(q: Optional[str], clauses: dict) -> list:
+    """Counts per category, condition, brand and value bucket, plus the total."""
+    return [
+        {"$match": _text_match(q)},
+        {"$facet": {
+            "category": [{"$match": _all_but(clauses, "category")}, *_count_by("category")],
+            "condition": [{"$match": _all_but(clauses, "condition")}, *_count_by("condition")],
+            "brand": [{"$match": _all_but(clauses)}, *_count_by("brand"), {"$limit": BRAND_FACET_SIZE}],
+            "value": [
+                {"$match": _all_but(clauses, "value")},
+                {"$bucket": {"groupBy": "$value", "boundaries": VALUE_BUCKETS, "default": "other"}},
+            ],
+            "total": [{"$match": _all_but(clauses)}, {"$count": "count"}],
+        }},
+    ]
+
+
+def shape_facets(row: dict) -> dict:
+    """Turn the `$facet` output into {facet: [{value, count}]} plus a total."""
+    upper = dict(zip(VALUE_BUCKETS, VALUE_BUCKETS[1:]))
+    return {
+        "category": [{"value": b["_id"], "count": b["count"]} for b in row.get("category", [])],
+        "condition": [{"value": b["_id"], "count": b["count"]} for b in row.get("condition", [])],
+        "brand": [{"value": b["_id"], "count": b["count"]} for b in row.get("brand", [])],
+        "value": [
+            {"min": b["_id"], "max": upper.get(b["_id"]), "count": b["count"]}
+            if b["_id"] != "other" else {"min": VALUE_BUCKETS[-1], "max": None, "count": b["count"]}
+            for b in row.get("value", [])
+        ],
+        "total": row["total"][0]["count"] if row.get("total") else 0,
+    }
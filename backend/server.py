@@ -1,15 +1,50 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import ClientDisconnect
 from motor.motor_asyncio import AsyncIOMotorClient
+from middleware import BodySizeLimitMiddleware, CompressionMiddleware
+from profiling import ProfileStore, ProfilingMiddleware, token_matches
+from capture import CaptureMiddleware, RollingWriter, Scrubber
+import metrics
+import auth
+import money
+from valuations import mock_value
+import tag_codec
+import bulk
+import analytics
+import deposit_analysis
+import search
+import ownership
+import payment_plan
+import trade_parties
+from slow_queries import SlowQueryListener, SlowQueryMonitor, report_query
+import netting
+import image_hash
+import visual_search
+from archive import ArchiveMover, archive_name
+from jobs import FINISHED as JOB_FINISHED, JobQueue, PermanentJobError, public_view
+from ratelimit import Admission, Bucket, MemoryStore, MongoStore, RateLimiter
+from realtime import EventHub
+from changes import (
+    next_change_seq, stamp, record_tombstones, clear_tombstones, mark_changed,
+    current_etag, etag_matches, format_token, parse_token, since_filter,
+    backfill_change_seq,
+)
+import asyncio
 import os
+import time
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from typing import List, Optional
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
+import base64
+import json
+from urllib.parse import urlparse
 
 
 ROOT_DIR = Path(__file__).parent
@@ -17,7 +52,18 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# Commands slower than SLOW_QUERY_MS are recorded by shape; 0 turns capture off
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+slow_query_listener = SlowQueryListener(
+    threshold_ms=SLOW_QUERY_MS,
+    sample_rate=float(os.environ.get("SLOW_QUERY_EXPLAIN_SAMPLE", 0.1)),
+)
+# Money is stored as Decimal128 and read back as float (see money.py)
+client = AsyncIOMotorClient(
+    mongo_url,
+    type_registry=money.TYPE_REGISTRY,
+    event_listeners=[slow_query_listener] if SLOW_QUERY_MS else [],
+)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
@@ -28,10 +74,10 @@ api_router = APIRouter(prefix="/api")
 
 
 # ============ User Models ============
-class User(BaseModel):
+class PublicUser(BaseModel):
+    """A user as the API returns it: everything but the PIN hash."""
     user_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     username: str
-    pin_hash: str  # Hashed PIN
     created_at: datetime = Field(default_factory=datetime.utcnow)
     biometric_enabled: bool = False
     balance: float = 0.0  # Current account balance
@@ -47,6 +93,9 @@ class User(BaseModel):
     zip_code: Optional[str] = None
     country: Optional[str] = None
 
+class User(PublicUser):
+    pin_hash: str  # Hashed PIN
+
 class UserCreate(BaseModel):
     username: str
     pin_hash: str
@@ -65,6 +114,21 @@ class UserLogin(BaseModel):
     username: str
     pin_hash: str
 
+class LoginResponse(BaseModel):
+    access_token: str
+    refresh_token: str
+    token_type: str = "bearer"
+    expires_in: int
+    user: PublicUser
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class Session(BaseModel):
+    user_id: str
+    username: str
+    expires_at: datetime
+
 class PersonalInfoUpdate(BaseModel):
     first_name: Optional[str] = None
     last_name: Optional[str] = None
@@ -88,9 +152,12 @@ class Item(BaseModel):
     condition: str
     photo: str  # base64 encoded
     value: float
+    name: str = ""  # from AI deposit analysis
+    description: str = ""
     is_fractional: bool = False
     share_percentage: float = 1.0  # 1.0 = 100%
     parent_item_id: Optional[str] = None
+    possible_duplicate_of: List[str] = []  # items whose photo is a near match
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -102,6 +169,8 @@ class ItemCreate(BaseModel):
     condition: str
     photo: str
     value: float
+    name: str = ""
+    description: str = ""
 
 class ItemUpdate(BaseModel):
     share_percentage: Optional[float] = None
@@ -119,6 +188,7 @@ class DepositAnalysisResponse(BaseModel):
     brand: str
     estimated_value: float
     condition: str = "good"
+    possible_duplicates: List[str] = []
 
 
 # ============ Transaction Models ============
@@ -192,8 +262,111 @@ class TradeCreate(BaseModel):
     payee_signature: str
 
 
+# ============ Graceful Drain ============
+class SyncDrain:
+    """
+    Tracks in-flight trade syncs so shutdown can wait for them to finish.
+
+    uvicorn has already stopped accepting connections by the time the
+    shutdown hook runs, so no new syncs can arrive while draining; the only
+    work left is batches whose client went away mid-request.
+    """
+
+    def __init__(self):
+        self._tasks = set()
+
+    def run(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return asyncio.shield(task)
+
+    async def drain(self, timeout: float):
+        if not self._tasks:
+            return
+        logger.info(f"Draining {len(self._tasks)} in-flight trade syncs...")
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            logger.warning(f"{len(pending)} trade syncs still running after {timeout}s drain timeout")
+
+sync_drain = SyncDrain()
+
+
+# ============ Conditional GET ============
+async def not_modified(request: Request, response: Response, user_id: str, *collections: str) -> Optional[Response]:
+    """
+    Tag a per-user resource with its ETag, or return a 304 if the client's
+    copy is current. Only reads version marks, never the documents.
+    """
+    etag = await current_etag(db, user_id, collections)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+# ============ NFC Tag Models ============
+class TagPayloadResponse(BaseModel):
+    item_id: str
+    payload: str  # base64 encoded binary tag payload
+    size: int
+    version: int = tag_codec.VERSION
+
+class TagPayloadBulkRequest(BaseModel):
+    item_ids: List[str]
+
+class TagDecodeRequest(BaseModel):
+    payload: str  # base64 encoded binary tag payload
+
+class DecodedTag(BaseModel):
+    item_id: str
+    owner_id: str
+    category: str
+    subcategory: str
+    brand: Optional[str] = None
+    condition: Optional[str] = None
+    value: float
+    is_fractional: bool
+    share_percentage: float
+    parent_item_id: Optional[str] = None
+    timestamp: datetime
+    signature_valid: bool
+
+class TagVerifyRequest(BaseModel):
+    payloads: List[str]  # base64 encoded tag payloads as scanned
+    expected_owner_id: Optional[str] = None  # who is presenting the items
+    max_age_seconds: Optional[int] = None
+
+class TagVerdict(BaseModel):
+    index: int
+    item_id: Optional[str] = None
+    valid: bool
+    reason: Optional[str] = None  # malformed, bad_signature, duplicate, not_found, owner_mismatch, share_mismatch, stale, expired
+    owner_id: Optional[str] = None
+    value: Optional[float] = None
+    share_percentage: Optional[float] = None
+
+class TagVerifyResponse(BaseModel):
+    verdicts: List[TagVerdict]
+    all_valid: bool
+    total_value: float
+
+
 # ============ User Endpoints ============
-@api_router.post("/users/register", response_model=User)
+token_issuer = auth.TokenIssuer(
+    auth.parse_keys(os.environ.get("AUTH_SIGNING_KEYS")),
+    access_ttl=int(os.environ.get("AUTH_ACCESS_TTL_SECONDS", 900)),
+    refresh_ttl=int(os.environ.get("AUTH_REFRESH_TTL_SECONDS", 30 * 86400)),
+)
+PIN_HASH_ROUNDS = int(os.environ.get("PIN_HASH_ROUNDS", 12))
+
+def session_claims(request: Request) -> Optional[dict]:
+    """Verified access-token claims, None without a token; raises 401 on a bad one."""
+    token = auth.bearer(request.headers.get("authorization"))
+    return token_issuer.verify(token) if token else None
+
+@api_router.post("/users/register", response_model=PublicUser)
 async def register_user(user: UserCreate):
     # Check if username exists
     existing = await db.users.find_one({"username": user.username})
@@ -201,39 +374,67 @@ async def register_user(user: UserCreate):
         raise HTTPException(status_code=400, detail="Username already exists")
 
     user_obj = User(**user.model_dump())
-    await db.users.insert_one(user_obj.model_dump())
-    return user_obj
+    user_obj.pin_hash = await auth.hash_pin(user.pin_hash, PIN_HASH_ROUNDS)
+    await db.users.insert_one(money.encode("users", user_obj.model_dump()))
+    await mark_changed(db, "users", [user_obj.user_id], await next_change_seq(db))
+    return PublicUser(**user_obj.model_dump())
 
-@api_router.post("/users/login")
+@api_router.post("/users/login", response_model=LoginResponse)
 async def login_user(credentials: UserLogin):
-    user = await db.users.find_one({
-        "username": credentials.username,
-        "pin_hash": credentials.pin_hash
-    })
+    user = await db.users.find_one({"username": credentials.username})
+    if not user or not await auth.check_pin(user["pin_hash"], credentials.pin_hash):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
 
+    if auth.needs_upgrade(user["pin_hash"]):
+        # Accounts from before bcrypt hold the client hash as-is; rehash it now we've seen it
+        hashed = await auth.hash_pin(credentials.pin_hash, PIN_HASH_ROUNDS)
+        await db.users.update_one({"user_id": user["user_id"], "pin_hash": user["pin_hash"]},
+                                  {"$set": {"pin_hash": hashed}})
+        user["pin_hash"] = hashed
+        metrics.inc("pin_hash_upgrades_total")
+
+    return LoginResponse(**token_issuer.pair(user), user=PublicUser(**user))
+
+@api_router.post("/auth/refresh", response_model=LoginResponse)
+async def refresh_session(body: RefreshRequest):
+    """Trade a refresh token for a new pair; the one read that checks the user still exists."""
+    claims = token_issuer.verify(body.refresh_token, auth.REFRESH)
+    user = await db.users.find_one({"user_id": claims["sub"]})
     if not user:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
+        raise auth.InvalidToken("User no longer exists")
+    return LoginResponse(**token_issuer.pair(user), user=PublicUser(**user))
 
-    return User(**user)
+@api_router.get("/auth/session", response_model=Session)
+async def get_session(request: Request):
+    """Who the bearer token belongs to, from its claims alone."""
+    claims = session_claims(request)
+    if not claims:
+        raise auth.InvalidToken("Missing bearer token")
+    return Session(user_id=claims["sub"], username=claims["username"],
+                   expires_at=datetime.utcfromtimestamp(claims["exp"]))
 
 
-@api_router.get("/users/by-username/{username}", response_model=User)
+@api_router.get("/users/by-username/{username}", response_model=PublicUser)
 async def get_user_by_username(username: str):
     user = await db.users.find_one({
         "username": {"$regex": f"^{re.escape(username)}$", "$options": "i"}
     })
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return User(**user)
+    return PublicUser(**user)
+
+@api_router.get("/users/{user_id}", response_model=PublicUser)
+async def get_user(user_id: str, request: Request, response: Response):
+    cached = await not_modified(request, response, user_id, "users")
+    if cached:
+        return cached
 
-@api_router.get("/users/{user_id}", response_model=User)
-async def get_user(user_id: str):
     user = await db.users.find_one({"user_id": user_id})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return User(**user)
+    return PublicUser(**user)
 
-@api_router.put("/users/{user_id}/personal-info", response_model=User)
+@api_router.put("/users/{user_id}/personal-info", response_model=PublicUser)
 async def update_personal_info(user_id: str, personal_info: PersonalInfoUpdate):
     # Check if user exists
     user = await db.users.find_one({"user_id": user_id})
@@ -251,15 +452,40 @@ async def update_personal_info(user_id: str, personal_info: PersonalInfoUpdate):
         {"user_id": user_id},
         {"$set": update_data}
     )
+    await mark_changed(db, "users", [user_id], await next_change_seq(db))
 
     # Return updated user
     updated_user = await db.users.find_one({"user_id": user_id})
-    return User(**updated_user)
+    return PublicUser(**updated_user)
+
+
+# ============ Rate Limiting ============
+MAX_SYNC_TRADES = int(os.environ.get("MAX_SYNC_TRADES", 200))
+
+rate_limit_store = MongoStore(db.rate_limits) if os.environ.get("RATE_LIMIT_STORE") == "mongo" else MemoryStore()
+rate_limiter = RateLimiter(rate_limit_store, {
+    # Vision calls are slow and billed; a handful per minute covers real use
+    "analyze-deposit": Bucket(rate=float(os.environ.get("ANALYZE_PER_MINUTE", 6)) / 60, burst=3),
+    # Cost is per trade in the batch, so a burst of small syncs and one large one weigh the same
+    "trades-sync": Bucket(rate=float(os.environ.get("SYNC_TRADES_PER_MINUTE", 120)) / 60, burst=MAX_SYNC_TRADES),
+})
+ai_admission = Admission(
+    "AI analysis",
+    max_concurrent=int(os.environ.get("AI_MAX_CONCURRENT", 8)),
+    max_wait=float(os.environ.get("AI_MAX_WAIT_SECONDS", 5)),
+)
+
+def client_key(request: Request) -> str:
+    """Who a request is billed to: the token's user if signed in, else the peer address."""
+    claims = session_claims(request)
+    if claims:
+        return claims["sub"]
+    return request.client.host if request.client else "unknown"
 
 
 # ============ AI Deposit Analysis Endpoint ============
 @api_router.post("/items/analyze-deposit", response_model=DepositAnalysisResponse)
-async def analyze_item_for_deposit(request: DepositAnalysisRequest):
+async def analyze_item_for_deposit(request: DepositAnalysisRequest, http_request: Request):
     """
     Analyze an item image using AI (GPT-4 Vision) to extract:
     - Item name
@@ -267,33 +493,41 @@ async def analyze_item_for_deposit(request: DepositAnalysisRequest):
     - Category and subcategory
     - Brand
     - Estimated market value
+
+    Holds the request open for the whole upstream call; the jobs endpoint
+    below is the non-blocking alternative.
     """
+    await rate_limiter.check("analyze-deposit", client_key(http_request))
+
     try:
-        from openai import AsyncOpenAI
+        return await run_deposit_analysis(request.image_base64)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"AI Analysis failed: {str(e)}")
+        # Provide fallback response
+        raise HTTPException(
+            status_code=500,
+            detail=f"AI analysis failed: {str(e)}. Please try again or add the item manually."
+        )
 
-        # Get API key from environment
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+async def run_deposit_analysis(image_base64: str) -> DepositAnalysisResponse:
+    from openai import AsyncOpenAI
 
-        # Clean base64 string (remove data:image prefix if present)
-        image_base64 = request.image_base64
-        if "base64," in image_base64:
-            image_base64 = image_base64.split("base64,")[1]
+    # Get API key from environment
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
 
-        # Create OpenAI client
-        client = AsyncOpenAI(api_key=api_key)
+    # Clean base64 string (remove data:image prefix if present)
+    if "base64," in image_base64:
+        image_base64 = image_base64.split("base64,")[1]
 
-        # Create analysis prompt
-        prompt = """Analyze this item image and provide detailed information in the following format:
+    # Create OpenAI client
+    client = AsyncOpenAI(api_key=api_key)
 
-NAME: [Clear, concise item name]
-DESCRIPTION: [Detailed 2-3 sentence description]
-CATEGORY: [One of: clothing, shoes, electronics, accessories, furniture, jewelry, sports, tools, books, toys]
-SUBCATEGORY: [Specific type - e.g., for clothing: shirt, pants, jacket, shorts; for shoes: sneakers, boots, sandals; for electronics: phone, tablet, laptop, headphones; for accessories: watch, bag, hat, sunglasses]
-BRAND: [Brand name if visible or identifiable, otherwise "Generic"]
-CONDITION: [One of: new, excellent, good, fair, poor - based on visual appearance]
-VALUE: [Realistic current market value in USD as a number only, e.g., 299.99]
+    # Create analysis prompt; the answer's shape is enforced by the JSON schema
+    prompt = """Analyze this item image and describe it for a deposit.
 
 Important guidelines:
 - Be realistic with valuations based on current market prices
@@ -302,83 +536,187 @@ Important guidelines:
 - Choose the most specific category and subcategory that fits
 - Provide accurate, honest assessments"""
 
-        logger.info("Sending image to AI for analysis...")
-
-        # Call OpenAI API with vision
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are an expert item appraiser and identifier. Analyze images of physical items and provide accurate details."
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
+    logger.info("Sending image to AI for analysis...")
+    # Duplicate check runs alongside the upstream call
+    duplicates = asyncio.create_task(check_photo_duplicates(image_base64))
+
+    # Call OpenAI API with vision
+    try:
+        async with ai_admission.slot():
+            response = await client.chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "You are an expert item appraiser and identifier. Analyze images of physical items and provide accurate details."
+                    },
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": prompt},
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:image/jpeg;base64,{image_base64}"
+                                }
                             }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=500
-        )
+                        ]
+                    }
+                ],
+                response_format=deposit_analysis.RESPONSE_FORMAT,
+                max_tokens=500
+            )
+    except BaseException:
+        duplicates.cancel()
+        raise
+
+    response_text = response.choices[0].message.content or ""
+    logger.info(f"AI Response: {response_text}")
 
-        response_text = response.choices[0].message.content
-        logger.info(f"AI Response: {response_text}")
+    try:
+        analysis = deposit_analysis.parse_analysis(response_text, DepositAnalysisResponse)
+        _, analysis.possible_duplicates = await duplicates
+        return analysis
+    except deposit_analysis.AnalysisParseError as e:
+        duplicates.cancel()
+        logger.warning(f"Unusable AI analysis ({e}): {response_text!r}")
+        raise HTTPException(
+            status_code=502,
+            detail="AI analysis could not be read. Please add the item manually."
+        )
 
-        # Parse the structured response
-        parsed_data = {}
 
-        # Extract fields using regex
-        name_match = re.search(r'NAME:\s*(.+?)(?:\n|$)', response_text, re.IGNORECASE)
-        desc_match = re.search(r'DESCRIPTION:\s*(.+?)(?:\n(?:CATEGORY|SUBCATEGORY|BRAND|CONDITION|VALUE):|$)', response_text, re.IGNORECASE | re.DOTALL)
-        category_match = re.search(r'CATEGORY:\s*(.+?)(?:\n|$)', response_text, re.IGNORECASE)
-        subcategory_match = re.search(r'SUBCATEGORY:\s*(.+?)(?:\n|$)', response_text, re.IGNORECASE)
-        brand_match = re.search(r'BRAND:\s*(.+?)(?:\n|$)', response_text, re.IGNORECASE)
-        condition_match = re.search(r'CONDITION:\s*(.+?)(?:\n|$)', response_text, re.IGNORECASE)
-        value_match = re.search(r'VALUE:\s*\$?([0-9]+\.?[0-9]*)', response_text, re.IGNORECASE)
+# ============ Background Job Endpoints ============
+class AnalysisJobRequest(DepositAnalysisRequest):
+    callback_url: Optional[str] = None
 
-        # Assign values with fallbacks
-        parsed_data['name'] = name_match.group(1).strip() if name_match else "Unknown Item"
-        parsed_data['description'] = desc_match.group(1).strip() if desc_match else "No description available"
-        parsed_data['category'] = category_match.group(1).strip().lower() if category_match else "accessories"
-        parsed_data['subcategory'] = subcategory_match.group(1).strip().lower() if subcategory_match else "item"
-        parsed_data['brand'] = brand_match.group(1).strip() if brand_match else "Generic"
-        parsed_data['condition'] = condition_match.group(1).strip().lower() if condition_match else "good"
-        parsed_data['estimated_value'] = float(value_match.group(1)) if value_match else 10.0
+async def deposit_analysis_job(payload: dict) -> dict:
+    try:
+        analysis = await run_deposit_analysis(payload["image_base64"])
+    except HTTPException as e:
+        if e.status_code == 429:
+            raise  # upstream saturated; back off and retry
+        raise PermanentJobError(e.detail)
+    return analysis.model_dump()
+
+job_queue = JobQueue(
+    db,
+    {"deposit-analysis": deposit_analysis_job},
+    concurrency=int(os.environ.get("JOB_WORKERS", 4)),
+    max_attempts=int(os.environ.get("JOB_MAX_ATTEMPTS", 3)),
+)
+# Callbacks are server-side requests, so only to hosts we were told about
+JOB_CALLBACK_HOSTS = {host.strip() for host in os.environ.get("JOB_CALLBACK_HOSTS", "").split(",") if host.strip()}
 
-        # Ensure condition is valid
-        valid_conditions = ["new", "excellent", "good", "fair", "poor"]
-        if parsed_data['condition'] not in valid_conditions:
-            parsed_data['condition'] = "good"
+@api_router.post("/items/analyze-deposit/jobs", status_code=202)
+async def submit_deposit_analysis(request: AnalysisJobRequest, http_request: Request):
+    """
+    Queue an image for AI analysis and return its job id straight away.
+    Poll `/jobs/{job_id}`, stream `/jobs/{job_id}/events`, or pass a
+    `callback_url` to be POSTed the finished job.
+    """
+    if request.callback_url and urlparse(request.callback_url).hostname not in JOB_CALLBACK_HOSTS:
+        raise HTTPException(status_code=400, detail="callback_url host is not allowed")
+    await rate_limiter.check("analyze-deposit", client_key(http_request))
+    job = await job_queue.submit(
+        "deposit-analysis", {"image_base64": request.image_base64}, callback_url=request.callback_url
+    )
+    return public_view(job)
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return public_view(job)
+
+@api_router.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request):
+    """Server-Sent Events: a `status` event on every change until the job finishes."""
+    job = await job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        last = None
+        while not await request.is_disconnected():
+            current = await job_queue.get(job_id)
+            if current is None:
+                return
+            view = public_view(current)
+            if (view["status"], view["attempts"]) != last:
+                last = (view["status"], view["attempts"])
+                yield f"event: status\ndata: {json.dumps(view, default=str)}\n\n"
+            if view["status"] in JOB_FINISHED:
+                return
+            await asyncio.sleep(1)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-        logger.info(f"Parsed data: {parsed_data}")
 
-        return DepositAnalysisResponse(**parsed_data)
+# ============ Item Endpoints ============
+async def check_photo_duplicates(photo: str):
+    """Hash a photo and find near-duplicate items; (None, []) if it can't be hashed."""
+    try:
+        value = await asyncio.to_thread(image_hash.photo_hash, photo)
+    except image_hash.UnreadablePhoto as e:
+        logger.info(f"Photo could not be hashed: {e}")
+        return None, []
+    if value is None:
+        return None, []
+    matches = await image_hash.find_near_duplicates(db, value)
+    if matches:
+        metrics.inc("duplicate_photos_flagged_total")
+    return value, [match["item_id"] for match in matches]
+
+async def describe_photo(photo: str):
+    """Visual search descriptor of a photo; None if it can't be described."""
+    try:
+        return await asyncio.to_thread(visual_search.photo_descriptor, photo)
+    except image_hash.UnreadablePhoto:
+        return None
 
-    except Exception as e:
-        logger.error(f"AI Analysis failed: {str(e)}")
-        # Provide fallback response
-        raise HTTPException(
-            status_code=500,
-            detail=f"AI analysis failed: {str(e)}. Please try again or add the item manually."
-        )
+async def photo_fields(item_obj: Item):
+    """
+    Hash and describe a new item's photo. Sets `possible_duplicate_of` and
+    returns the document to store along with the descriptor (or None).
+    """
+    (photo_hash, item_obj.possible_duplicate_of), descriptor = await asyncio.gather(
+        check_photo_duplicates(item_obj.photo), describe_photo(item_obj.photo)
+    )
+    if item_obj.possible_duplicate_of:
+        logger.warning(f"Item {item_obj.item_id} looks like a duplicate of {item_obj.possible_duplicate_of}")
 
+    doc = item_obj.dict()
+    if photo_hash is not None:
+        doc.update(image_hash.hash_fields(photo_hash))
+    if descriptor is not None:
+        doc["visual_descriptor"] = visual_search.to_bytes(descriptor)
+    return doc, descriptor
 
-# ============ Item Endpoints ============
 @api_router.post("/items", response_model=Item)
 async def create_item(item: ItemCreate):
     item_obj = Item(**item.dict())
-    await db.items.insert_one(item_obj.dict())
+    doc, descriptor = await photo_fields(item_obj)
+    await ownership.append(db, item_obj.item_id, ownership.DEPOSIT, item_obj.owner_id, item_obj.created_at,
+                           share_percentage=item_obj.share_percentage)
+    seq = await next_change_seq(db)
+    await db.items.insert_one(money.encode("items", stamp(doc, seq, item_obj.updated_at)))
+    await mark_changed(db, "items", [item_obj.owner_id], seq)
+    if descriptor is not None:
+        visual_index.add(item_obj.item_id, descriptor)
     return item_obj
 
 @api_router.get("/items/user/{user_id}", response_model=List[Item])
-async def get_user_items(user_id: str):
+async def get_user_items(user_id: str, request: Request, response: Response):
+    cached = await not_modified(request, response, user_id, "items")
+    if cached:
+        return cached
+
     items = await db.items.find({"owner_id": user_id}).to_list(1000)
     return [Item(**item) for item in items]
 
@@ -396,63 +734,449 @@ async def update_item(item_id: str, update: ItemUpdate):
         raise HTTPException(status_code=404, detail="Item not found")
 
     update_data = update.dict(exclude_unset=True)
-    update_data["updated_at"] = datetime.utcnow()
+    if update_data.get("owner_id") not in (None, item["owner_id"]):
+        await ownership.append(db, item_id, ownership.TRANSFER, update_data["owner_id"],
+                               share_percentage=update_data.get("share_percentage"))
+    elif update_data.get("share_percentage") is not None:
+        await ownership.append(db, item_id, ownership.SHARE_CHANGE, None,
+                               share_percentage=update_data["share_percentage"])
+    seq = await next_change_seq(db)
+    stamp(update_data, seq)
 
     await db.items.update_one(
         {"item_id": item_id},
-        {"$set": update_data}
+        {"$set": money.encode("items", update_data)}
     )
 
+    # The previous owner's devices need to drop the item
+    if update_data.get("owner_id") not in (None, item["owner_id"]):
+        await record_tombstones(db, "items", item_id, [item["owner_id"]])
+    await mark_changed(db, "items", [item["owner_id"], update_data.get("owner_id")], seq)
+
     updated_item = await db.items.find_one({"item_id": item_id})
     return Item(**updated_item)
 
 @api_router.delete("/items/{item_id}")
 async def delete_item(item_id: str):
-    result = await db.items.delete_one({"item_id": item_id})
-    if result.deleted_count == 0:
+    deleted = await db.items.find_one_and_delete({"item_id": item_id}, {"owner_id": 1})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Item not found")
+    await ownership.append(db, item_id, ownership.DELETE, None)
+
+    await record_tombstones(db, "items", item_id, [deleted.get("owner_id")])
+    await mark_changed(db, "items", [deleted.get("owner_id")], await next_change_seq(db))
+    visual_index.remove(item_id)
     return {"message": "Item deleted successfully"}
 
 
+# ============ Visual Search Endpoints ============
+MAX_SIMILAR_ITEMS = 50
+
+visual_index = visual_search.VisualSearch(
+    db,
+    refresh_interval=float(os.environ.get("VISUAL_INDEX_REFRESH_SECONDS", 5)),
+    nprobe=int(os.environ.get("VISUAL_INDEX_NPROBE", 16)),
+    ivf_min_rows=int(os.environ.get("VISUAL_INDEX_IVF_MIN_ROWS", visual_search.IVF_MIN_ROWS)),
+)
+
+class SimilarItem(BaseModel):
+    item: Item
+    similarity: float
+
+class SimilarPhotoRequest(BaseModel):
+    image_base64: str
+
+async def similar_items(vector, limit: int, exclude_item_id: Optional[str], exclude_owner_id: Optional[str]) -> List[SimilarItem]:
+    limit = max(1, min(limit, MAX_SIMILAR_ITEMS))
+    # Over-fetch so dropping the shopper's own items still fills the page
+    matches = visual_index.similar(vector, limit * 3 if exclude_owner_id else limit, exclude_item_id)
+    if not matches:
+        return []
+
+    query = {"item_id": {"$in": [item_id for item_id, _ in matches]}}
+    if exclude_owner_id:
+        query["owner_id"] = {"$ne": exclude_owner_id}
+    items = {doc["item_id"]: doc for doc in await db.items.find(query).to_list(len(matches))}
+    return [
+        SimilarItem(item=Item(**items[item_id]), similarity=round(score, 4))
+        for item_id, score in matches if item_id in items
+    ][:limit]
+
+@api_router.get("/items/{item_id}/similar", response_model=List[SimilarItem])
+async def get_similar_items(item_id: str, limit: int = 10, exclude_owner_id: Optional[str] = None):
+    """Items whose photos look most like this one's, most similar first."""
+    vector = await visual_index.descriptor_of(item_id)
+    if vector is None:
+        if not await db.items.find_one({"item_id": item_id}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Item not found")
+        raise HTTPException(status_code=409, detail="Item photo has not been indexed yet")
+    return await similar_items(vector, limit, item_id, exclude_owner_id)
+
+@api_router.post("/items/similar", response_model=List[SimilarItem])
+async def search_similar_items(request: SimilarPhotoRequest, limit: int = 10, exclude_owner_id: Optional[str] = None):
+    """Items that look like an uploaded photo, most similar first."""
+    if image_hash.Image is None:
+        raise HTTPException(status_code=501, detail="Photo search requires Pillow")
+    vector = await describe_photo(request.image_base64)
+    if vector is None:
+        raise HTTPException(status_code=400, detail="Photo could not be read")
+    return await similar_items(vector, limit, None, exclude_owner_id)
+
+
+# ============ NFC Tag Endpoints ============
+MAX_TAG_BATCH = 500
+
+def tag_signing_key() -> bytes:
+    key = os.getenv("TAG_SIGNING_KEY")
+    if not key:
+        raise HTTPException(status_code=500, detail="Tag signing key not configured")
+    return key.encode()
+
+def encode_item_tag(item: dict, key: bytes) -> TagPayloadResponse:
+    payload = tag_codec.encode(tag_codec.TagPayload(
+        item_id=item["item_id"],
+        owner_id=item["owner_id"],
+        category=item["category"],
+        subcategory=item["subcategory"],
+        brand=item.get("brand"),
+        condition=item.get("condition"),
+        value=item["value"],
+        is_fractional=item.get("is_fractional", False),
+        share_percentage=item.get("share_percentage", 1.0),
+        parent_item_id=item.get("parent_item_id"),
+        timestamp=datetime.utcnow(),
+    ), key)
+    return TagPayloadResponse(
+        item_id=item["item_id"],
+        payload=base64.b64encode(payload).decode(),
+        size=len(payload)
+    )
+
+@api_router.get("/items/{item_id}/tag-payload", response_model=TagPayloadResponse)
+async def get_item_tag_payload(item_id: str):
+    """Signed compact binary payload to write to the item's NFC tag."""
+    key = tag_signing_key()
+    item = await db.items.find_one({"item_id": item_id}, {"photo": 0})
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    try:
+        return encode_item_tag(item, key)
+    except tag_codec.TagCodecError as e:
+        raise HTTPException(status_code=422, detail=f"Item cannot be encoded: {e}")
+
+@api_router.post("/items/tag-payloads", response_model=List[TagPayloadResponse])
+async def get_item_tag_payloads(request: TagPayloadBulkRequest):
+    """Tag payloads for many items in one query; unknown ids are skipped."""
+    if len(request.item_ids) > MAX_TAG_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_TAG_BATCH} items per request")
+
+    key = tag_signing_key()
+    items = await db.items.find(
+        {"item_id": {"$in": request.item_ids}}, {"photo": 0}
+    ).to_list(len(request.item_ids))
+
+    payloads = []
+    for item in items:
+        try:
+            payloads.append(encode_item_tag(item, key))
+        except tag_codec.TagCodecError as e:
+            logger.warning(f"Skipping tag payload for item {item['item_id']}: {e}")
+    return payloads
+
+@api_router.post("/tags/decode", response_model=DecodedTag)
+async def decode_tag_payload(request: TagDecodeRequest):
+    key = tag_signing_key()
+    try:
+        data = base64.b64decode(request.payload, validate=True)
+        signature_valid = True
+        try:
+            tag = tag_codec.decode(data, key)
+        except tag_codec.TagSignatureError:
+            signature_valid = False
+            tag = tag_codec.decode(data)
+    except (ValueError, tag_codec.TagCodecError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid tag payload: {e}")
+
+    return DecodedTag(**vars(tag), signature_valid=signature_valid)
+
+
+@api_router.post("/items/verify", response_model=TagVerifyResponse)
+async def verify_item_tags(request: TagVerifyRequest):
+    """
+    Verify a batch of scanned item tags at checkout with one item lookup.
+
+    A tag is valid when its signature checks out, the item exists, the tag's
+    owner and share match the item as stored, the item hasn't changed since
+    the tag was written, and the tag is younger than `max_age_seconds`.
+    """
+    if len(request.payloads) > MAX_TAG_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_TAG_BATCH} tags per request")
+
+    key = tag_signing_key()
+    now = datetime.utcnow()
+    verdicts = []
+    decoded = {}
+
+    for index, payload in enumerate(request.payloads):
+        try:
+            tag = tag_codec.decode(base64.b64decode(payload, validate=True), key)
+        except tag_codec.TagSignatureError:
+            verdicts.append(TagVerdict(index=index, valid=False, reason="bad_signature"))
+            continue
+        except ValueError:
+            verdicts.append(TagVerdict(index=index, valid=False, reason="malformed"))
+            continue
+
+        if tag.item_id in decoded:
+            verdicts.append(TagVerdict(index=index, item_id=tag.item_id, valid=False, reason="duplicate"))
+            continue
+        decoded[tag.item_id] = tag
+        verdicts.append(TagVerdict(index=index, item_id=tag.item_id, valid=True))
+
+    items = {
+        item["item_id"]: item
+        for item in await db.items.find(
+            {"item_id": {"$in": list(decoded)}}, {"photo": 0}
+        ).to_list(len(decoded))
+    } if decoded else {}
+
+    total_value = 0.0
+    for verdict in verdicts:
+        if not verdict.valid:
+            continue
+        tag = decoded[verdict.item_id]
+        item = items.get(verdict.item_id)
+        if item is None:
+            verdict.valid, verdict.reason = False, "not_found"
+            continue
+
+        verdict.owner_id = item["owner_id"]
+        verdict.value = item.get("value")
+        verdict.share_percentage = item.get("share_percentage", 1.0)
+
+        # Tag timestamps have whole-second precision
+        updated_at = item.get("updated_at") or item.get("created_at") or now
+        if item["owner_id"] != tag.owner_id or (
+            request.expected_owner_id and item["owner_id"] != request.expected_owner_id
+        ):
+            verdict.reason = "owner_mismatch"
+        elif abs(verdict.share_percentage - tag.share_percentage) > 1e-4:
+            verdict.reason = "share_mismatch"
+        elif updated_at - tag.timestamp > timedelta(seconds=1):
+            verdict.reason = "stale"
+        elif request.max_age_seconds is not None and (now - tag.timestamp).total_seconds() > request.max_age_seconds:
+            verdict.reason = "expired"
+
+        if verdict.reason:
+            verdict.valid = False
+        else:
+            total_value += verdict.value or 0.0
+
+    return TagVerifyResponse(
+        verdicts=verdicts,
+        all_valid=bool(verdicts) and all(v.valid for v in verdicts),
+        total_value=round(total_value, 2)
+    )
+
+
+# ============ Bulk Import / Export Endpoints ============
+IMPORT_CHUNK_SIZE = 500
+MAX_REPORTED_IMPORT_ERRORS = 100
+
+EXPORTS = {
+    "items": (Item, "owner_id"),
+    "transactions": (Transaction, "user_id"),
+    "trades": (Trade, None),
+}
+
+@api_router.post("/items/import")
+async def import_items(request: Request, owner_id: Optional[str] = None):
+    """
+    Bulk-create items from an NDJSON or CSV body (by Content-Type).
+
+    Rows are validated and inserted in chunks as the upload streams in. The
+    response is an NDJSON stream of `progress` events after each chunk and a
+    final `done` event with totals and the first rejected rows. `owner_id`
+    fills in rows that don't name an owner.
+    """
+    content_type = request.headers.get("content-type", "")
+    if "csv" in content_type:
+        fmt = "csv"
+    elif "ndjson" in content_type or "jsonl" in content_type:
+        fmt = "ndjson"
+    else:
+        raise HTTPException(status_code=415, detail="Send application/x-ndjson or text/csv")
+
+    async def run_import():
+        inserted, failed = 0, 0
+        errors = []
+
+        try:
+            async for rows in bulk.iter_row_chunks(request.stream(), fmt, IMPORT_CHUNK_SIZE):
+                valid = []
+                for line_number, row, error in rows:
+                    if row is not None:
+                        if owner_id and "owner_id" not in row:
+                            row["owner_id"] = owner_id
+                        try:
+                            valid.append(Item(**ItemCreate(**row).dict()))
+                        except ValidationError as e:
+                            error = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+                    if error:
+                        failed += 1
+                        if len(errors) < MAX_REPORTED_IMPORT_ERRORS:
+                            errors.append({"line": line_number, "error": error})
+
+                if valid:
+                    described = await asyncio.gather(*(photo_fields(item) for item in valid))
+                    await ownership.append_deposits(db, [item.dict() for item in valid])
+                    seq = await next_change_seq(db, len(valid))
+                    await db.items.insert_many(
+                        [money.encode("items", stamp(doc, seq + offset, item.updated_at))
+                         for offset, (item, (doc, _)) in enumerate(zip(valid, described))],
+                        ordered=False
+                    )
+                    inserted += len(valid)
+                    await mark_changed(db, "items", {item.owner_id for item in valid}, seq)
+                    for item, (_, descriptor) in zip(valid, described):
+                        if descriptor is not None:
+                            visual_index.add(item.item_id, descriptor)
+
+                yield json.dumps({"type": "progress", "inserted": inserted, "failed": failed}) + "\n"
+        except ClientDisconnect:
+            logger.info(f"Bulk import aborted by client after {inserted} inserted")
+            return
+
+        logger.info(f"Bulk import finished: {inserted} inserted, {failed} failed")
+        yield json.dumps({"type": "done", "inserted": inserted, "failed": failed, "errors": errors}) + "\n"
+
+    return bulk.UploadProgressResponse(run_import(), media_type="application/x-ndjson")
+
+@api_router.get("/export/{collection}")
+async def export_collection(collection: str, user_id: Optional[str] = None, format: str = "ndjson"):
+    """
+    Stream a collection as NDJSON or Parquet, for one user or everyone.
+    Documents are read in cursor batches so memory stays flat.
+    """
+    if collection not in EXPORTS:
+        raise HTTPException(status_code=404, detail=f"Unknown collection: {collection}")
+    if format not in ("ndjson", "parquet"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or parquet")
+
+    model, owner_field = EXPORTS[collection]
+    if user_id and not owner_field:
+        # A user's trades come through their party entries
+        cursor = trade_parties.user_trades(db, user_id, batch_size=IMPORT_CHUNK_SIZE)
+    else:
+        query = {owner_field: user_id} if user_id else {}
+        cursor = db[collection].find(query, {"_id": 0}).batch_size(IMPORT_CHUNK_SIZE)
+
+    async def batches():
+        exported = 0
+        batch = []
+        async for doc in cursor:
+            batch.append(model(**doc))
+            if len(batch) == IMPORT_CHUNK_SIZE:
+                exported += len(batch)
+                logger.info(f"Export {collection}: {exported} documents")
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    filename = f"{collection}-{user_id or 'all'}"
+
+    if format == "ndjson":
+        async def ndjson():
+            async for batch in batches():
+                yield "".join(row.model_dump_json() + "\n" for row in batch)
+
+        return StreamingResponse(
+            ndjson(),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.ndjson"'}
+        )
+
+    try:
+        parquet = bulk.ParquetExport(model)
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+
+    async for batch in batches():
+        # Row groups are encoded off the event loop
+        await asyncio.to_thread(parquet.write, batch)
+    sink = await asyncio.to_thread(parquet.finish)
+
+    def read_sink():
+        with sink:
+            while chunk := sink.read(1024 * 1024):
+                yield chunk
+
+    return StreamingResponse(
+        read_sink(),
+        media_type="application/vnd.apache.parquet",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.parquet"'}
+    )
+
+
 # ============ Transaction Endpoints ============
+SETTLEMENT_WINDOW = timedelta(seconds=float(os.environ.get("SETTLEMENT_WINDOW_SECONDS", 0)))
+
 @api_router.post("/transactions", response_model=Transaction)
 async def create_transaction(transaction: TransactionCreate):
     transaction_obj = Transaction(**transaction.dict())
-    await db.transactions.insert_one(transaction_obj.dict())
-
-    # Update user balance based on transaction type
-    user = await db.users.find_one({"user_id": transaction.user_id})
-    if user:
-        current_balance = user.get("balance", 0.0)
-
-        # Determine balance change based on transaction type
-        if transaction.type == "deposit" or transaction.type == "refund":
-            # Increase balance (money coming in)
-            new_balance = current_balance + transaction.amount
-        elif transaction.type == "payment" or transaction.type == "withdrawal":
-            # Decrease balance (money going out)
-            new_balance = current_balance - transaction.amount
-        else:
-            new_balance = current_balance
+    seq = await next_change_seq(db)
+    await db.transactions.insert_one(
+        money.encode("transactions", stamp(transaction_obj.dict(), seq, transaction_obj.created_at))
+    )
 
-        # Update user's balance
-        await db.users.update_one(
+    if SETTLEMENT_WINDOW:
+        # Balances move when the settlement runner nets the window
+        obligation = netting.obligation_for(transaction_obj.dict())
+        if obligation:
+            await db.obligations.insert_one(obligation)
+        await mark_changed(db, "transactions", [transaction.user_id], seq)
+        return transaction_obj
+
+    # Determine balance change based on transaction type
+    if transaction.type == "deposit" or transaction.type == "refund":
+        # Increase balance (money coming in)
+        change = transaction.amount
+    elif transaction.type == "payment" or transaction.type == "withdrawal":
+        # Decrease balance (money going out)
+        change = -transaction.amount
+    else:
+        change = 0.0
+
+    if change:
+        # One exact Decimal128 $inc: no read-modify-write race, no float drift
+        updated = await db.users.update_one(
             {"user_id": transaction.user_id},
-            {"$set": {"balance": new_balance}}
+            {"$inc": {"balance": money.decimal(change)}}
         )
+        if updated.matched_count:
+            logger.info(f"Changed balance for user {transaction.user_id} by {change} (type: {transaction.type})")
 
-        logger.info(f"Updated balance for user {transaction.user_id}: {current_balance} -> {new_balance} (type: {transaction.type})")
-
+    await mark_changed(db, "transactions", [transaction.user_id], seq)
+    await mark_changed(db, "users", [transaction.user_id], seq)
     return transaction_obj
 
 @api_router.get("/transactions/user/{user_id}", response_model=List[Transaction])
-async def get_user_transactions(user_id: str):
+async def get_user_transactions(user_id: str, request: Request, response: Response, include_archived: bool = False):
     """
     Get all transactions for a user, combining:
     - Items deposited (from items collection)
     - Payments sent/received (from transactions collection)
     - Money spent at merchants (from transactions collection)
+
+    History older than the archive horizon is left out unless
+    `include_archived` is set.
     """
+    collections = ["items", "transactions"] + ([archive_name("transactions")] if include_archived else [])
+    cached = await not_modified(request, response, user_id, *collections)
+    if cached:
+        return cached
+
     transactions_list = []
 
     # Get items as deposit transactions
@@ -480,6 +1204,10 @@ async def get_user_transactions(user_id: str):
     payment_transactions = await db.transactions.find({"user_id": user_id}).to_list(1000)
     for tx in payment_transactions:
         transactions_list.append(tx)
+    if include_archived:
+        transactions_list.extend(
+            await db[archive_name("transactions")].find({"user_id": user_id}).to_list(None)
+        )
 
     # Sort by created_at descending (most recent first)
     transactions_list.sort(key=lambda x: x.get("created_at", datetime.min), reverse=True)
@@ -498,47 +1226,80 @@ async def get_transaction(transaction_id: str):
 @api_router.post("/trades", response_model=Trade)
 async def create_trade(trade: TradeCreate):
     trade_obj = Trade(**trade.dict())
+    seq = await next_change_seq(db, len(trade.items) + 1)
+    trade_doc = money.encode("trades", stamp(trade_obj.dict(), seq))
+    await trade_parties.record(db, trade_doc)
 
     # Update item ownership
-    for item in trade.items:
+    for offset, item in enumerate(trade.items, start=1):
+        share = 1.0 - item.share_percentage if item.share_percentage < 1.0 else 0.0
+        await ownership.append(db, item.item_id, ownership.TRANSFER, item.new_owner, trade_obj.timestamp,
+                               share_percentage=share, trade_id=trade_obj.trade_id)
+        if item.previous_owner != item.new_owner:
+            await clear_tombstones(db, "items", item.item_id, [item.new_owner])
         await db.items.update_one(
             {"item_id": item.item_id},
-            {"$set": {
-                "owner_id": item.new_owner,
-                "share_percentage": 1.0 - item.share_percentage if item.share_percentage < 1.0 else 0.0,
-                "updated_at": datetime.utcnow()
-            }}
+            {"$set": stamp({"owner_id": item.new_owner, "share_percentage": share}, seq + offset)}
         )
+        if item.previous_owner != item.new_owner:
+            await record_tombstones(db, "items", item.item_id, [item.previous_owner])
 
-    await db.trades.insert_one(trade_obj.dict())
+    await db.trades.insert_one(trade_doc)
+    await mark_trade_changed(trade_obj, seq)
     return trade_obj
 
+async def mark_trade_changed(trade_obj: Trade, seq: int):
+    await mark_changed(db, "trades", [trade_obj.payer_id, trade_obj.payee_id], seq)
+    owners = [owner for item in trade_obj.items for owner in (item.previous_owner, item.new_owner)]
+    await mark_changed(db, "items", owners, seq)
+
 @api_router.get("/trades/user/{user_id}", response_model=List[Trade])
-async def get_user_trades(user_id: str):
-    trades = await db.trades.find({
-        "$or": [{"payer_id": user_id}, {"payee_id": user_id}]
-    }).to_list(1000)
+async def get_user_trades(user_id: str, request: Request, response: Response, include_archived: bool = False):
+    collections = ["trades"] + ([archive_name("trades")] if include_archived else [])
+    cached = await not_modified(request, response, user_id, *collections)
+    if cached:
+        return cached
+
+    # One range scan over the user's own party entries, not an $or over both roles
+    trades = [trade async for trade in trade_parties.user_trades(db, user_id, limit=1000)]
+    if include_archived:
+        trades.extend([trade async for trade in trade_parties.user_trades(db, user_id, archive_name("trades"))])
     return [Trade(**trade) for trade in trades]
 
 @api_router.post("/trades/sync")
-async def sync_offline_trades(trades: List[TradeCreate]):
+async def sync_offline_trades(trades: List[TradeCreate], request: Request):
+    if len(trades) > MAX_SYNC_TRADES:
+        raise HTTPException(status_code=413, detail=f"Sync at most {MAX_SYNC_TRADES} trades per request")
+    await rate_limiter.check("trades-sync", client_key(request), cost=max(1, len(trades)))
+
+    # Shielded so a dropped client connection can't abandon a half-applied batch
+    return await sync_drain.run(apply_offline_trades(trades))
+
+async def apply_offline_trades(trades: List[TradeCreate]):
     synced = []
     failed = []
 
     for trade_data in trades:
         try:
             trade_obj = Trade(**trade_data.dict())
-            await db.trades.insert_one(trade_obj.dict())
+            seq = await next_change_seq(db, len(trade_obj.items) + 1)
+            trade_doc = money.encode("trades", stamp(trade_obj.dict(), seq))
+            await trade_parties.record(db, trade_doc)
+            await db.trades.insert_one(trade_doc)
 
             # Update item ownership
-            for item in trade_obj.items:
+            for offset, item in enumerate(trade_obj.items, start=1):
+                await ownership.append(db, item.item_id, ownership.TRANSFER, item.new_owner, trade_obj.timestamp,
+                                       trade_id=trade_obj.trade_id)
+                if item.previous_owner != item.new_owner:
+                    await clear_tombstones(db, "items", item.item_id, [item.new_owner])
                 await db.items.update_one(
                     {"item_id": item.item_id},
-                    {"$set": {
-                        "owner_id": item.new_owner,
-                        "updated_at": datetime.utcnow()
-                    }}
+                    {"$set": stamp({"owner_id": item.new_owner}, seq + offset)}
                 )
+                if item.previous_owner != item.new_owner:
+                    await record_tombstones(db, "items", item.item_id, [item.previous_owner])
+            await mark_trade_changed(trade_obj, seq)
 
             synced.append(trade_obj.trade_id)
         except Exception as e:
@@ -547,73 +1308,507 @@ async def sync_offline_trades(trades: List[TradeCreate]):
     return {"synced": len(synced), "failed": len(failed), "synced_ids": synced}
 
 
+# ============ Payment Plan Endpoint ============
+class PaymentPlanRequest(BaseModel):
+    payer_id: str
+    amount: float
+    payee_id: Optional[str] = None  # fills in trade_items ready for POST /trades
+    exclude_item_ids: List[str] = []  # never spend these
+    prefer_item_ids: List[str] = []  # spend these first where they fit
+    no_split_item_ids: List[str] = []  # spend whole or not at all
+
+class PaymentPlan(BaseModel):
+    payer_id: str
+    amount: float
+    items: List[SpentItem]
+    trade_items: List[TradeItem] = []
+    split_count: int
+
+@api_router.post("/payments/plan", response_model=PaymentPlan)
+async def plan_payment(request: PaymentPlanRequest):
+    """
+    Which of the payer's items to spend on an amount: whole items adding up
+    exactly where possible, otherwise one item split for the remainder.
+    Fractions are of the whole item, so they can go straight into a trade.
+    """
+    if request.amount <= 0:
+        raise HTTPException(status_code=400, detail="amount must be positive")
+    items = await db.items.find(
+        {"owner_id": request.payer_id, "item_id": {"$nin": request.exclude_item_ids}},
+        {"_id": 0, "item_id": 1, "value": 1, "share_percentage": 1, "brand": 1, "subcategory": 1},
+    ).to_list(None)
+    for item in items:
+        # Only the payer's share of an item is theirs to spend
+        item["value"] = item["value"] * item.get("share_percentage", 1.0)
+    try:
+        # Thousands of items take tens of milliseconds; keep that off the event loop
+        chosen = await asyncio.to_thread(
+            payment_plan.plan, items, request.amount, request.prefer_item_ids, request.no_split_item_ids
+        )
+    except payment_plan.InsufficientValue as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    spent = [
+        SpentItem(item_id=item["item_id"], label=f"{item.get('brand', '')} {item.get('subcategory', '')}".strip(),
+                  amount=cents / 100, fraction=fraction * item.get("share_percentage", 1.0))
+        for item, fraction, cents in chosen["items"]
+    ]
+    trade_items = [
+        TradeItem(item_id=entry.item_id, share_percentage=entry.fraction, value=entry.amount,
+                  previous_owner=request.payer_id, new_owner=request.payee_id)
+        for entry in spent
+    ] if request.payee_id else []
+    return PaymentPlan(payer_id=request.payer_id, amount=request.amount, items=spent,
+                       trade_items=trade_items, split_count=chosen["splits"])
+
+
+# ============ Ownership History Endpoints ============
+class OwnershipState(BaseModel):
+    item_id: str
+    owner_id: Optional[str] = None
+    share_percentage: Optional[float] = None
+    version: int
+    deleted: bool = False
+    as_of: Optional[datetime] = None  # time of the last event applied
+
+class OwnershipPeriod(BaseModel):
+    owner_id: str
+    since: datetime
+    until: Optional[datetime] = None
+    via: str
+    trade_id: Optional[str] = None
+
+class Provenance(BaseModel):
+    item_id: str
+    owners: List[OwnershipPeriod]
+    version: int
+
+@api_router.get("/items/{item_id}/owner", response_model=OwnershipState)
+async def get_item_owner(item_id: str, at: Optional[datetime] = None):
+    """Who held an item at time `at` (default now), from the ownership log."""
+    state = await ownership.state_at(db, item_id, when=at)
+    if state["version"] == 0:
+        raise HTTPException(status_code=404, detail="No ownership history for this item at that time")
+    return OwnershipState(**state, as_of=state["at"])
+
+@api_router.get("/items/{item_id}/provenance", response_model=Provenance)
+async def get_item_provenance(item_id: str, until: Optional[datetime] = None):
+    """Every owner an item has had, oldest first, optionally only up to `until`."""
+    state = await ownership.state_at(db, item_id, when=until)
+    if state["version"] == 0:
+        raise HTTPException(status_code=404, detail="No ownership history for this item")
+    return Provenance(item_id=item_id, owners=state["owners"], version=state["version"])
+
+@api_router.get("/items/{item_id}/ownership-events")
+async def get_item_ownership_events(item_id: str):
+    """The raw ownership log for an item, for audits and disputes."""
+    return await ownership.events(db, item_id)
+
+
+# ============ Delta Sync Endpoint ============
+SYNC_PAGE_SIZE = 500
+TOMBSTONE_TTL = timedelta(days=int(os.environ.get("TOMBSTONE_TTL_DAYS", 30)))
+
+@api_router.get("/sync")
+async def get_changes(user_id: str, since: Optional[str] = None, limit: int = SYNC_PAGE_SIZE):
+    """
+    Return items, transactions and trades for a user that changed since a
+    sync token, plus ids of items deleted or traded away.
+
+    Omit `since` for a full sync. Keep calling with the returned `token`
+    while `has_more` is true. `reset` means the token predates tombstone
+    retention and the client should drop local state and full-sync.
+    """
+    limit = max(1, min(limit, SYNC_PAGE_SIZE))
+    now = datetime.utcnow()
+
+    if since:
+        try:
+            since_seq, since_at, continuation = parse_token(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid sync token")
+        if since_at < now - TOMBSTONE_TTL:
+            return {"reset": True, "token": None, "has_more": False}
+        changed = since_filter(since_seq, since_at, continuation)
+        # A paged sync keeps the time it started so the final token covers it
+        started_at = since_at if continuation else now
+    else:
+        since_seq, started_at = 0, now
+        changed = {}
+
+    queries = {
+        "items": {"owner_id": user_id},
+        "transactions": {"user_id": user_id},
+        # Trades are paged through the user's party entries, which share their stamps
+        trade_parties.PARTIES: {"user_id": user_id},
+        "tombstones": {"user_id": user_id},
+    }
+
+    results = {}
+    next_seq = since_seq
+    truncated_at = None
+    for name, query in queries.items():
+        if name == "tombstones" and not since:
+            results[name] = []
+            continue
+        if changed:
+            query = {"$and": [query, changed]}
+        docs = await db[name].find(query).sort("change_seq", 1).limit(limit).to_list(limit)
+        results[name] = docs
+        if name == trade_parties.PARTIES:
+            results["trades"] = await trade_parties.fetch(db, [doc["trade_id"] for doc in docs])
+        if docs:
+            last_seq = docs[-1].get("change_seq", 0)
+            next_seq = max(next_seq, last_seq)
+            if len(docs) == limit:
+                truncated_at = last_seq if truncated_at is None else min(truncated_at, last_seq)
+
+    has_more = truncated_at is not None
+    if has_more:
+        # Resume from the collection that fell furthest behind
+        token = format_token(truncated_at, started_at, continuation=True)
+    else:
+        token = format_token(next_seq, started_at)
+
+    return {
+        "reset": False,
+        "token": token,
+        "has_more": has_more,
+        "items": [Item(**doc) for doc in results["items"]],
+        "transactions": [Transaction(**doc) for doc in results["transactions"]],
+        "trades": [Trade(**doc) for doc in results["trades"]],
+        "deleted_item_ids": sorted({
+            doc["doc_id"] for doc in results["tombstones"] if doc["collection"] == "items"
+        }),
+    }
+
+
+# ============ Real-time Events Endpoint ============
+event_hub = EventHub(db, poll_interval=float(os.environ.get("EVENT_POLL_INTERVAL", 0.5)))
+
+@api_router.get("/events/user/{user_id}")
+async def stream_user_events(user_id: str, request: Request):
+    """
+    Server-Sent Events stream of trades and transactions involving a user.
+
+    Emits `trade` and `transaction` events carrying the same JSON as the REST
+    endpoints, plus a comment heartbeat every 15 seconds to keep proxies open.
+    """
+    queue = event_hub.subscribe(user_id)
+
+    async def event_stream():
+        try:
+            yield ": connected\n\n"
+            while not await request.is_disconnected():
+                try:
+                    collection, doc = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+
+                if collection == "trades":
+                    yield f"event: trade\ndata: {Trade(**doc).model_dump_json()}\n\n"
+                else:
+                    yield f"event: transaction\ndata: {Transaction(**doc).model_dump_json()}\n\n"
+        finally:
+            event_hub.unsubscribe(user_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# ============ History Archive Endpoints ============
+archive_mover = ArchiveMover(
+    db,
+    after=timedelta(days=int(os.environ.get("ARCHIVE_AFTER_DAYS", 365))),
+    interval=float(os.environ.get("ARCHIVE_INTERVAL_SECONDS", 3600)),
+)
+
+@api_router.get("/history/summary/{user_id}")
+async def get_history_summary(user_id: str, collection: Optional[str] = None):
+    """Monthly totals for a user's archived transactions and trades, oldest first."""
+    query = {"user_id": user_id}
+    if collection:
+        query["collection"] = collection
+    return await db.history_summaries.find(query, {"_id": 0}).sort("month", 1).to_list(None)
+
+
+# ============ Settlement Endpoints ============
+settlement_runner = netting.SettlementRunner(db, SETTLEMENT_WINDOW)
+
+@api_router.get("/settlements")
+async def list_settlements(limit: int = 50):
+    return await db.settlements.find({}, {"positions": 0, "transfers": 0}).sort("created_at", -1).to_list(limit)
+
+@api_router.get("/settlements/pending/{user_id}")
+async def get_pending_settlement(user_id: str):
+    """Balance change a user has waiting for the next settlement."""
+    return {"user_id": user_id, "pending": await netting.pending_net(db, user_id)}
+
+@api_router.get("/settlements/{settlement_id}")
+async def get_settlement(settlement_id: str):
+    settlement = await db.settlements.find_one({"_id": settlement_id})
+    if not settlement:
+        raise HTTPException(status_code=404, detail="Settlement not found")
+    return settlement
+
+@api_router.get("/settlements/{settlement_id}/obligations")
+async def get_settlement_obligations(settlement_id: str, limit: int = 1000):
+    """The source transactions a settlement applied."""
+    return await db.obligations.find({"settlement_id": settlement_id}, {"_id": 0}).to_list(limit)
+
+
+# ============ Analytics Endpoints ============
+analytics_cache = analytics.ResultCache(ttl=float(os.environ.get("ANALYTICS_CACHE_SECONDS", 60)))
+
+async def run_report(collection: str, pipeline: list, user_id: Optional[str] = None, *watched: str):
+    """
+    Aggregate with caching. Per-user reports key on the user's version
+    marks so they refresh on the next write; global ones wait out the TTL.
+    """
+    version = await current_etag(db, user_id, watched) if user_id else None
+    key = (collection, repr(pipeline), version)
+    cached = analytics_cache.get(key)
+    if cached is not None:
+        metrics.inc("analytics_cache_total", result="hit")
+        return cached
+
+    metrics.inc("analytics_cache_total", result="miss")
+    started = time.perf_counter()
+    rows = await db[collection].aggregate(pipeline, allowDiskUse=True).to_list(None)
+    metrics.observe("analytics_query_seconds", time.perf_counter() - started, collection=collection)
+    analytics_cache.put(key, rows)
+    return rows
+
+def check_choice(name: str, value: str, choices):
+    if value not in choices:
+        raise HTTPException(status_code=400, detail=f"{name} must be one of: {', '.join(choices)}")
+
+@api_router.get("/analytics/spend")
+async def spend_analytics(
+    group_by: str = "merchant",
+    bucket: str = "month",
+    user_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """Completed payments per merchant or website, bucketed by day, week or month."""
+    check_choice("group_by", group_by, analytics.SPEND_GROUPS)
+    check_choice("bucket", bucket, analytics.BUCKETS)
+    pipeline = analytics.spend_pipeline(group_by, bucket, user_id, start, end)
+    return await run_report("transactions", pipeline, user_id, "transactions")
+
+@api_router.get("/analytics/deposits")
+async def deposit_analytics(
+    group_by: str = "category",
+    bucket: str = "month",
+    user_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """Deposited item count and value per category or brand, bucketed over time."""
+    check_choice("group_by", group_by, analytics.DEPOSIT_GROUPS)
+    check_choice("bucket", bucket, analytics.BUCKETS)
+    pipeline = analytics.deposit_pipeline(group_by, bucket, user_id, start, end)
+    return await run_report("items", pipeline, user_id, "items")
+
+@api_router.get("/analytics/trade-volume")
+async def trade_volume_analytics(start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 100):
+    """Value sent and received through trades per user, busiest first."""
+    pipeline = analytics.trade_volume_pipeline(start, end, max(1, min(limit, 1000)))
+    return await run_report("trades", pipeline)
+
+@api_router.get("/analytics/item-value-by-condition")
+async def item_value_by_condition(category: Optional[str] = None):
+    """Average, min and max item value for each condition."""
+    return await run_report("items", analytics.value_by_condition_pipeline(category))
+
+
+# ============ Item Search Endpoint ============
+MAX_SEARCH_PAGE = 100
+search_facet_cache = analytics.ResultCache(ttl=float(os.environ.get("SEARCH_FACET_CACHE_SECONDS", 30)))
+
+class ItemSearchResponse(BaseModel):
+    items: List[Item]
+    next_cursor: Optional[str] = None
+    facets: Optional[dict] = None  # first page only
+
+@api_router.get("/search/items", response_model=ItemSearchResponse)
+async def search_items(
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    condition: Optional[str] = None,
+    min_value: Optional[float] = None,
+    max_value: Optional[float] = None,
+    sort: Optional[str] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+):
+    """
+    Search items by text and filters. Sorts by relevance when `q` is given,
+    otherwise newest first. Pass `next_cursor` back as `cursor` for the next
+    page; facet counts come with the first page.
+    """
+    q = (q or "").strip() or None
+    sort = sort or ("relevance" if q else "newest")
+    check_choice("sort", sort, search.SORTS)
+    if sort == "relevance" and not q:
+        raise HTTPException(status_code=400, detail="relevance sort needs a search query")
+    limit = max(1, min(limit, MAX_SEARCH_PAGE))
+
+    after = None
+    if cursor:
+        try:
+            after = search.decode_cursor(cursor, sort)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    clauses = search.filters(category, condition, min_value, max_value)
+    rows = await db.items.aggregate(search.results_pipeline(q, clauses, sort, limit, after)).to_list(limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        field, _ = search.SORTS[sort]
+        next_cursor = search.encode_cursor(sort, rows[-1][field], rows[-1]["item_id"])
+
+    facets = None
+    if not cursor:
+        key = (q, repr(sorted(clauses.items())))
+        facets = search_facet_cache.get(key)
+        if facets is None:
+            started = time.perf_counter()
+            row = (await db.items.aggregate(search.facet_pipeline(q, clauses)).to_list(1) or [{}])[0]
+            facets = search.shape_facets(row)
+            metrics.observe("search_facet_seconds", time.perf_counter() - started)
+            search_facet_cache.put(key, facets)
+
+    return ItemSearchResponse(items=[Item(**row) for row in rows], next_cursor=next_cursor, facets=facets)
+
+
 # ============ Valuation Endpoint ============
 @api_router.post("/valuations/mock")
 async def get_mock_valuation(data: dict):
     """Mock valuation based on category, brand, and condition"""
+    return mock_value(
+        data.get("category", ""),
+        data.get("subcategory", ""),
+        data.get("brand", "Generic"),
+        data.get("condition", "good"),
+    )
 
-    # Mock valuation table
-    VALUATIONS = {
-        "clothing": {
-            "shirt": {"Nike": 30, "Adidas": 25, "Puma": 20, "Generic": 10},
-            "pants": {"Nike": 40, "Adidas": 35, "Puma": 30, "Generic": 15},
-            "jacket": {"Nike": 80, "Adidas": 70, "Puma": 60, "Generic": 25},
-            "shorts": {"Nike": 25, "Adidas": 20, "Puma": 18, "Generic": 8}
-        },
-        "shoes": {
-            "sneakers": {"Nike": 80, "Adidas": 70, "Puma": 60, "Generic": 30},
-            "boots": {"Nike": 100, "Adidas": 90, "Puma": 80, "Generic": 40},
-            "sandals": {"Nike": 30, "Adidas": 25, "Puma": 20, "Generic": 10}
-        },
-        "accessories": {
-            "watch": {"Rolex": 5000, "Casio": 50, "Generic": 20},
-            "bag": {"Nike": 50, "Adidas": 45, "Generic": 15},
-            "hat": {"Nike": 25, "Adidas": 20, "Generic": 8}
-        },
-        "electronics": {
-            "phone": {"Apple": 800, "Samsung": 600, "Generic": 200},
-            "tablet": {"Apple": 500, "Samsung": 350, "Generic": 150},
-            "laptop": {"Apple": 1200, "Dell": 800, "Generic": 400}
-        }
-    }
 
-    CONDITION_MULTIPLIERS = {
-        "new": 1.0,
-        "excellent": 0.9,
-        "good": 0.7,
-        "fair": 0.5,
-        "poor": 0.3
-    }
+# ============ Metrics Endpoint ============
+@api_router.get("/metrics")
+async def get_metrics():
+    """Counters and summaries for this worker process."""
+    return metrics.snapshot()
 
-    category = data.get("category", "")
-    subcategory = data.get("subcategory", "")
-    brand = data.get("brand", "Generic")
-    condition = data.get("condition", "good")
 
-    # Get base value
-    base_value = 10  # default
-    if category in VALUATIONS:
-        if subcategory in VALUATIONS[category]:
-            if brand in VALUATIONS[category][subcategory]:
-                base_value = VALUATIONS[category][subcategory][brand]
-            else:
-                base_value = VALUATIONS[category][subcategory].get("Generic", 10)
+# ============ Slow Query Endpoint ============
+slow_query_monitor = SlowQueryMonitor(client, db, slow_query_listener)
 
-    # Apply condition multiplier
-    multiplier = CONDITION_MULTIPLIERS.get(condition, 0.7)
-    final_value = round(base_value * multiplier, 2)
-
-    return {
-        "value": final_value,
-        "currency": "USD",
-        "base_value": base_value,
-        "condition_multiplier": multiplier
-    }
+@api_router.get("/slow-queries")
+async def list_slow_queries(flagged: bool = False, collection: Optional[str] = None, limit: int = 50):
+    """
+    Slow query shapes across workers, by total time spent. `flagged` keeps
+    those whose sampled explain found a collection scan, poor selectivity
+    or an in-memory sort.
+    """
+    rows = await db.slow_queries.find(report_query(flagged, collection)).sort("total_ms", -1).to_list(max(1, min(limit, 500)))
+    for row in rows:
+        row["mean_ms"] = round(row["total_ms"] / row["count"], 2) if row.get("count") else 0.0
+    return rows
+
+
+# ============ Profiling Endpoints ============
+# Profiling is off entirely unless a token is configured
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+profile_store = ProfileStore(db.profiles)
+
+def check_profile_token(request: Request):
+    if not PROFILE_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is not enabled")
+    if not token_matches(request.headers.get("x-profile-token"), PROFILE_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+
+async def find_profile(profile_id: str, fields: Optional[dict] = None) -> dict:
+    report = await profile_store.get(profile_id, fields)
+    if not report:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return report
+
+@api_router.get("/profiles")
+async def list_profiles(request: Request, limit: int = 50):
+    """Recent request profiles, newest first. Needs X-Profile-Token."""
+    check_profile_token(request)
+    return await profile_store.recent(max(1, min(limit, 200)))
+
+@api_router.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    """A profile's summary and allocation top-N; stacks are downloaded separately."""
+    check_profile_token(request)
+    return await find_profile(profile_id, {"cpu_folded": 0, "alloc_folded": 0})
+
+@api_router.get("/profiles/{profile_id}/{kind}.folded")
+async def download_profile_stacks(profile_id: str, kind: str, request: Request):
+    """Folded stacks (`cpu` samples or `alloc` bytes) for flamegraph.pl, speedscope or inferno."""
+    check_profile_token(request)
+    check_choice("kind", kind, ("cpu", "alloc"))
+    report = await find_profile(profile_id, {f"{kind}_folded": 1})
+    return PlainTextResponse(
+        report[f"{kind}_folded"],
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}-{kind}.folded"'},
+    )
 
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Sampled, scrubbed request/response capture for replay.py; innermost, so it sees uncompressed bodies
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR")
+capture_writer = RollingWriter(
+    CAPTURE_DIR,
+    max_bytes=int(os.environ.get("CAPTURE_MAX_FILE_MB", 64)) * 1024 * 1024,
+    max_files=int(os.environ.get("CAPTURE_MAX_FILES", 20)),
+    scrubber=Scrubber(os.environ.get("CAPTURE_SCRUB_KEY", "").encode() or None),
+) if CAPTURE_DIR else None
+if capture_writer:
+    app.add_middleware(
+        CaptureMiddleware,
+        writer=capture_writer,
+        sample_rate=float(os.environ.get("CAPTURE_SAMPLE_RATE", 0.01)),
+    )
+
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    max_body_bytes=int(os.environ.get("MAX_BODY_BYTES", 1024 * 1024)),
+    # Base64 photos and bulk imports are the only legitimately large bodies
+    path_limits={
+        "POST /api/items": int(os.environ.get("MAX_UPLOAD_BYTES", 15 * 1024 * 1024)),
+        "PUT /api/items/{item_id}": int(os.environ.get("MAX_UPLOAD_BYTES", 15 * 1024 * 1024)),
+        "POST /api/items/similar": int(os.environ.get("MAX_ANALYZE_BYTES", 8 * 1024 * 1024)),
+        "POST /api/items/analyze-deposit": int(os.environ.get("MAX_ANALYZE_BYTES", 8 * 1024 * 1024)),
+        "POST /api/items/analyze-deposit/jobs": int(os.environ.get("MAX_ANALYZE_BYTES", 8 * 1024 * 1024)),
+        "POST /api/items/import": int(os.environ.get("MAX_IMPORT_BYTES", 1024 * 1024 * 1024)),
+    },
+)
+
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.environ.get("COMPRESSION_MIN_BYTES", 1024)),
+)
+
+if PROFILE_TOKEN:
+    app.add_middleware(
+        ProfilingMiddleware,
+        token=PROFILE_TOKEN,
+        store=profile_store,
+        interval=float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", 5)) / 1000,
+    )
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -629,8 +1824,114 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def ensure_indexes():
+    # The real-time polling fallback scans by change sequence and settle time
+    for collection in ("transactions", "trades"):
+        await db[collection].create_index("change_seq")
+        await db[collection].create_index("updated_at")
+
+    # Delta sync scans by owner then change sequence / settle time
+    for collection, owner_fields in (
+        ("items", ["owner_id"]),
+        ("transactions", ["user_id"]),
+        ("tombstones", ["user_id"]),
+    ):
+        for field in owner_fields:
+            await db[collection].create_index([(field, 1), ("change_seq", 1)])
+            await db[collection].create_index([(field, 1), ("updated_at", 1)])
+    await db.tombstones.create_index("deleted_at", expireAfterSeconds=int(TOMBSTONE_TTL.total_seconds()))
+    await db.tombstones.create_index([("collection", 1), ("doc_id", 1), ("user_id", 1)])
+
+    # Analytics pipelines open with a $match on these
+    await db.transactions.create_index([("type", 1), ("status", 1), ("created_at", 1)])
+    await db.transactions.create_index([("user_id", 1), ("type", 1), ("created_at", 1)])
+    await db.items.create_index("created_at")
+    await db.items.create_index([("owner_id", 1), ("created_at", 1)])
+    await db.items.create_index([("category", 1), ("condition", 1), ("value", 1)])
+    await db.trades.create_index([("status", 1), ("timestamp", 1)])
+
+    # The archive mover scans hot collections by age; archives serve per-user history
+    await db.transactions.create_index("created_at")
+    await db.trades.create_index("timestamp")
+    await db[archive_name("transactions")].create_index([("user_id", 1), ("created_at", 1)])
+    for field in ("payer_id", "payee_id"):
+        await db[archive_name("trades")].create_index([(field, 1), ("timestamp", 1)])
+    await db.history_summaries.create_index([("user_id", 1), ("collection", 1), ("month", 1)])
+
+    # Sync pages by change_seq, so nothing may be left without one
+    await db.items.create_index("change_seq")
+    await db.items.create_index("photo_hash_chunks")
+    # Visual search refreshers re-read recently updated items
+    await db.items.create_index("updated_at")
+
+    # Item search: text over brand/subcategory/name/description, keyset paging per sort
+    keys, options = search.text_index_spec()
+    await db.items.create_index(keys, **options)
+    await db.items.create_index([("created_at", -1), ("item_id", -1)])
+    await db.items.create_index([("value", 1), ("item_id", 1)])
+    await db.items.create_index([("category", 1), ("created_at", -1), ("item_id", -1)])
+    await db.items.create_index([("category", 1), ("value", 1), ("item_id", 1)])
+    # Login looks users up by name alone now that the PIN check is bcrypt
+    await db.users.create_index("username")
+    await db.users.create_index("user_id")
+    await ownership.ensure_indexes(db)
+    await trade_parties.ensure_indexes(db)
+    await netting.ensure_indexes(db)
+    stamped = await backfill_change_seq(db)
+    if stamped:
+        logger.info(f"Stamped {stamped} documents with a change sequence")
+
+@app.on_event("startup")
+async def start_event_hub():
+    event_hub.start()
+
+@app.on_event("startup")
+async def ensure_rate_limit_indexes():
+    if isinstance(rate_limit_store, MongoStore):
+        await rate_limit_store.ensure_indexes()
+
+@app.on_event("startup")
+async def ensure_profile_indexes():
+    if PROFILE_TOKEN:
+        await profile_store.ensure_indexes()
+
+@app.on_event("startup")
+async def start_job_workers():
+    await job_queue.ensure_indexes()
+    job_queue.start()
+
+@app.on_event("startup")
+async def start_visual_index():
+    visual_index.start()
+
+@app.on_event("startup")
+async def start_archive_mover():
+    if archive_mover.after.days > 0:
+        archive_mover.start()
+
+@app.on_event("startup")
+async def start_slow_query_monitor():
+    if SLOW_QUERY_MS:
+        await slow_query_monitor.ensure_indexes()
+        slow_query_monitor.start()
+
+@app.on_event("startup")
+async def start_settlement_runner():
+    if SETTLEMENT_WINDOW:
+        settlement_runner.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await event_hub.stop()
+    await settlement_runner.stop()
+    await slow_query_monitor.stop()
+    await archive_mover.stop()
+    await visual_index.stop()
+    await job_queue.stop()
+    await sync_drain.drain(float(os.environ.get("SYNC_DRAIN_SECONDS", 25)))
+    if capture_writer:
+        await asyncio.to_thread(capture_writer.close)
     client.close()
 
 
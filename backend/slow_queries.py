@@ -0,0 +1,289 @@
+"""
+Slow-query capture with sampled explain plans.
+
+A pymongo CommandListener on the server's client times every read and
+write command. Those slower than SLOW_QUERY_MS are counted per query
+shape: the collection, operation and filter/sort/pipeline with every value
+replaced by "?", so `{"username": {"$regex": "^bob$"}}` and the same regex
+for "alice" are one shape. Shapes never carry values, which keeps user
+data out of the reports.
+
+Listener callbacks run on Motor's pool threads and only touch in-memory
+counters under a lock. A background task in each worker flushes those
+counters into `slow_queries` (one document per shape, summed across
+workers) and, for a sampled fraction of slow commands whose shape hasn't
+been explained recently, runs `explain` with executionStats on the
+original command. Plans are flagged for:
+
+- collscan: the winning plan scans the collection
+- poor_selectivity: many more documents examined than returned
+- in_memory_sort: the sort isn't served by an index
+
+`GET /api/slow-queries` lists shapes by total time, flagged ones first if
+asked, so a missing index shows up the day the query ships rather than
+when p99 does.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo import UpdateOne, monitoring
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# command -> where its filter lives
+TRACKED = {
+    "find": ("filter",),
+    "aggregate": ("pipeline",),
+    "count": ("query",),
+    "distinct": ("query",),
+    "findAndModify": ("query",),
+    "update": ("updates", "q"),
+    "delete": ("deletes", "q"),
+}
+# The monitor's own writes
+IGNORED_COLLECTIONS = {"slow_queries"}
+# Pipelines that write must never be explained
+WRITE_STAGES = {"$out", "$merge"}
+
+RETENTION = timedelta(days=30)
+POOR_SELECTIVITY_RATIO = 10
+POOR_SELECTIVITY_MIN_EXAMINED = 1000
+
+
+def normalize(value):
+    """Keep the structure of a filter or pipeline, replace every value with "?"."""
+    if isinstance(value, dict):
+        return {key: normalize(inner) for key, inner in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(inner, dict) for inner in value):
+            return [normalize(inner) for inner in value]
+        return ["?"]
+    return "?"
+
+
+def query_of(command_name: str, command: dict):
+    """The filter (or pipeline) part of a command."""
+    field, *nested = TRACKED[command_name]
+    query = command.get(field)
+    if nested and isinstance(query, list) and query:
+        query = query[0].get(nested[0])
+    return query
+
+
+def shape(command_name: str, command: dict) -> dict:
+    described = {"collection": command.get(command_name), "op": command_name}
+    query = query_of(command_name, command)
+    described["pipeline" if command_name == "aggregate" else "filter"] = normalize(query or {})
+    if command.get("sort"):
+        # Sort directions are part of the shape; an index serves one and not the other
+        described["sort"] = dict(command["sort"])
+    if command_name == "distinct":
+        described["key"] = command.get("key")
+    return described
+
+
+def shape_id(described: dict) -> str:
+    return hashlib.sha1(json.dumps(described, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def explain_command(command_name: str, command: dict) -> Optional[dict]:
+    """A read-only command that explains `command`, or None if it can't be explained safely."""
+    collection = command.get(command_name)
+    if command_name == "aggregate":
+        pipeline = command.get("pipeline", [])
+        if any(WRITE_STAGES & set(stage) for stage in pipeline):
+            return None
+        return {"aggregate": collection, "pipeline": pipeline, "cursor": {}}
+    if command_name == "find":
+        inner = {"find": collection, "filter": command.get("filter", {})}
+        for option in ("sort", "limit", "skip", "hint"):
+            if option in command:
+                inner[option] = command[option]
+        return inner
+    if command_name == "distinct":
+        return {"distinct": collection, "key": command.get("key"), "query": command.get("query", {})}
+    # Counts and writes are explained as the find that locates their documents
+    inner = {"find": collection, "filter": query_of(command_name, command) or {}}
+    if command.get("sort"):
+        inner["sort"] = command["sort"]
+    return inner
+
+
+def _walk(node, found: dict):
+    if isinstance(node, dict):
+        if isinstance(node.get("stage"), str):
+            found["stages"].add(node["stage"])
+        stats = node.get("executionStats")
+        if isinstance(stats, dict) and "nReturned" in stats:
+            found["examined"] += stats.get("totalDocsExamined", 0)
+            found["keys_examined"] += stats.get("totalKeysExamined", 0)
+            found["returned"] += stats.get("nReturned", 0)
+        for inner in node.values():
+            _walk(inner, found)
+    elif isinstance(node, list):
+        for inner in node:
+            _walk(inner, found)
+
+
+def summarize_plan(explained: dict) -> dict:
+    """Stages, examined/returned counts and flags from an explain result."""
+    found = {"stages": set(), "examined": 0, "keys_examined": 0, "returned": 0}
+    _walk(explained, found)
+    flags = []
+    if "COLLSCAN" in found["stages"]:
+        flags.append("collscan")
+    if found["examined"] >= POOR_SELECTIVITY_MIN_EXAMINED and \
+            found["examined"] > POOR_SELECTIVITY_RATIO * max(found["returned"], 1):
+        flags.append("poor_selectivity")
+    if "SORT" in found["stages"]:
+        flags.append("in_memory_sort")
+    return {
+        "stages": sorted(found["stages"]),
+        "docs_examined": found["examined"],
+        "keys_examined": found["keys_examined"],
+        "returned": found["returned"],
+        "flags": flags,
+    }
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Times tracked commands; callbacks run on driver threads, so state is behind a lock."""
+
+    def __init__(self, threshold_ms: float = 100, sample_rate: float = 0.1, max_pending: int = 100):
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self._started = {}
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.to_explain = deque(maxlen=max_pending)
+
+    def started(self, event):
+        if event.command_name in TRACKED and event.command.get(event.command_name) not in IGNORED_COLLECTIONS:
+            with self._lock:
+                self._started[event.request_id] = (event.database_name, event.command_name, event.command)
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        with self._lock:
+            started = self._started.pop(event.request_id, None)
+        if started is None:
+            return
+        took_ms = event.duration_micros / 1000
+        if took_ms < self.threshold_ms:
+            return
+        database, command_name, command = started
+        described = shape(command_name, command)
+        key = shape_id(described)
+        with self._lock:
+            stat = self.stats.setdefault(key, {"shape": described, "count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stat["count"] += 1
+            stat["total_ms"] += took_ms
+            stat["max_ms"] = max(stat["max_ms"], took_ms)
+            stat["last_seen"] = datetime.utcnow()
+            if random.random() < self.sample_rate:
+                self.to_explain.append((key, database, command_name, command))
+
+    def drain(self):
+        with self._lock:
+            stats, self.stats = self.stats, {}
+            pending = list(self.to_explain)
+            self.to_explain.clear()
+        return stats, pending
+
+
+class SlowQueryMonitor:
+    """Flushes a listener's counters to `slow_queries` and explains sampled commands."""
+
+    def __init__(self, client, db, listener: SlowQueryListener, interval: float = 10,
+                 explain_every: timedelta = timedelta(minutes=10)):
+        self.client = client
+        self.db = db
+        self.listener = listener
+        self.interval = interval
+        self.explain_every = explain_every
+        self._explained_at = {}
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.flush()
+
+    async def ensure_indexes(self):
+        await self.db.slow_queries.create_index("last_seen", expireAfterSeconds=int(RETENTION.total_seconds()))
+        await self.db.slow_queries.create_index("total_ms")
+
+    async def flush(self):
+        stats, pending = self.listener.drain()
+        if stats:
+            await self.db.slow_queries.bulk_write([
+                UpdateOne({"_id": key}, {
+                    "$setOnInsert": {**stat["shape"], "first_seen": stat["last_seen"]},
+                    "$inc": {"count": stat["count"], "total_ms": stat["total_ms"]},
+                    "$max": {"max_ms": stat["max_ms"]},
+                    "$set": {"last_seen": stat["last_seen"]},
+                }, upsert=True)
+                for key, stat in stats.items()
+            ], ordered=False)
+
+        now = time.monotonic()
+        for key, database, command_name, command in pending:
+            if now - self._explained_at.get(key, -float("inf")) < self.explain_every.total_seconds():
+                continue
+            self._explained_at[key] = now
+            inner = explain_command(command_name, command)
+            if inner is None:
+                continue
+            try:
+                explained = await self.client[database].command(
+                    {"explain": inner, "verbosity": "executionStats"}
+                )
+            except PyMongoError as e:
+                logger.warning(f"Could not explain slow {command_name} on {command.get(command_name)}: {e}")
+                continue
+            plan = summarize_plan(explained)
+            await self.db.slow_queries.update_one(
+                {"_id": key}, {"$set": {"plan": plan, "flags": plan["flags"], "explained_at": datetime.utcnow()}}
+            )
+            if plan["flags"]:
+                logger.warning(f"Slow {command_name} on {command.get(command_name)} flagged {plan['flags']}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except PyMongoError as e:
+                logger.warning(f"Slow query flush failed: {e}")
+
+
+def report_query(flagged: bool = False, collection: Optional[str] = None) -> dict:
+    query = {}
+    if flagged:
+        query["flags.0"] = {"$exists": True}
+    if collection:
+        query["collection"] = collection
+    return query
@@ -0,0 +1,276 @@
+"""
+Compact binary payload for item NFC tags.
+
+Layout (version 1), all multi-byte integers as unsigned LEB128 varints:
+
+    version      1 byte
+    flags        1 byte   FRACTIONAL | HAS_PARENT | HAS_BRAND | HAS_SHARE | *_TEXT escapes
+    item_id      16 bytes raw UUID
+    owner_id     16 bytes raw UUID
+    class        1 byte   category code (5 bits) << 3 | condition code (3 bits)
+    [category]   len-prefixed UTF-8, only when the category code is TEXT_CODE
+    subcategory  1 byte code, or len-prefixed UTF-8 when SUBCATEGORY_TEXT
+    [brand]      same as subcategory, only when HAS_BRAND
+    value        varint, cents
+    [share]      varint, basis points (10000 = whole item), when FRACTIONAL or
+                 HAS_SHARE; a whole, non-fractional item omits it
+    [parent_id]  16 bytes raw UUID, only when HAS_PARENT
+    timestamp    varint, seconds since TAG_EPOCH
+    signature    SIGNATURE_BYTES of HMAC-SHA256 over everything before it
+
+Enum codes are positions in the tuples in valuations.py. A fully populated
+tag with free-text fields at their length cap stays under 180 bytes, well
+inside an NTAG215's 504-byte user area.
+"""
+import hashlib
+import hmac
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from valuations import BRANDS, CATEGORIES, CONDITIONS, SUBCATEGORIES
+
+VERSION = 1
+SIGNATURE_BYTES = 8
+MAX_TEXT_BYTES = 32
+NTAG215_USER_BYTES = 504
+
+TAG_EPOCH = datetime(2024, 1, 1)
+
+FRACTIONAL = 0x01
+HAS_PARENT = 0x02
+HAS_BRAND = 0x04
+SUBCATEGORY_TEXT = 0x08
+BRAND_TEXT = 0x10
+HAS_SHARE = 0x20  # share present on a non-fractional item (e.g. 0 after a full trade)
+KNOWN_FLAGS = FRACTIONAL | HAS_PARENT | HAS_BRAND | SUBCATEGORY_TEXT | BRAND_TEXT | HAS_SHARE
+
+TEXT_CODE = 0x1F  # category escape: free text follows
+NO_CONDITION = 0x07
+
+
+class TagCodecError(ValueError):
+    """The bytes are not a well-formed tag payload."""
+
+
+class TagSignatureError(TagCodecError):
+    """The payload decoded but its signature does not match."""
+
+
+@dataclass(frozen=True)
+class TagPayload:
+    item_id: str
+    owner_id: str
+    category: str
+    subcategory: str
+    value: float
+    timestamp: datetime
+    condition: Optional[str] = None
+    brand: Optional[str] = None
+    share_percentage: float = 1.0
+    is_fractional: bool = False
+    parent_item_id: Optional[str] = None
+
+
+# ============ Primitives ============
+def _write_varint(out: bytearray, value: int):
+    if value < 0:
+        raise TagCodecError("varints are unsigned")
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _write_text(out: bytearray, text: str):
+    raw = text.encode("utf-8")[:MAX_TEXT_BYTES]
+    # Don't leave a split multi-byte character behind the cut
+    raw = raw.decode("utf-8", "ignore").encode("utf-8")
+    out.append(len(raw))
+    out += raw
+
+
+class _Reader:
+    __slots__ = ("data", "pos")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def take(self, count: int) -> bytes:
+        end = self.pos + count
+        if end > len(self.data):
+            raise TagCodecError("payload truncated")
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def byte(self) -> int:
+        return self.take(1)[0]
+
+    def varint(self) -> int:
+        result = 0
+        for shift in range(0, 70, 7):
+            byte = self.byte()
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return result
+        raise TagCodecError("varint too long")
+
+    def text(self) -> str:
+        length = self.byte()
+        if length > MAX_TEXT_BYTES:
+            raise TagCodecError("text field too long")
+        try:
+            return self.take(length).decode("utf-8")
+        except UnicodeDecodeError:
+            raise TagCodecError("text field is not UTF-8")
+
+    def uuid(self) -> str:
+        return str(uuid.UUID(bytes=bytes(self.take(16))))
+
+    def code(self, table: tuple) -> str:
+        code = self.byte()
+        if code >= len(table):
+            raise TagCodecError(f"unknown enum code {code}")
+        return table[code]
+
+
+def _sign(key: bytes, body: bytes) -> bytes:
+    return hmac.new(key, body, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+# ============ Codec ============
+def encode(payload: TagPayload, key: bytes) -> bytes:
+    flags = 0
+    basis_points = round(payload.share_percentage * 10000)
+    if payload.is_fractional:
+        flags |= FRACTIONAL
+    elif basis_points != 10000:
+        flags |= HAS_SHARE
+    if payload.parent_item_id:
+        flags |= HAS_PARENT
+    if payload.brand:
+        flags |= HAS_BRAND
+        if payload.brand not in BRANDS:
+            flags |= BRAND_TEXT
+    if payload.subcategory not in SUBCATEGORIES:
+        flags |= SUBCATEGORY_TEXT
+
+    out = bytearray((VERSION, flags))
+    try:
+        out += uuid.UUID(payload.item_id).bytes
+        out += uuid.UUID(payload.owner_id).bytes
+    except ValueError:
+        raise TagCodecError("item_id and owner_id must be UUIDs")
+
+    category_code = CATEGORIES.index(payload.category) if payload.category in CATEGORIES else TEXT_CODE
+    condition_code = CONDITIONS.index(payload.condition) if payload.condition in CONDITIONS else NO_CONDITION
+    out.append(category_code << 3 | condition_code)
+    if category_code == TEXT_CODE:
+        _write_text(out, payload.category)
+
+    if flags & SUBCATEGORY_TEXT:
+        _write_text(out, payload.subcategory)
+    else:
+        out.append(SUBCATEGORIES.index(payload.subcategory))
+
+    if flags & HAS_BRAND:
+        if flags & BRAND_TEXT:
+            _write_text(out, payload.brand)
+        else:
+            out.append(BRANDS.index(payload.brand))
+
+    _write_varint(out, round(payload.value * 100))
+    if flags & (FRACTIONAL | HAS_SHARE):
+        _write_varint(out, basis_points)
+    if flags & HAS_PARENT:
+        try:
+            out += uuid.UUID(payload.parent_item_id).bytes
+        except ValueError:
+            raise TagCodecError("parent_item_id must be a UUID")
+    _write_varint(out, max(0, int((payload.timestamp - TAG_EPOCH).total_seconds())))
+
+    out += _sign(key, bytes(out))
+    return bytes(out)
+
+
+def decode(data: bytes, key: Optional[bytes] = None) -> TagPayload:
+    """
+    Parse a tag payload. With `key`, the signature is checked as well and a
+    mismatch raises TagSignatureError. Any malformed input raises
+    TagCodecError and nothing else.
+    """
+    reader = _Reader(data)
+    version = reader.byte()
+    if version != VERSION:
+        raise TagCodecError(f"unsupported tag version {version}")
+    flags = reader.byte()
+    if flags & ~KNOWN_FLAGS:
+        raise TagCodecError("unknown flags set")
+
+    item_id = reader.uuid()
+    owner_id = reader.uuid()
+
+    packed = reader.byte()
+    category_code, condition_code = packed >> 3, packed & 0x07
+    if category_code == TEXT_CODE:
+        category = reader.text()
+    elif category_code < len(CATEGORIES):
+        category = CATEGORIES[category_code]
+    else:
+        raise TagCodecError(f"unknown category code {category_code}")
+    if condition_code == NO_CONDITION:
+        condition = None
+    elif condition_code < len(CONDITIONS):
+        condition = CONDITIONS[condition_code]
+    else:
+        raise TagCodecError(f"unknown condition code {condition_code}")
+
+    subcategory = reader.text() if flags & SUBCATEGORY_TEXT else reader.code(SUBCATEGORIES)
+
+    brand = None
+    if flags & HAS_BRAND:
+        brand = reader.text() if flags & BRAND_TEXT else reader.code(BRANDS)
+    elif flags & BRAND_TEXT:
+        raise TagCodecError("brand text flag without brand")
+
+    value = reader.varint() / 100
+    share = 1.0
+    if flags & (FRACTIONAL | HAS_SHARE):
+        basis_points = reader.varint()
+        if basis_points > 10000:
+            raise TagCodecError("share above 100%")
+        share = basis_points / 10000
+    parent_item_id = reader.uuid() if flags & HAS_PARENT else None
+    seconds = reader.varint()
+    try:
+        timestamp = TAG_EPOCH + timedelta(seconds=seconds)
+    except OverflowError:
+        raise TagCodecError("timestamp out of range")
+
+    body_end = reader.pos
+    signature = reader.take(SIGNATURE_BYTES)
+    if reader.pos != len(data):
+        raise TagCodecError("trailing bytes after signature")
+    if key is not None and not hmac.compare_digest(signature, _sign(key, bytes(data[:body_end]))):
+        raise TagSignatureError("signature mismatch")
+
+    return TagPayload(
+        item_id=item_id,
+        owner_id=owner_id,
+        category=category,
+        subcategory=subcategory,
+        value=value,
+        timestamp=timestamp,
+        condition=condition,
+        brand=brand,
+        share_percentage=share,
+        is_fractional=bool(flags & FRACTIONAL),
+        parent_item_id=parent_item_id,
+    )
@@ -0,0 +1,134 @@
+"""
+Per-party index of trades.
+
+A trade involves two users, so "trades of user X" used to be
+`{"$or": [{"payer_id": X}, {"payee_id": X}]}`: two index scans and a
+merge, and a scatter-gather on a cluster sharded by user. Every trade now
+also writes one small entry per side to `trade_parties`, keyed by
+`user_id`:
+
+    {user_id, role, trade_id, counterparty, total_value, timestamp, change_seq, updated_at}
+
+A user's trade history, delta sync page or export is then one range scan
+over their own entries, followed by a fetch of the trades by `trade_id`.
+Entries carry the trade's change stamps, so sync filters them exactly as
+it would the trades.
+
+Entries are written before the trade, so a trade is never stored without
+them; an entry whose trade never landed is simply skipped on read. They
+move to `trade_parties_archive` together with their trades (see
+archive.py).
+
+    python trade_parties.py   # once, before serving: index trades that predate this
+"""
+from typing import AsyncIterator, Optional
+
+from pymongo import ReplaceOne
+
+import money
+from archive import archive_name
+
+PARTIES = "trade_parties"
+ROLES = (("payer", "payer_id", "payee_id"), ("payee", "payee_id", "payer_id"))
+FETCH_BATCH = 500
+
+
+def parties_of(trades_collection: str) -> str:
+    """The entry collection serving a trades collection (hot or archive)."""
+    return archive_name(PARTIES) if trades_collection == archive_name("trades") else PARTIES
+
+
+def entries(trade: dict) -> list:
+    """One entry per side; a trade with oneself gets just the one."""
+    sides = ROLES if trade["payer_id"] != trade["payee_id"] else ROLES[:1]
+    return [
+        {
+            "_id": f"{trade['trade_id']}:{role}",
+            "user_id": trade[own],
+            "role": role,
+            "trade_id": trade["trade_id"],
+            "counterparty": trade[other],
+            "total_value": money.decimal(trade["total_value"]),
+            "timestamp": trade["timestamp"],
+            "change_seq": trade.get("change_seq"),
+            "updated_at": trade.get("updated_at"),
+        }
+        for role, own, other in sides
+    ]
+
+
+async def record(db, trade: dict, collection: str = PARTIES):
+    """Write a trade's entries; idempotent, so a retried write is harmless."""
+    await db[collection].bulk_write(
+        [ReplaceOne({"_id": entry["_id"]}, entry, upsert=True) for entry in entries(trade)], ordered=False
+    )
+
+
+async def user_trades(db, user_id: str, trades_collection: str = "trades", limit: Optional[int] = None,
+                      batch_size: int = FETCH_BATCH) -> AsyncIterator[dict]:
+    """A user's trades, oldest first, read through their entries."""
+    cursor = db[parties_of(trades_collection)].find({"user_id": user_id}, {"_id": 0, "trade_id": 1}).sort("timestamp", 1)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    batch = []
+    async for entry in cursor:
+        batch.append(entry["trade_id"])
+        if len(batch) == batch_size:
+            for trade in await fetch(db, batch, trades_collection):
+                yield trade
+            batch = []
+    if batch:
+        for trade in await fetch(db, batch, trades_collection):
+            yield trade
+
+
+async def fetch(db, trade_ids: list, trades_collection: str = "trades") -> list:
+    """Trades by id in the order given; ids whose trade never landed are skipped."""
+    found = {
+        trade["trade_id"]: trade
+        async for trade in db[trades_collection].find({"trade_id": {"$in": trade_ids}})
+    }
+    return [found[trade_id] for trade_id in trade_ids if trade_id in found]
+
+
+async def ensure_indexes(db):
+    for name in (PARTIES, archive_name(PARTIES)):
+        await db[name].create_index([("user_id", 1), ("timestamp", 1)])
+        await db[name].create_index([("user_id", 1), ("change_seq", 1)])
+        await db[name].create_index([("user_id", 1), ("updated_at", 1)])
+        await db[name].create_index("trade_id")
+    for name in ("trades", archive_name("trades")):
+        await db[name].create_index("trade_id")
+
+
+async def backfill(db, batch_size: int = 1000) -> int:
+    """Write entries for every stored trade, hot and archived; safe to re-run."""
+    indexed = 0
+    for trades_collection in ("trades", archive_name("trades")):
+        batch = []
+        async for trade in db[trades_collection].find(
+            {}, {"trade_id": 1, "payer_id": 1, "payee_id": 1, "total_value": 1, "timestamp": 1,
+                 "change_seq": 1, "updated_at": 1}
+        ):
+            batch.extend(ReplaceOne({"_id": entry["_id"]}, entry, upsert=True) for entry in entries(trade))
+            indexed += 1
+            if len(batch) >= batch_size:
+                await db[parties_of(trades_collection)].bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            await db[parties_of(trades_collection)].bulk_write(batch, ordered=False)
+    return indexed
+
+
+if __name__ == "__main__":
+    import asyncio
+    import os
+    from pathlib import Path
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / ".env")
+    database = AsyncIOMotorClient(os.environ["MONGO_URL"])[os.environ["DB_NAME"]]
+    print(f"Indexed {asyncio.run(backfill(database))} trades by party")
@@ -0,0 +1,82 @@
+"""
+Valuation tables and the fixed vocabularies items are described with.
+
+The tuples below double as wire enums for the NFC tag codec: a value's
+position is its code, so entries may only ever be appended.
+"""
+
+# Mock valuation table
+VALUATIONS = {
+    "clothing": {
+        "shirt": {"Nike": 30, "Adidas": 25, "Puma": 20, "Generic": 10},
+        "pants": {"Nike": 40, "Adidas": 35, "Puma": 30, "Generic": 15},
+        "jacket": {"Nike": 80, "Adidas": 70, "Puma": 60, "Generic": 25},
+        "shorts": {"Nike": 25, "Adidas": 20, "Puma": 18, "Generic": 8}
+    },
+    "shoes": {
+        "sneakers": {"Nike": 80, "Adidas": 70, "Puma": 60, "Generic": 30},
+        "boots": {"Nike": 100, "Adidas": 90, "Puma": 80, "Generic": 40},
+        "sandals": {"Nike": 30, "Adidas": 25, "Puma": 20, "Generic": 10}
+    },
+    "accessories": {
+        "watch": {"Rolex": 5000, "Casio": 50, "Generic": 20},
+        "bag": {"Nike": 50, "Adidas": 45, "Generic": 15},
+        "hat": {"Nike": 25, "Adidas": 20, "Generic": 8}
+    },
+    "electronics": {
+        "phone": {"Apple": 800, "Samsung": 600, "Generic": 200},
+        "tablet": {"Apple": 500, "Samsung": 350, "Generic": 150},
+        "laptop": {"Apple": 1200, "Dell": 800, "Generic": 400}
+    }
+}
+
+CONDITION_MULTIPLIERS = {
+    "new": 1.0,
+    "excellent": 0.9,
+    "good": 0.7,
+    "fair": 0.5,
+    "poor": 0.3
+}
+
+# Append-only: positions are wire codes
+CATEGORIES = (
+    "clothing", "shoes", "accessories", "electronics", "furniture",
+    "jewelry", "sports", "tools", "books", "toys",
+)
+
+CONDITIONS = ("new", "excellent", "good", "fair", "poor")
+
+SUBCATEGORIES = (
+    "shirt", "pants", "jacket", "shorts",
+    "sneakers", "boots", "sandals",
+    "watch", "bag", "hat", "sunglasses",
+    "phone", "tablet", "laptop", "headphones",
+    "item",
+)
+
+BRANDS = (
+    "Generic", "Nike", "Adidas", "Puma", "Rolex", "Casio",
+    "Apple", "Samsung", "Dell",
+)
+
+
+def mock_value(category: str, subcategory: str, brand: str, condition: str) -> dict:
+    # Get base value
+    base_value = 10  # default
+    if category in VALUATIONS:
+        if subcategory in VALUATIONS[category]:
+            if brand in VALUATIONS[category][subcategory]:
+                base_value = VALUATIONS[category][subcategory][brand]
+            else:
+                base_value = VALUATIONS[category][subcategory].get("Generic", 10)
+
+    # Apply condition multiplier
+    multiplier = CONDITION_MULTIPLIERS.get(condition, 0.7)
+    final_value = round(base_value * multiplier, 2)
+
+    return {
+        "value": final_value,
+        "currency": "USD",
+        "base_value": base_value,
+        "condition_multiplier": multiplier
+    }
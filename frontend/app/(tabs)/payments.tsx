@@ -24,6 +24,7 @@ import { useAuthStore } from "../../src/store/authStore";
 import { useItemStore } from "../../src/store/itemStore";
 import { useTransactionStore } from "../../src/store/transactionStore";
 import UserService from "../../src/services/UserService";
+import { subscribeToUserEvents } from "../../src/services/EventStreamService";
 import LottieView from "lottie-react-native";
 import * as Clipboard from "expo-clipboard";
 import * as Linking from "expo-linking";
@@ -49,9 +50,17 @@ export default function PaymentsScreen() {
 
   useFocusEffect(
     useCallback(() => {
-      if (user?.user_id) {
-        fetchItems(user.user_id);
-      }
+      if (!user?.user_id) return;
+      fetchItems(user.user_id);
+
+      // Incoming payments and trades are pushed instead of re-polled
+      const userId = user.user_id;
+      return subscribeToUserEvents(userId, {
+        onEvent: () => {
+          fetchItems(userId);
+          useAuthStore.getState().refreshUser();
+        },
+      });
     }, [user?.user_id, fetchItems]),
   );
 
@@ -23,6 +23,10 @@ import {
   useTransactionStore,
   SpentItem,
 } from "../../src/store/transactionStore";
+import {
+  VisualSearchService,
+  SimilarItem,
+} from "../../src/services/VisualSearchService";
 import * as Clipboard from "expo-clipboard";
 import AsyncStorage from "@react-native-async-storage/async-storage";
 
@@ -121,6 +125,9 @@ export default function ShoppingScreen() {
   );
   const [shippingModalVisible, setShippingModalVisible] = useState(false);
   const [showShippingLabel, setShowShippingLabel] = useState(false);
+  const [similarSourceId, setSimilarSourceId] = useState<string | null>(null);
+  const [similarItems, setSimilarItems] = useState<SimilarItem[]>([]);
+  const [similarLoading, setSimilarLoading] = useState(false);
 
   // Hide tab bar when in webview, show when in store selection
   useEffect(() => {
@@ -350,6 +357,22 @@ export default function ShoppingScreen() {
     ],
   );
 
+  const handleFindSimilar = async (itemId: string) => {
+    setSimilarSourceId(itemId);
+    setSimilarItems([]);
+    setSimilarLoading(true);
+    try {
+      setSimilarItems(
+        await VisualSearchService.findSimilarItems(itemId, user?.user_id),
+      );
+    } catch (error) {
+      console.log("Similar item search failed:", error);
+      Alert.alert("Error", "Couldn't find similar items. Please try again.");
+    } finally {
+      setSimilarLoading(false);
+    }
+  };
+
   const handleStorePress = (storeUrl: string) => {
     setUrl(storeUrl);
     setSearchText("");
@@ -703,6 +726,61 @@ export default function ShoppingScreen() {
               </TouchableOpacity>
             ))}
           </View>
+
+          {items.length > 0 && (
+            <View style={styles.similarSection}>
+              <Text style={styles.similarTitle}>Find similar items</Text>
+              <Text style={styles.similarSubtitle}>
+                Tap one of your items to see lookalikes on Brail
+              </Text>
+              <ScrollView horizontal showsHorizontalScrollIndicator={false}>
+                {items.map((item) => (
+                  <TouchableOpacity
+                    key={item.item_id}
+                    onPress={() => handleFindSimilar(item.item_id)}
+                    style={[
+                      styles.similarThumb,
+                      similarSourceId === item.item_id &&
+                        styles.similarThumbSelected,
+                    ]}
+                  >
+                    <Image
+                      source={{ uri: item.photo }}
+                      style={styles.similarPhoto}
+                    />
+                  </TouchableOpacity>
+                ))}
+              </ScrollView>
+
+              {similarLoading && (
+                <ActivityIndicator style={styles.similarLoading} />
+              )}
+              {!similarLoading &&
+                similarSourceId &&
+                similarItems.length === 0 && (
+                  <Text style={styles.similarSubtitle}>
+                    No similar items yet
+                  </Text>
+                )}
+              <ScrollView horizontal showsHorizontalScrollIndicator={false}>
+                {similarItems.map(({ item, similarity }) => (
+                  <View key={item.item_id} style={styles.similarCard}>
+                    <Image
+                      source={{ uri: item.photo }}
+                      style={styles.similarPhoto}
+                    />
+                    <Text style={styles.similarName} numberOfLines={1}>
+                      {item.brand} {item.subcategory}
+                    </Text>
+                    <Text style={styles.similarMeta}>
+                      ${item.value.toFixed(2)} •{" "}
+                      {Math.round(similarity * 100)}% match
+                    </Text>
+                  </View>
+                ))}
+              </ScrollView>
+            </View>
+          )}
         </ScrollView>
       </SafeAreaView>
     );
@@ -1016,6 +1094,58 @@ const styles = StyleSheet.create({
     color: "#000000",
     textAlign: "center",
   },
+  similarSection: {
+    marginTop: 8,
+  },
+  similarTitle: {
+    fontSize: 20,
+    fontWeight: "bold",
+    color: "#000000",
+    marginBottom: 4,
+  },
+  similarSubtitle: {
+    fontSize: 14,
+    color: "#8E8E93",
+    marginBottom: 12,
+  },
+  similarThumb: {
+    marginRight: 12,
+    marginBottom: 16,
+    borderRadius: 12,
+    borderWidth: 2,
+    borderColor: "transparent",
+  },
+  similarThumbSelected: {
+    borderColor: "#007AFF",
+  },
+  similarPhoto: {
+    width: 80,
+    height: 80,
+    borderRadius: 10,
+    backgroundColor: "#E5E5EA",
+  },
+  similarLoading: {
+    marginVertical: 12,
+  },
+  similarCard: {
+    width: 104,
+    marginRight: 12,
+    backgroundColor: "#FFFFFF",
+    borderRadius: 12,
+    padding: 12,
+    alignItems: "center",
+  },
+  similarName: {
+    fontSize: 13,
+    fontWeight: "600",
+    color: "#000000",
+    marginTop: 8,
+  },
+  similarMeta: {
+    fontSize: 12,
+    color: "#8E8E93",
+    marginTop: 2,
+  },
   searchContainer: {
     backgroundColor: "#FFFFFF",
     paddingHorizontal: 16,
@@ -19,6 +19,8 @@ import { useTransactionStore } from "../../src/store/transactionStore";
 import axios from "axios";
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL;
+const JOB_POLL_INTERVAL_MS = 1500;
+const ANALYSIS_TIMEOUT_MS = 120000;
 
 interface AnalysisResult {
   name: string;
@@ -28,6 +30,7 @@ interface AnalysisResult {
   brand: string;
   estimated_value: number;
   condition: string;
+  possible_duplicates?: string[];
 }
 
 export default function ConfirmDeposit() {
@@ -58,13 +61,41 @@ export default function ConfirmDeposit() {
     setError(null);
 
     try {
-      const response = await axios.post(
-        `${API_URL}/api/items/analyze-deposit`,
+      // Queue the analysis and poll for it, so a dropped connection or a
+      // slow upstream doesn't lose the result
+      const submitted = await axios.post(
+        `${API_URL}/api/items/analyze-deposit/jobs`,
         { image_base64: photo },
-        { timeout: 60000 }, // 60 second timeout
+        { timeout: 30000 },
       );
+      const jobId = submitted.data.job_id;
 
-      setAnalysis(response.data);
+      const deadline = Date.now() + ANALYSIS_TIMEOUT_MS;
+      while (Date.now() < deadline) {
+        await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+        try {
+          const { data: job } = await axios.get(`${API_URL}/api/jobs/${jobId}`, {
+            timeout: 10000,
+          });
+          if (job.status === "succeeded") {
+            setAnalysis(job.result);
+            if (job.result.possible_duplicates?.length) {
+              Alert.alert(
+                "Already Deposited?",
+                "This photo looks like an item that's already on the platform. You can still deposit it if it's a different item."
+              );
+            }
+            return;
+          }
+          if (job.status === "failed") {
+            throw { response: { data: { detail: job.error } } };
+          }
+        } catch (pollError: any) {
+          // Transient network errors just mean we ask again
+          if (pollError.response) throw pollError;
+        }
+      }
+      throw new Error("Analysis timed out");
     } catch (err: any) {
       console.error("Analysis failed:", err);
       const errorMessage =
@@ -95,6 +126,8 @@ export default function ConfirmDeposit() {
         condition: analysis.condition,
         photo,
         value: analysis.estimated_value,
+        name: analysis.name,
+        description: analysis.description,
         is_fractional: false,
         share_percentage: 1.0,
       });
@@ -21,6 +21,8 @@ import { OfflineTradeService } from "../../src/services/OfflineTradeService";
 import LottieView from "lottie-react-native";
 import NFCService from "../../src/services/NFCService";
 import { isNFCAvailable } from "../../src/services/NFCManager";
+import { subscribeToUserEvents } from "../../src/services/EventStreamService";
+import { PaymentPlanService } from "../../src/services/PaymentPlanService";
 
 export default function AcceptPayment() {
   const router = useRouter();
@@ -345,101 +347,37 @@ export default function AcceptPayment() {
         return;
       }
 
-      const { fetchItems } = useItemStore.getState();
-
       // Parse payment amount
       const amountNum = parseFloat(amount || "0");
       console.log("Payment amount:", amountNum);
 
-      // Fetch all customer's items
-      console.log("Fetching customer items for:", customerIdFromTag);
-      await fetchItems(customerIdFromTag);
-      const { items: updatedItems } = useItemStore.getState();
-
-      console.log("Total items in store after fetch:", updatedItems.length);
-
-      const customerItems = updatedItems.filter(
-        (item) => item.owner_id === customerIdFromTag,
-      );
-
-      console.log(
-        "Customer has",
-        customerItems.length,
-        "items after filtering",
-      );
-      console.log(
-        "Customer items:",
-        customerItems.map((i) => ({
-          id: i.item_id,
-          owner: i.owner_id,
-          value: i.value,
-          name: `${i.brand} ${i.subcategory}`,
-        })),
-      );
-
-      // Calculate total value
-      const totalCustomerValue = customerItems.reduce(
-        (sum, item) => sum + item.value,
-        0,
-      );
-
-      console.log("Customer total value:", totalCustomerValue);
-
-      if (totalCustomerValue < amountNum) {
-        console.error("Insufficient funds:", {
-          required: amountNum,
-          available: totalCustomerValue,
-          customerItems: customerItems.length,
-          allItems: updatedItems.length,
-        });
-
-        // Check if this is a dev mode / same device issue
-        const isDev = process.env.EXPO_PUBLIC_DEV_BYPASS === "true";
-        const warningMessage = isDev
-          ? `Customer doesn't have enough items to cover $${amount}.\n\nCustomer balance: $${totalCustomerValue.toFixed(2)}\n\n⚠️ DEV MODE: Items don't sync between devices. You need to:\n- Use the same device (scan as customer, then as merchant)\n- Or use a real backend server`
-          : `Customer doesn't have enough items to cover $${amount}.\n\nCustomer balance: $${totalCustomerValue.toFixed(2)}`;
-
-        Alert.alert("Insufficient Funds", warningMessage, [{ text: "OK" }]);
-        return;
-      }
-
-      // Auto-select items to cover payment
-      const itemsToTransfer: any[] = [];
-      let runningTotal = 0;
-
-      const sortedItems = [...customerItems].sort((a, b) => b.value - a.value);
-
-      for (const item of sortedItems) {
-        if (runningTotal >= amountNum) break;
-
-        const remainingAmount = amountNum - runningTotal;
-
-        if (item.value <= remainingAmount) {
-          // Transfer 100% of item
-          itemsToTransfer.push({
-            item_id: item.item_id,
-            item_name: `${item.brand} ${item.subcategory}`,
-            share_percentage: 1.0,
-            value: item.value,
-            previous_owner: customerIdFromTag,
-            new_owner: merchantId,
-          });
-          runningTotal += item.value;
-        } else if (runningTotal < amountNum) {
-          // Transfer partial item
-          const percentage = remainingAmount / item.value;
-          itemsToTransfer.push({
-            item_id: item.item_id,
-            item_name: `${item.brand} ${item.subcategory}`,
-            share_percentage: percentage,
-            value: remainingAmount,
-            previous_owner: customerIdFromTag,
-            new_owner: merchantId,
-          });
-          runningTotal += remainingAmount;
+      // The server picks which of the customer's items cover the amount
+      let plan;
+      try {
+        plan = await PaymentPlanService.planPayment(
+          customerIdFromTag,
+          merchantId as string,
+          amountNum,
+        );
+      } catch (planError: any) {
+        if (planError.response?.status === 400) {
+          setNfcScanning(false);
+          Alert.alert(
+            "Insufficient Funds",
+            `Customer doesn't have enough items to cover $${amount}.\n\n${planError.response.data?.detail || ""}`,
+            [{ text: "OK" }],
+          );
+          return;
         }
+        throw planError;
       }
 
+      const labels = new Map(plan.items.map((item) => [item.item_id, item.label]));
+      const itemsToTransfer = plan.trade_items.map((item) => ({
+        ...item,
+        item_name: labels.get(item.item_id) || "Item",
+      }));
+
       console.log("Items to transfer:", itemsToTransfer);
 
       // Store for confirmation screen
@@ -485,6 +423,18 @@ export default function AcceptPayment() {
     initializeNFC();
   }, []);
 
+  useEffect(() => {
+    if (!merchantId) return;
+    // Trades landing for the merchant (e.g. a synced offline payment) refresh
+    // inventory and balance as soon as the backend records them
+    return subscribeToUserEvents(merchantId as string, {
+      onEvent: () => {
+        useItemStore.getState().fetchItems(merchantId as string);
+        useAuthStore.getState().refreshUser();
+      },
+    });
+  }, [merchantId]);
+
   useEffect(() => {
     // Auto-start NFC scanning when screen loads
     const startNFCScanning = async () => {
@@ -0,0 +1,84 @@
+import { API_URL } from '../config/api';
+
+export type StreamEventType = 'trade' | 'transaction';
+
+export interface StreamHandlers {
+  onEvent: (type: StreamEventType, data: any) => void;
+  onOpen?: () => void;
+}
+
+const MAX_RETRY_DELAY_MS = 30000;
+
+/**
+ * Subscribe to the backend's Server-Sent Events stream for a user.
+ *
+ * React Native has no EventSource, so this reads the stream through
+ * XMLHttpRequest progress events and parses the SSE frames by hand.
+ * Reconnects with exponential backoff until the returned function is called.
+ */
+export function subscribeToUserEvents(userId: string, handlers: StreamHandlers): () => void {
+  let xhr: XMLHttpRequest | null = null;
+  let retryTimer: ReturnType<typeof setTimeout> | null = null;
+  let retryDelay = 1000;
+  let closed = false;
+
+  const connect = () => {
+    if (closed) return;
+
+    let consumed = 0;
+    let buffer = '';
+    xhr = new XMLHttpRequest();
+    xhr.open('GET', `${API_URL}/api/events/user/${encodeURIComponent(userId)}`);
+    xhr.setRequestHeader('Accept', 'text/event-stream');
+    xhr.setRequestHeader('Cache-Control', 'no-cache');
+
+    xhr.onprogress = () => {
+      if (!xhr) return;
+      if (consumed === 0) {
+        retryDelay = 1000;
+        handlers.onOpen?.();
+      }
+      buffer += xhr.responseText.substring(consumed);
+      consumed = xhr.responseText.length;
+
+      const frames = buffer.split('\n\n');
+      buffer = frames.pop() ?? '';
+      for (const frame of frames) {
+        let type: string | null = null;
+        const dataLines: string[] = [];
+        for (const line of frame.split('\n')) {
+          if (line.startsWith('event:')) type = line.slice(6).trim();
+          else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+        }
+        if ((type === 'trade' || type === 'transaction') && dataLines.length) {
+          try {
+            handlers.onEvent(type, JSON.parse(dataLines.join('\n')));
+          } catch (error) {
+            console.error('[EventStream] Bad event payload:', error);
+          }
+        }
+      }
+    };
+
+    const scheduleReconnect = () => {
+      if (closed) return;
+      retryTimer = setTimeout(connect, retryDelay);
+      retryDelay = Math.min(retryDelay * 2, MAX_RETRY_DELAY_MS);
+    };
+    xhr.onerror = scheduleReconnect;
+    xhr.onload = scheduleReconnect;
+
+    xhr.send();
+  };
+
+  connect();
+
+  return () => {
+    closed = true;
+    if (retryTimer) clearTimeout(retryTimer);
+    xhr?.abort();
+    xhr = null;
+  };
+}
+
+export default { subscribeToUserEvents };
@@ -0,0 +1,54 @@
+import axios from 'axios';
+import { API_URL } from '../config/api';
+
+export interface PlannedTradeItem {
+  item_id: string;
+  share_percentage: number;
+  value: number;
+  previous_owner: string;
+  new_owner: string;
+}
+
+export interface PaymentPlan {
+  payer_id: string;
+  amount: number;
+  items: { item_id: string; label?: string; amount: number; fraction: number }[];
+  trade_items: PlannedTradeItem[];
+  split_count: number;
+}
+
+export interface PaymentPlanOptions {
+  excludeItemIds?: string[];
+  preferItemIds?: string[];
+  noSplitItemIds?: string[];
+}
+
+export const PaymentPlanService = {
+  /**
+   * Items the payer should spend on `amount`, chosen on the server: whole
+   * items where they add up exactly, otherwise one item split for the rest.
+   * Rejects with a 400 when the payer's items can't cover the amount.
+   */
+  async planPayment(
+    payerId: string,
+    payeeId: string,
+    amount: number,
+    options: PaymentPlanOptions = {},
+  ): Promise<PaymentPlan> {
+    const response = await axios.post(
+      `${API_URL}/api/payments/plan`,
+      {
+        payer_id: payerId,
+        payee_id: payeeId,
+        amount,
+        exclude_item_ids: options.excludeItemIds ?? [],
+        prefer_item_ids: options.preferItemIds ?? [],
+        no_split_item_ids: options.noSplitItemIds ?? [],
+      },
+      { timeout: 10000 },
+    );
+    return response.data;
+  },
+};
+
+export default PaymentPlanService;
@@ -0,0 +1,41 @@
+import axios from 'axios';
+import { API_URL } from '../config/api';
+
+export interface SimilarItem {
+  item: {
+    item_id: string;
+    owner_id: string;
+    category: string;
+    subcategory: string;
+    brand: string;
+    condition: string;
+    photo: string;
+    value: number;
+  };
+  similarity: number;
+}
+
+export const VisualSearchService = {
+  /**
+   * Items on the platform whose photos look like this item's, most similar
+   * first. Pass the shopper's id to leave out items they already own.
+   */
+  async findSimilarItems(itemId: string, excludeOwnerId?: string, limit = 10): Promise<SimilarItem[]> {
+    const response = await axios.get(`${API_URL}/api/items/${itemId}/similar`, {
+      params: { limit, exclude_owner_id: excludeOwnerId },
+      timeout: 10000,
+    });
+    return response.data;
+  },
+
+  async findItemsLikePhoto(imageBase64: string, excludeOwnerId?: string, limit = 10): Promise<SimilarItem[]> {
+    const response = await axios.post(
+      `${API_URL}/api/items/similar`,
+      { image_base64: imageBase64 },
+      { params: { limit, exclude_owner_id: excludeOwnerId }, timeout: 20000 }
+    );
+    return response.data;
+  },
+};
+
+export default VisualSearchService;
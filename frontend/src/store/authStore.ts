@@ -10,7 +10,7 @@ const DEV_BYPASS = process.env.EXPO_PUBLIC_DEV_BYPASS === 'true';
 interface User {
   user_id: string;
   username: string;
-  pin_hash: string;
+  pin_hash?: string;
   biometric_enabled: boolean;
   balance?: number;
   first_name?: string | null;
@@ -25,6 +25,21 @@ interface User {
   country?: string | null;
 }
 
+interface Session {
+  access_token: string;
+  refresh_token: string;
+  expires_in: number;
+  user: User;
+}
+
+const applyToken = (token: string | null) => {
+  if (token) {
+    axios.defaults.headers.common.Authorization = `Bearer ${token}`;
+  } else {
+    delete axios.defaults.headers.common.Authorization;
+  }
+};
+
 interface AuthState {
   user: User | null;
   token: string | null;
@@ -35,6 +50,8 @@ interface AuthState {
   checkAuth: () => Promise<void>;
   hashPin: (pin: string) => Promise<string>;
   setUser: (user: User | null, pinHash?: string) => Promise<void>;
+  setSession: (session: Session) => Promise<void>;
+  refreshSession: () => Promise<boolean>;
   refreshUser: () => Promise<void>;
 }
 
@@ -61,10 +78,37 @@ export const useAuthStore = create<AuthState>((set, get) => ({
       return;
     }
 
-    await AsyncStorage.multiRemove(['user', 'pin_hash']);
+    await AsyncStorage.multiRemove(['user', 'pin_hash', 'access_token', 'refresh_token']);
+    applyToken(null);
     set({ user: null, token: null });
   },
 
+  setSession: async (session: Session) => {
+    await AsyncStorage.multiSet([
+      ['access_token', session.access_token],
+      ['refresh_token', session.refresh_token],
+    ]);
+    applyToken(session.access_token);
+    set({ token: session.access_token });
+  },
+
+  // Swap the stored refresh token for a new pair; false if signed out or it was rejected
+  refreshSession: async () => {
+    const refreshToken = await AsyncStorage.getItem('refresh_token');
+    if (!refreshToken || DEV_BYPASS) {
+      return false;
+    }
+    try {
+      const response = await axios.post(`${API_URL}/api/auth/refresh`, { refresh_token: refreshToken });
+      await get().setSession(response.data);
+      await get().setUser(response.data.user);
+      return true;
+    } catch (error) {
+      console.error('[AuthStore] Session refresh failed:', error);
+      return false;
+    }
+  },
+
   register: async (username: string, pin: string) => {
     set({ isLoading: true });
     try {
@@ -75,11 +119,17 @@ export const useAuthStore = create<AuthState>((set, get) => ({
         console.log('[DEV BYPASS] Registering user with mock API');
         user = await MockAPIService.registerUser({ username, pin_hash: pinHash });
       } else {
-        const response = await axios.post(`${API_URL}/api/users/register`, {
+        await axios.post(`${API_URL}/api/users/register`, {
+          username,
+          pin_hash: pinHash,
+        });
+        // Registration doesn't sign in; log in for a token pair
+        const response = await axios.post(`${API_URL}/api/users/login`, {
           username,
           pin_hash: pinHash,
         });
-        user = response.data;
+        await get().setSession(response.data);
+        user = response.data.user;
       }
 
       await get().setUser(user, pinHash);
@@ -104,7 +154,8 @@ export const useAuthStore = create<AuthState>((set, get) => ({
           username,
           pin_hash: pinHash,
         });
-        user = response.data;
+        await get().setSession(response.data);
+        user = response.data.user;
       }
 
       await get().setUser(user, pinHash);
@@ -124,7 +175,11 @@ export const useAuthStore = create<AuthState>((set, get) => ({
       const userStr = await AsyncStorage.getItem('user');
       if (userStr) {
         const user = JSON.parse(userStr);
-        set({ user });
+        const token = await AsyncStorage.getItem('access_token');
+        applyToken(token);
+        set({ user, token });
+        // Access tokens are short-lived; renew on app start rather than on the first 401
+        await get().refreshSession();
       }
     } catch (error) {
       console.error('Auth check failed:', error);
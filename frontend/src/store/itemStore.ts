@@ -14,6 +14,8 @@ interface Item {
   condition: string;
   photo: string;
   value: number;
+  name?: string;
+  description?: string;
   is_fractional: boolean;
   share_percentage: number;
   parent_item_id?: string;
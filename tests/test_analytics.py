@@ -0,0 +1,44 @@
+import analytics
+from analytics import ResultCache
+
+
+def test_cache_expires_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(analytics.time, "monotonic", lambda: now[0])
+    cache = ResultCache(ttl=60)
+    cache.put("spend", [{"total": 1}])
+
+    now[0] += 59
+    assert cache.get("spend") == [{"total": 1}]
+    now[0] += 1
+    assert cache.get("spend") is None
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ResultCache(max_entries=2)
+    cache.put("a", [])
+    cache.put("b", [])
+    cache.get("a")
+    cache.put("c", [])
+
+    assert cache.get("a") == []
+    assert cache.get("b") is None
+    assert cache.get("c") == []
+
+
+def test_empty_results_are_cached():
+    cache = ResultCache()
+    cache.put("none", [])
+    assert cache.get("none") == []
+
+
+def test_pipelines_open_with_an_indexed_match():
+    pipelines = [
+        analytics.spend_pipeline("website", "week", user_id="u1"),
+        analytics.deposit_pipeline("brand", "day"),
+        analytics.trade_volume_pipeline(),
+        analytics.value_by_condition_pipeline("shoes"),
+    ]
+    for pipeline in pipelines:
+        assert next(iter(pipeline[0])) == "$match"
+    assert pipelines[0][0]["$match"] == {"type": "payment", "status": "completed", "user_id": "u1"}
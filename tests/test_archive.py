@@ -0,0 +1,74 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import archive
+import trade_parties
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+CUTOFF = datetime(2026, 1, 1)
+
+
+def trade(n, when, payer_id="alice", payee_id="bob"):
+    return {"_id": f"t{n}", "trade_id": f"t{n}", "payer_id": payer_id, "payee_id": payee_id,
+            "total_value": 10.0, "timestamp": when, "items": []}
+
+
+def test_month_bounds_cover_whole_months_across_december():
+    assert archive.month_bounds(datetime(2025, 12, 15), datetime(2025, 12, 31, 23)) == (
+        datetime(2025, 12, 1), datetime(2026, 1, 1),
+    )
+    assert archive.month_bounds(datetime(2025, 11, 2), datetime(2026, 2, 3)) == (
+        datetime(2025, 11, 1), datetime(2026, 3, 1),
+    )
+    match = archive.summary_pipeline("trades", ["alice"], *archive.month_bounds(
+        datetime(2025, 12, 5), datetime(2025, 12, 6)
+    ))[0]["$match"]
+    assert match["timestamp"] == {"$gte": datetime(2025, 12, 1), "$lt": datetime(2026, 1, 1)}
+    assert archive.summary_pipeline("trades", [], CUTOFF, CUTOFF)[-1]["$merge"]["into"] == "history_summaries"
+
+
+def test_trades_move_with_their_party_entries():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["archive"]
+        old = [trade(1, datetime(2025, 12, 30)), trade(2, datetime(2025, 12, 31))]
+        new = trade(3, datetime(2026, 1, 2))
+        for doc in old + [new]:
+            await trade_parties.record(db, doc)
+            await db.trades.insert_one(dict(doc))
+        # As if an earlier run copied t1 and then crashed before deleting it
+        await db.trades_archive.insert_one(dict(old[0]))
+
+        moved = await archive.move_batch(db, "trades", CUTOFF)
+        return (
+            [doc["trade_id"] for doc in moved],
+            sorted(await db.trades.distinct("trade_id")),
+            sorted(await db.trades_archive.distinct("trade_id")),
+            sorted(await db.trade_parties.distinct("trade_id")),
+            sorted(await db.trade_parties_archive.distinct("trade_id")),
+            await db.trade_parties_archive.count_documents({}),
+            await archive.move_batch(db, "trades", CUTOFF),
+        )
+
+    moved, hot, archived, parties, archived_parties, archived_entries, again = asyncio.run(scenario())
+    assert moved == ["t1", "t2"]
+    assert hot == parties == ["t3"]
+    assert archived == archived_parties == ["t1", "t2"]
+    assert archived_entries == 4
+    assert again == []
+
+
+def test_lease_is_refused_to_a_second_holder_until_it_expires():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["archive"]
+        first = await archive.acquire_lease(db, "archive", "worker-a")
+        second = await archive.acquire_lease(db, "archive", "worker-b")
+        renewed = await archive.acquire_lease(db, "archive", "worker-a")
+        await db.locks.update_one({"_id": "archive"}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+        taken_over = await archive.acquire_lease(db, "archive", "worker-b")
+        holder = (await db.locks.find_one({"_id": "archive"}))["holder"]
+        return first, second, renewed, taken_over, holder
+
+    assert asyncio.run(scenario()) == (True, False, True, True, "worker-b")
@@ -0,0 +1,88 @@
+import asyncio
+import os
+
+import pytest
+
+import auth
+
+USER = {"user_id": "u1", "username": "bob"}
+FIRST, SECOND = "a" * 32, "b" * 32
+
+
+def test_access_tokens_verify_in_process_and_carry_claims():
+    issuer = auth.TokenIssuer({"k1": FIRST.encode()})
+    pair = issuer.pair(USER)
+    claims = issuer.verify(pair["access_token"])
+    assert (claims["sub"], claims["username"]) == ("u1", "bob")
+    assert issuer.verify(pair["refresh_token"], auth.REFRESH)["sub"] == "u1"
+    with pytest.raises(auth.InvalidToken):
+        issuer.verify(pair["refresh_token"])
+    with pytest.raises(auth.InvalidToken):
+        auth.TokenIssuer({"k1": SECOND.encode()}).verify(pair["access_token"])
+    with pytest.raises(auth.InvalidToken):
+        auth.TokenIssuer({"k1": FIRST.encode()}, access_ttl=-1).verify(
+            auth.TokenIssuer({"k1": FIRST.encode()}, access_ttl=-1).issue(USER)
+        )
+
+
+def test_rotated_keys_keep_verifying_until_dropped():
+    old = auth.TokenIssuer(auth.parse_keys(f"k1:{FIRST}"))
+    token = old.issue(USER)
+    rotated = auth.TokenIssuer(auth.parse_keys(f"k2:{SECOND}, k1:{FIRST}"))
+    assert rotated.signing_kid == "k2"
+    assert rotated.verify(token)["sub"] == "u1"
+    with pytest.raises(auth.InvalidToken):
+        auth.TokenIssuer(auth.parse_keys(f"k2:{SECOND}")).verify(token)
+    with pytest.raises(ValueError):
+        auth.parse_keys("no-secret")
+
+
+def test_bearer_header_parsing():
+    assert auth.bearer("Bearer abc") == "abc"
+    assert auth.bearer("bearer  abc ") == "abc"
+    assert auth.bearer("Basic abc") is None
+    assert auth.bearer(None) is None
+
+
+def test_pins_are_bcrypted_and_legacy_hashes_still_match():
+    async def scenario():
+        hashed = await auth.hash_pin("client-sha256", rounds=4)
+        return (
+            hashed,
+            await auth.check_pin(hashed, "client-sha256"),
+            await auth.check_pin(hashed, "wrong"),
+            await auth.check_pin("client-sha256", "client-sha256"),
+        )
+
+    hashed, right, wrong, legacy = asyncio.run(scenario())
+    assert hashed.startswith("$2") and not auth.needs_upgrade(hashed)
+    assert right and not wrong and legacy
+    assert auth.needs_upgrade("client-sha256")
+
+
+def test_user_endpoints_never_return_the_pin_hash(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "test")
+    server = pytest.importorskip("server")
+    from fastapi.testclient import TestClient
+
+    db = mongomock_motor.AsyncMongoMockClient()["auth"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "PIN_HASH_ROUNDS", 4)
+    client = TestClient(server.app)
+
+    registered = client.post("/api/users/register", json={"username": "bob", "pin_hash": "client-hash"}).json()
+    # mongomock ignores the client's type registry, so store the balance as the server would read it
+    asyncio.run(db.users.update_one({"username": "bob"}, {"$set": {"balance": 0.0}}))
+    login = client.post("/api/users/login", json={"username": "bob", "pin_hash": "client-hash"}).json()
+    users = [
+        registered,
+        login["user"],
+        client.post("/api/auth/refresh", json={"refresh_token": login["refresh_token"]}).json()["user"],
+        client.get("/api/users/by-username/bob").json(),
+        client.get(f"/api/users/{registered['user_id']}").json(),
+        client.put(f"/api/users/{registered['user_id']}/personal-info", json={"city": "Oslo"}).json(),
+    ]
+    assert [user["username"] for user in users] == ["bob"] * 6
+    assert not any("pin_hash" in user for user in users)
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import bulk
+
+
+def collect(chunks, fmt, chunk_size=100):
+    async def source():
+        for chunk in chunks:
+            yield chunk
+
+    async def run():
+        return [batch async for batch in bulk.iter_row_chunks(source(), fmt, chunk_size)]
+
+    return asyncio.run(run())
+
+
+def rows(batches):
+    return [entry for batch in batches for entry in batch]
+
+
+def test_csv_header_names_columns_and_is_not_a_row():
+    result = rows(collect([b"category, brand,value\nshoes,Nike,80\n"], "csv"))
+    assert result == [(2, {"category": "shoes", "brand": "Nike", "value": "80"}, None)]
+
+
+def test_csv_empty_cells_are_dropped():
+    result = rows(collect([b"category,brand,value\nshoes,,80\n"], "csv"))
+    assert result[0][1] == {"category": "shoes", "value": "80"}
+
+
+def test_csv_column_count_mismatch_is_reported_per_line():
+    result = rows(collect([b"a,b\n1,2\n1,2,3\n4\n5,6\n"], "csv"))
+    assert [(line, error) for line, _, error in result] == [
+        (2, None),
+        (3, "expected 2 columns, got 3"),
+        (4, "expected 2 columns, got 1"),
+        (5, None),
+    ]
+    assert result[1][1] is None
+
+
+def test_line_split_across_chunks():
+    result = rows(collect([b'{"category": "sh', b'oes"}\r', b'\n{"category": "hat"}\n'], "ndjson"))
+    assert result == [(1, {"category": "shoes"}, None), (2, {"category": "hat"}, None)]
+
+
+def test_multibyte_character_split_across_chunks():
+    encoded = '{"brand": "Pumá"}\n'.encode("utf-8")
+    cut = encoded.index(b"\xc3") + 1
+    assert rows(collect([encoded[:cut], encoded[cut:]], "ndjson")) == [(1, {"brand": "Pumá"}, None)]
+
+
+def test_trailing_line_without_newline():
+    result = rows(collect([b'{"a": 1}\n{"a": 2}'], "ndjson"))
+    assert result == [(1, {"a": 1}, None), (2, {"a": 2}, None)]
+
+    result = rows(collect([b"a,b\n1,2"], "csv"))
+    assert result == [(2, {"a": "1", "b": "2"}, None)]
+
+
+def test_blank_lines_are_skipped_but_counted():
+    result = rows(collect([b'{"a": 1}\n\n  \n{"a": 2}\n'], "ndjson"))
+    assert [line for line, _, _ in result] == [1, 4]
+
+
+def test_bad_ndjson_lines_are_reported():
+    result = rows(collect([b'[1, 2]\n{"a": \n\xff\xfe\n'], "ndjson"))
+    assert [(row, error) for _, row, error in result] == [
+        (None, "expected a JSON object"),
+        (None, "invalid JSON: Expecting value"),
+        (None, "line is not UTF-8"),
+    ]
+
+
+def test_rows_are_batched_by_chunk_size():
+    body = b"".join(b'{"n": %d}\n' % i for i in range(7))
+    batches = collect([body], "ndjson", chunk_size=3)
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+
+
+def test_imported_items_are_hashed_and_described(monkeypatch):
+    pytest.importorskip("PIL")
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "test")
+    server = pytest.importorskip("server")
+    from fastapi.testclient import TestClient
+
+    from .test_image_hash import photo
+
+    db = mongomock_motor.AsyncMongoMockClient()["bulk"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "visual_index", server.visual_search.VisualSearch(db))
+    rows = [{"category": "shoes", "subcategory": "sneakers", "brand": "x",
+             "condition": "new", "photo": photo(n), "value": 10} for n in range(2)]
+    response = TestClient(server.app).post(
+        "/api/items/import?owner_id=alice", content="\n".join(json.dumps(row) for row in rows),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert json.loads(response.text.splitlines()[-1])["inserted"] == 2
+
+    items = asyncio.run(db.items.find({}, {"item_id": 1, "photo_hash": 1, "visual_descriptor": 1}).to_list(None))
+    assert all(item["photo_hash"] is not None and item["visual_descriptor"] for item in items)
+    assert len(server.visual_index.index) == 2
+    assert all(item["item_id"] in server.visual_index.index for item in items)
@@ -0,0 +1,80 @@
+import json
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+import replay
+from capture import SCRUBBED, CaptureMiddleware, RollingWriter, Scrubber
+
+
+def test_scrubber_hides_secrets_and_pseudonymizes_people():
+    scrub = Scrubber(b"k")
+    doc = scrub.document({
+        "username": "bob", "pin_hash": "1234", "photo": "A" * 40,
+        "items": [{"brand": "Acme", "email": "b@x.io"}],
+    })
+    assert doc["pin_hash"] == SCRUBBED
+    assert doc["username"] == scrub.pseudonym("bob") != "bob"
+    assert doc["photo"] == "<photo:40>"
+    assert doc["items"][0] == {"brand": "Acme", "email": scrub.pseudonym("b@x.io")}
+    assert scrub.path("/api/users/by-username/bob") == "/api/users/by-username/" + scrub.pseudonym("bob")
+    assert scrub.query("limit=5&__profile=abc") == f"limit=5&__profile={SCRUBBED.replace('[', '%5B').replace(']', '%5D')}"
+    assert scrub.query("token=abc") == "token=abc"
+    assert scrub.document({"token": "abc", "access_token": "xyz"}) == {"token": "abc", "access_token": SCRUBBED}
+    assert scrub.body(b"\x89PNG", "image/png") == {"bytes": 4}
+
+
+def test_writer_rolls_and_keeps_newest_files(tmp_path):
+    writer = RollingWriter(tmp_path, max_bytes=1, max_files=2, scrubber=Scrubber(b"k"))
+    for n in range(5):
+        writer.put({
+            "path": f"/api/items/{n}", "query": "", "request_headers": {}, "request_body": b"",
+            "request_truncated": False, "response_headers": {}, "response_body": b"", "response_truncated": False,
+        })
+    writer.close()
+    files = sorted(tmp_path.glob("*.ndjson"))
+    assert len(files) == 2
+    assert all(len(f.read_text().splitlines()) == 1 for f in files)
+
+
+def test_middleware_records_scrubbed_exchange(tmp_path):
+    app = FastAPI()
+
+    @app.post("/api/users/register")
+    async def register(request: Request):
+        body = await request.json()
+        return {"user_id": "u1", "username": body["username"]}
+
+    @app.get("/health")
+    async def health():
+        return {"ok": True}
+
+    writer = RollingWriter(tmp_path, max_bytes=1 << 20, max_files=2, scrubber=Scrubber(b"k"))
+    app.add_middleware(CaptureMiddleware, writer=writer, sample_rate=1.0)
+    client = TestClient(app)
+    assert client.post("/api/users/register", json={"username": "bob", "pin": "1234"}).json()["username"] == "bob"
+    client.get("/health")
+    writer.close()
+
+    records = replay.load([tmp_path])
+    assert len(records) == 1
+    record = records[0]
+    assert record["request_body"]["json"]["pin"] == SCRUBBED
+    assert record["response_body"]["json"]["username"] == record["request_body"]["json"]["username"] != "bob"
+    assert record["status"] == 200 and record["duration_ms"] >= 0
+
+
+def test_replay_compares_masked_bodies():
+    record = {
+        "status": 200,
+        "response_body": {"json": {
+            "trade_id": "6f0f8488-935d-4460-88fe-1a06b9ee9006", "timestamp": "2026-01-01T00:00:00",
+            "username": "anon-1", "total_value": 10.0, "change_seq": 4,
+        }},
+    }
+    same = {"trade_id": "0d2a3b54-1c1e-4a7e-9d8e-0a1b2c3d4e5f", "timestamp": "2026-10-19T06:00:00.5",
+            "username": "bob", "total_value": 10.0, "change_seq": 9}
+    assert replay.compare(record, 200, json.dumps(same).encode()) is None
+    assert replay.compare(record, 200, json.dumps({**same, "total_value": 12.0}).encode()) == "body differs"
+    assert replay.compare(record, 404, b"{}") == "status 200 -> 404"
+    assert replay.route({"method": "GET", "path": "/api/items/6f0f8488-935d-4460-88fe-1a06b9ee9006"}) == "GET /api/items/{id}"
@@ -0,0 +1,89 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from changes import (
+    EPOCH, SETTLE_WINDOW, current_etag, etag_matches, format_token, mark_changed,
+    parse_token, since_filter,
+)
+
+STARTED = datetime(2025, 3, 14, 15, 9, 26, 535000)
+
+
+def test_token_round_trip():
+    seq, started_at, continuation = parse_token(format_token(42, STARTED))
+    assert (seq, started_at, continuation) == (42, STARTED, False)
+
+
+def test_continuation_token_round_trip():
+    token = format_token(42, STARTED, continuation=True)
+    assert token.endswith(".more")
+    assert parse_token(token) == (42, STARTED, True)
+
+
+def test_token_drops_sub_millisecond_precision():
+    _, started_at, _ = parse_token(format_token(1, STARTED + timedelta(microseconds=999)))
+    assert started_at == STARTED
+
+
+def test_format_token_is_timezone_independent():
+    assert format_token(7, EPOCH + timedelta(seconds=1)) == "7.1000"
+
+
+@pytest.mark.parametrize("token", [
+    "", "42", "42.", "a.b", "42.1000.less", "42.1000.more.x", "-1.1000", "1.-1000",
+])
+def test_parse_token_rejects_malformed(token):
+    with pytest.raises(ValueError):
+        parse_token(token)
+
+
+def test_since_filter_rereads_settle_window():
+    query = since_filter(42, STARTED)
+    assert query == {"$or": [
+        {"change_seq": {"$gt": 42}},
+        {"updated_at": {"$gte": STARTED - SETTLE_WINDOW}},
+    ]}
+
+
+def test_since_filter_continuation_pages_by_sequence_only():
+    assert since_filter(42, STARTED, continuation=True) == {"change_seq": {"$gt": 42}}
+
+
+ETAG = '"items+transactions.12-7"'
+
+
+@pytest.mark.parametrize("header", [
+    ETAG,
+    f"W/{ETAG}",
+    f'"other", {ETAG}',
+    f'"other",W/{ETAG}',
+    "*",
+    '"other", *',
+])
+def test_etag_matches(header):
+    assert etag_matches(header, ETAG)
+
+
+@pytest.mark.parametrize("header", [
+    None, "", '"other"', ETAG.strip('"'), '"items+transactions.12-8"', f"w/{ETAG}",
+])
+def test_etag_does_not_match(header):
+    assert not etag_matches(header, ETAG)
+
+
+def test_etag_format_and_versioning():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["etags"]
+        first = await current_etag(db, "u1", ["items", "transactions"])
+        await mark_changed(db, "items", ["u1", "u2"], 12)
+        await mark_changed(db, "items", ["u1"], 9)  # a late, older write never lowers the mark
+        await mark_changed(db, "transactions", ["u1"], 7)
+        return first, await current_etag(db, "u1", ["items", "transactions"])
+
+    first, second = asyncio.run(scenario())
+    assert first == '"items+transactions.0-0"'
+    assert second == ETAG
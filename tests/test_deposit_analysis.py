@@ -0,0 +1,94 @@
+import json
+
+import pytest
+from pydantic import BaseModel
+
+import metrics
+from deposit_analysis import AnalysisParseError, parse_analysis
+
+
+class Analysis(BaseModel):
+    name: str
+    description: str
+    category: str
+    subcategory: str
+    brand: str
+    estimated_value: float
+    condition: str = "good"
+
+
+GOOD = {
+    "name": "Air Max 90",
+    "description": "White leather sneakers with light creasing.",
+    "category": "shoes",
+    "subcategory": "sneakers",
+    "brand": "Nike",
+    "condition": "good",
+    "estimated_value": 85.5,
+}
+
+
+def parse_count(outcome):
+    return metrics.snapshot()["counters"].get(f"ai_analysis_parse_total{{outcome={outcome}}}", 0)
+
+
+def test_schema_output_parses_directly():
+    before = parse_count("ok")
+    assert parse_analysis(json.dumps(GOOD), Analysis) == Analysis(**GOOD)
+    assert parse_count("ok") == before + 1
+
+
+@pytest.mark.parametrize("text", [
+    "```json\n" + json.dumps(GOOD) + "\n```",
+    "Here is the analysis: " + json.dumps(GOOD) + " Let me know!",
+    json.dumps(GOOD)[:-1] + ",}",
+])
+def test_drifted_json_is_repaired(text):
+    before = parse_count("repaired")
+    assert parse_analysis(text, Analysis) == Analysis(**GOOD)
+    assert parse_count("repaired") == before + 1
+
+
+def test_labelled_lines_are_read_in_one_pass():
+    text = (
+        "NAME: Air Max 90\n"
+        "DESCRIPTION: White leather sneakers\nwith light creasing.\n"
+        "**Category**: Footwear\n"
+        "SUBCATEGORY: Sneakers\n"
+        "BRAND: NIKE\n"
+        "CONDITION: Used\n"
+        "VALUE: $1,085.50\n"
+    )
+    result = parse_analysis(text, Analysis)
+    assert result.description == "White leather sneakers with light creasing."
+    assert (result.category, result.subcategory, result.brand, result.condition) == ("shoes", "sneakers", "Nike", "good")
+    assert result.estimated_value == 1085.5
+
+
+def test_category_is_inferred_from_subcategory():
+    result = parse_analysis(json.dumps({**GOOD, "category": "Fashion", "subcategory": "Watches"}), Analysis)
+    assert (result.category, result.subcategory) == ("accessories", "watch")
+
+
+def test_missing_brand_is_generic():
+    result = parse_analysis(json.dumps({**GOOD, "brand": "unknown"}), Analysis)
+    assert result.brand == "Generic"
+
+
+@pytest.mark.parametrize("change", [
+    {"category": "vehicles", "subcategory": "car"},
+    {"condition": "sparkly"},
+    {"estimated_value": "priceless"},
+    {"estimated_value": None},
+    {"name": ""},
+])
+def test_unmappable_answers_fail_loudly(change):
+    before = parse_count("failed")
+    with pytest.raises(AnalysisParseError):
+        parse_analysis(json.dumps({**GOOD, **change}), Analysis)
+    assert parse_count("failed") == before + 1
+
+
+def test_garbage_fails():
+    with pytest.raises(AnalysisParseError):
+        parse_analysis("I can't see an item in this image.", Analysis)
@@ -0,0 +1,77 @@
+import asyncio
+import base64
+import io
+import random
+
+import pytest
+
+import image_hash
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def photo(seed: int, size=(640, 480), quality=90, fmt="JPEG") -> str:
+    """A base64 image of random soft blobs, like the frontend sends."""
+    rng = random.Random(seed)
+    image = Image.new("RGB", (32, 24))
+    image.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(32 * 24)])
+    image = image.resize(size, Image.BICUBIC)
+    out = io.BytesIO()
+    image.save(out, fmt, quality=quality)
+    return base64.b64encode(out.getvalue()).decode()
+
+
+def test_reencoded_and_resized_photos_stay_close():
+    original = image_hash.photo_hash(photo(1))
+    assert image_hash.distance(original, image_hash.photo_hash(photo(1, quality=40))) <= 3
+    assert image_hash.distance(original, image_hash.photo_hash(photo(1, size=(320, 240)))) <= 3
+    assert image_hash.distance(original, image_hash.photo_hash("data:image/png;base64," + photo(1, fmt="PNG"))) <= 3
+
+
+def test_different_photos_are_far_apart():
+    hashes = [image_hash.photo_hash(photo(seed)) for seed in range(20)]
+    closest = min(image_hash.distance(a, b) for i, a in enumerate(hashes) for b in hashes[i + 1:])
+    assert closest > image_hash.MAX_DISTANCE
+
+
+def test_unreadable_photo():
+    with pytest.raises(image_hash.UnreadablePhoto):
+        image_hash.photo_hash(base64.b64encode(b"not an image").decode())
+
+
+def test_signed_storage_round_trips():
+    for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        assert image_hash.to_unsigned(image_hash.to_signed(value)) == value
+        assert -(1 << 63) <= image_hash.to_signed(value) < 1 << 63
+
+
+def test_query_keys_cover_every_hash_within_max_distance():
+    rng = random.Random(5)
+    for _ in range(500):
+        value = rng.getrandbits(64)
+        near = value
+        for bit in rng.sample(range(64), rng.randint(0, image_hash.MAX_DISTANCE)):
+            near ^= 1 << bit
+        assert set(image_hash.chunk_keys(near)) & set(image_hash.query_keys(value))
+
+
+def test_find_near_duplicates():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["hashes"]
+        for seed in range(10):
+            await db.items.insert_one({
+                "item_id": f"item-{seed}", "owner_id": "u1",
+                **image_hash.hash_fields(image_hash.photo_hash(photo(seed))),
+            })
+        return (
+            await image_hash.find_near_duplicates(db, image_hash.photo_hash(photo(3, quality=50))),
+            await image_hash.find_near_duplicates(db, image_hash.photo_hash(photo(99))),
+            await image_hash.find_near_duplicates(db, image_hash.photo_hash(photo(3)), exclude_item_id="item-3"),
+        )
+
+    resized, unrelated, excluded = asyncio.run(scenario())
+    assert [match["item_id"] for match in resized] == ["item-3"]
+    assert unrelated == []
+    assert excluded == []
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+import jobs
+from jobs import JobQueue, PermanentJobError
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+def run_queue(handlers, submissions, **options):
+    """Submit jobs, let the consumers run briefly, return the stored jobs."""
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["jobs"]
+        queue = JobQueue(db, handlers, backoff=0.01, poll_interval=0.01, **options)
+        queue.start()
+        submitted = [await queue.submit(kind, payload) for kind, payload in submissions]
+        await asyncio.sleep(0.3)
+        await queue.stop()
+        return [await db.jobs.find_one({"_id": job["_id"]}) for job in submitted]
+
+    return asyncio.run(scenario())
+
+
+def test_retries_until_success_and_drops_payload():
+    attempts = []
+
+    async def flaky(payload):
+        attempts.append(payload)
+        if len(attempts) < 3:
+            raise RuntimeError("upstream timed out")
+        return {"value": payload["n"] * 2}
+
+    [job] = run_queue({"flaky": flaky}, [("flaky", {"n": 21})])
+    assert job["status"] == jobs.SUCCEEDED
+    assert job["attempts"] == 3
+    assert job["result"] == {"value": 42}
+    assert "payload" not in job
+
+
+def test_gives_up_after_max_attempts():
+    async def broken(payload):
+        raise RuntimeError("still down")
+
+    [job] = run_queue({"broken": broken}, [("broken", {})], max_attempts=2)
+    assert job["status"] == jobs.FAILED
+    assert job["attempts"] == 2
+    assert job["error"] == "still down"
+
+
+def test_permanent_errors_are_not_retried():
+    async def rejects(payload):
+        raise PermanentJobError("not an image")
+
+    [job] = run_queue({"rejects": rejects}, [("rejects", {})])
+    assert (job["status"], job["attempts"]) == (jobs.FAILED, 1)
+
+
+def test_unknown_kinds_are_refused():
+    with pytest.raises(ValueError):
+        run_queue({}, [("missing", {})])
@@ -0,0 +1,193 @@
+import asyncio
+import zlib
+
+import pytest
+
+import middleware
+from middleware import ENCODERS, CompressionMiddleware, negotiate_encoding
+
+
+def run_app(app, accept_encoding="gzip", path="/"):
+    """Drive an ASGI app once and return the messages it sent."""
+    sent = []
+    scope = {
+        "type": "http", "method": "GET", "path": path,
+        "headers": [(b"accept-encoding", accept_encoding.encode())],
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+
+def streaming_app(chunks, content_type="application/json", content_length=None):
+    async def app(scope, receive, send):
+        headers = [(b"content-type", content_type.encode())]
+        if content_length is not None:
+            headers.append((b"content-length", str(content_length).encode()))
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        for index, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": index < len(chunks) - 1})
+    return app
+
+
+def header(message, name):
+    return dict(message["headers"]).get(name.encode(), b"").decode()
+
+
+# ============ Negotiation ============
+@pytest.mark.parametrize("accept, expected", [
+    ("", None),
+    ("identity", None),
+    ("gzip", "gzip"),
+    ("GZIP", "gzip"),
+    ("gzip;q=0", None),
+    ("deflate, gzip;q=0.5", "gzip"),
+    ("gzip;q=bogus", None),
+])
+def test_negotiate_encoding(accept, expected):
+    assert negotiate_encoding(accept) == expected
+
+
+def test_negotiate_prefers_server_order_on_ties():
+    assert negotiate_encoding("gzip, br, zstd") == next(iter(ENCODERS))
+
+
+def test_negotiate_honours_client_q_values():
+    assert negotiate_encoding("zstd;q=0.1, br;q=0.1, gzip;q=0.9") == "gzip"
+
+
+def test_negotiate_wildcard():
+    assert negotiate_encoding("*") == next(iter(ENCODERS))
+    assert negotiate_encoding("*;q=0.5, gzip;q=0") != "gzip"
+
+
+# ============ Skips ============
+def test_small_bodies_pass_through():
+    body = b'{"ok": true}'
+    sent = run_app(CompressionMiddleware(streaming_app([body]), minimum_size=1024))
+    assert "content-encoding" not in dict(sent[0]["headers"])
+    assert sent[1]["body"] == body
+
+
+def test_declared_length_below_threshold_passes_through():
+    chunks = [b"x" * 100, b"x" * 100]
+    sent = run_app(CompressionMiddleware(streaming_app(chunks, content_length=200), minimum_size=1024))
+    assert "content-encoding" not in dict(sent[0]["headers"])
+    assert b"".join(m["body"] for m in sent[1:]) == b"".join(chunks)
+
+
+def test_bodies_at_threshold_are_compressed():
+    body = b"a" * 1024
+    sent = run_app(CompressionMiddleware(streaming_app([body]), minimum_size=1024))
+    assert header(sent[0], "content-encoding") == "gzip"
+    assert zlib.decompress(sent[1]["body"], 16 + zlib.MAX_WBITS) == body
+
+
+@pytest.mark.parametrize("content_type", [
+    "image/jpeg", "application/zip", "application/vnd.apache.parquet", "text/event-stream; charset=utf-8",
+])
+def test_incompressible_types_pass_through(content_type):
+    body = b"a" * 4096
+    sent = run_app(CompressionMiddleware(streaming_app([body], content_type=content_type)))
+    assert "content-encoding" not in dict(sent[0]["headers"])
+    assert sent[1]["body"] == body
+
+
+def test_strong_etag_is_weakened():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json"), (b"etag", b'"items.3"')]})
+        await send({"type": "http.response.body", "body": b"a" * 2048})
+
+    sent = run_app(CompressionMiddleware(app))
+    assert header(sent[0], "etag") == 'W/"items.3"'
+    assert header(sent[0], "vary") == "Accept-Encoding"
+
+
+# ============ Streaming ============
+@pytest.mark.parametrize("encoding", list(ENCODERS))
+def test_streamed_chunks_are_flushed(encoding):
+    lines = [b'{"processed": %d}\n' % i for i in range(5)] + [b"a" * 2048]
+    sent = run_app(CompressionMiddleware(streaming_app(lines), minimum_size=16), accept_encoding=encoding)
+    assert header(sent[0], "content-encoding") == encoding
+
+    bodies = [message["body"] for message in sent[1:]]
+    assert len(bodies) == len(lines)
+    assert all(bodies), "every streamed chunk should reach the client"
+
+    # Each prefix decodes on its own to exactly the lines sent so far
+    decoder = _decoder(encoding)
+    decoded = b""
+    for body, line in zip(bodies[:-1], lines):
+        decoded += decoder(body)
+        assert decoded.endswith(line)
+    assert decoded + decoder(bodies[-1]) == b"".join(lines)
+
+
+def _decoder(encoding):
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    if encoding == "br":
+        return middleware.brotli.Decompressor().process
+    return middleware.zstandard.ZstdDecompressor().decompressobj().decompress
+
+
+def drive_upload(app, path, chunks, method="POST", content_length=None):
+    """Send a request body in chunks and return the status and the bytes the app read."""
+    sent, read = [], []
+    headers = [(b"content-length", str(content_length).encode())] if content_length is not None else []
+    scope = {"type": "http", "method": method, "path": path, "headers": headers}
+    pending = list(chunks)
+
+    async def receive():
+        body = pending.pop(0) if pending else b""
+        return {"type": "http.request", "body": body, "more_body": bool(pending)}
+
+    async def send(message):
+        sent.append(message)
+
+    async def app_reading_body(scope, receive, send):
+        while True:
+            message = await receive()
+            read.append(message["body"])
+            if not message.get("more_body"):
+                break
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    asyncio.run(app(app_reading_body)(scope, receive, send))
+    return sent[0]["status"], b"".join(read)
+
+
+def limited(max_body_bytes=10, path_limits=None):
+    return lambda inner: middleware.BodySizeLimitMiddleware(inner, max_body_bytes, path_limits)
+
+
+def test_declared_oversized_body_is_rejected_unread():
+    status, read = drive_upload(limited(), "/api/trades", [b"x" * 20], content_length=20)
+    assert status == 413
+    assert read == b""
+
+
+def test_streamed_body_is_cut_off_once_over_the_limit():
+    status, read = drive_upload(limited(), "/api/trades", [b"x" * 6, b"x" * 6, b"x" * 6])
+    assert status == 413
+    assert len(read) == 6
+    assert drive_upload(limited(), "/api/trades", [b"x" * 5, b"x" * 5])[0] == 200
+
+
+def test_large_allowance_only_on_photo_routes():
+    limits = limited(10, {"POST /api/items": 100, "PUT /api/items/{item_id}": 100, "POST /api/items/import": 1000})
+    assert drive_upload(limits, "/api/items", [b"x" * 50], content_length=50)[0] == 200
+    assert drive_upload(limits, "/api/items/abc", [b"x" * 50], method="PUT", content_length=50)[0] == 200
+    # Same prefix, but not a photo route
+    assert drive_upload(limits, "/api/items/verify", [b"x" * 50], content_length=50)[0] == 413
+    assert drive_upload(limits, "/api/items/abc/extra", [b"x" * 50], method="PUT")[0] == 413
+    # The literal import route wins over the {item_id} template
+    assert drive_upload(limits, "/api/items/import", [b"x" * 500])[0] == 200
@@ -0,0 +1,49 @@
+import asyncio
+from decimal import Decimal
+
+import bson
+import pytest
+from bson.codec_options import CodecOptions
+from bson.decimal128 import Decimal128
+
+import money
+
+
+def test_amounts_are_stored_to_the_cent():
+    assert money.decimal(0.1 + 0.2) == Decimal128("0.30")
+    assert money.decimal(19.999) == Decimal128("20.00")
+    assert money.decimal(None) is None
+    assert money.from_cents(-1050) == Decimal128("-10.50")
+
+
+def test_encode_reaches_nested_fields_and_reads_decode_to_floats():
+    trade = {"total_value": 12.5, "items": [{"value": 10.0}, {"value": 2.5}], "payer_id": "alice"}
+    stored = money.encode("trades", dict(trade, items=[dict(i) for i in trade["items"]]))
+    assert stored["items"][1]["value"] == Decimal128("2.50")
+    assert money.encode("ownership_events", {"value": 1.0}) == {"value": 1.0}
+
+    options = CodecOptions(type_registry=money.TYPE_REGISTRY)
+    raw = bson.encode({**stored, "exact": Decimal("0.10")}, codec_options=options)
+    assert bson.decode(raw)["exact"] == Decimal128("0.10")
+    decoded = bson.decode(raw, options)
+    assert {k: decoded[k] for k in trade} == trade
+    assert decoded["exact"] == 0.1
+
+
+def test_migration_converts_hot_and_archived_amounts_once():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["money"]
+        await db.users.insert_many([{"balance": 0.1}, {"balance": 3}, {"username": "no-balance"}])
+        await db.trades_archive.insert_one({"total_value": 0.3, "items": [{"value": 0.1}, {"value": 0.2}]})
+        first = await money.migrate(db, batch_size=1)
+        again = await money.migrate(db)
+        balances = [user.get("balance") async for user in db.users.find()]
+        return first, again, balances, await db.trades_archive.find_one()
+
+    first, again, balances, trade = asyncio.run(scenario())
+    assert first == {"users": 2, "trades_archive": 1}
+    assert again == {}
+    assert balances == [Decimal128("0.10"), Decimal128("3.00"), None]
+    assert [item["value"] for item in trade["items"]] == [Decimal128("0.10"), Decimal128("0.20")]
@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from bson.decimal128 import Decimal128
+
+import netting
+
+T0 = datetime(2026, 1, 1)
+
+
+def transaction(n, user_id, type, amount, merchant_name=None):
+    return {"transaction_id": f"tx-{n}", "user_id": user_id, "type": type, "amount": amount,
+            "merchant_name": merchant_name, "created_at": T0 + timedelta(seconds=n)}
+
+
+def test_reduced_transfers_settle_every_position():
+    rng = np.random.default_rng(7)
+    parties = 50
+    payers = rng.integers(0, parties, 5000)
+    payees = rng.integers(0, parties, 5000)
+    cents = rng.integers(1, 10_000, 5000)
+    net = netting.net_positions(payers, payees, cents, parties)
+
+    senders, receivers, amounts = netting.reduce_transfers(net)
+    settled = np.zeros(parties, dtype=np.int64)
+    np.add.at(settled, receivers, amounts)
+    np.subtract.at(settled, senders, amounts)
+    assert (settled == net).all()
+    assert (amounts > 0).all()
+    assert len(amounts) <= np.count_nonzero(net) - 1
+
+
+def test_reduce_transfers_of_nothing():
+    senders, receivers, amounts = netting.reduce_transfers(np.zeros(3, dtype=np.int64))
+    assert len(senders) == len(receivers) == len(amounts) == 0
+
+
+def test_obligations_point_the_right_way():
+    paid = netting.obligation_for(transaction(1, "alice", "payment", 5.0, "Cafe"))
+    assert (paid["payer"], paid["payee"]) == ("alice", "ext:merchant:Cafe")
+    refund = netting.obligation_for(transaction(2, "alice", "refund", 5.0))
+    assert (refund["payer"], refund["payee"]) == (netting.PLATFORM, "alice")
+    assert netting.obligation_for(transaction(3, "alice", "transfer", 5.0)) is None
+
+
+def test_settlement_nets_a_window_into_one_write_per_user():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["netting"]
+        # mongomock can't add Decimal128, so no user documents: the $incs match nothing here
+        n = 0
+        for _ in range(100):
+            for user_id, type, amount in (("alice", "payment", 0.1), ("bob", "refund", 0.1), ("bob", "payment", 0.3)):
+                n += 1
+                await db.obligations.insert_one(netting.obligation_for(transaction(n, user_id, type, amount, "Cafe")))
+        later = netting.obligation_for(transaction(10_000, "alice", "deposit", 1.0))
+        await db.obligations.insert_one(later)
+
+        settlement = await netting.settle(db, T0 + timedelta(seconds=n + 1))
+        # Re-applying (as after a crash) must not move balances again
+        await netting.apply_settlement(db, settlement["_id"])
+        claimed = await db.obligations.count_documents({"settlement_id": settlement["_id"]})
+        pending = await netting.pending_net(db, "alice")
+        again = await netting.settle(db, T0 + timedelta(seconds=n + 1))
+        return settlement, claimed, pending, again
+
+    settlement, claimed, pending, again = asyncio.run(scenario())
+    assert settlement["obligations"] == claimed == 300
+    assert settlement["balance_writes"] == 2
+    assert {p["party"]: p["net"] for p in settlement["positions"]} == {
+        "alice": -10.0, "bob": -20.0, "ext:merchant:Cafe": 30.0,
+    }
+    assert {(t["from"], t["to"], t["amount"]) for t in settlement["transfers"]} == {
+        ("alice", "ext:merchant:Cafe", 10.0), ("bob", "ext:merchant:Cafe", 20.0),
+    }
+    assert pending == 1.0
+    assert again is None
+
+
+def test_balance_updates_are_exact_and_applied_once():
+    alice, bob = netting.balance_updates("s1", [("alice", -1000), ("bob", 1)])
+    assert alice._filter == {"user_id": "alice", "settled_through": {"$ne": "s1"}}
+    assert alice._doc["$inc"] == {"balance": Decimal128("-10.00")}
+    assert bob._doc["$inc"] == {"balance": Decimal128("0.01")}
@@ -0,0 +1,117 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import ownership
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+T0 = datetime(2026, 1, 1)
+
+
+def at(hours):
+    return T0 + timedelta(hours=hours)
+
+
+async def trade_history(db, item_id="item-1", owners=("alice", "bob", "carol", "dave"), snapshot_every=2):
+    await ownership.append(db, item_id, ownership.DEPOSIT, owners[0], at(0), share_percentage=1.0,
+                           snapshot_every=snapshot_every)
+    for hour, owner in enumerate(owners[1:], start=1):
+        await ownership.append(db, item_id, ownership.TRANSFER, owner, at(hour), trade_id=f"trade-{hour}",
+                               snapshot_every=snapshot_every)
+
+
+def test_apply_builds_the_provenance_chain():
+    events = [
+        {"version": 1, "type": ownership.DEPOSIT, "owner_id": "alice", "share_percentage": 1.0, "at": at(0)},
+        {"version": 2, "type": ownership.SHARE_CHANGE, "owner_id": "alice", "share_percentage": 0.5, "at": at(1)},
+        {"version": 3, "type": ownership.TRANSFER, "owner_id": "bob", "trade_id": "t1", "at": at(2)},
+        {"version": 4, "type": ownership.DELETE, "owner_id": "bob", "at": at(3)},
+    ]
+    state = ownership.replay(ownership.empty_state("item-1"), events)
+    assert state["owner_id"] == "bob"
+    assert state["share_percentage"] == 0.5
+    assert state["deleted"]
+    assert [(o["owner_id"], o["since"], o["until"], o["via"]) for o in state["owners"]] == [
+        ("alice", at(0), at(2), ownership.DEPOSIT),
+        ("bob", at(2), None, ownership.TRANSFER),
+    ]
+
+
+def test_owner_at_time_replays_from_the_nearest_snapshot():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["ownership"]
+        await trade_history(db)
+        snapshots = await db.ownership_snapshots.find({}, {"version": 1}).sort("version", 1).to_list(None)
+        # Replays must not depend on events before the snapshot
+        await db.ownership_events.delete_many({"version": {"$lte": 2}})
+        return (
+            [s["version"] for s in snapshots],
+            await ownership.owner_at(db, "item-1", at(1.5)),
+            await ownership.owner_at(db, "item-1", at(2.5)),
+            await ownership.owner_at(db, "item-1", at(-1)),
+            await ownership.state_at(db, "item-1"),
+        )
+
+    versions, at_1_5, at_2_5, before, now = asyncio.run(scenario())
+    assert versions == [2, 4]
+    assert at_1_5["owner_id"] == "bob"
+    assert at_2_5["owner_id"] == "carol"
+    assert before is None
+    assert [o["owner_id"] for o in now["owners"]] == ["alice", "bob", "carol", "dave"]
+    assert now["owners"][2]["trade_id"] == "trade-2"
+
+
+def test_concurrent_appends_get_distinct_versions():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["ownership"]
+        await asyncio.gather(*[
+            ownership.append(db, "item-1", ownership.TRANSFER, f"user-{i}", at(i)) for i in range(10)
+        ])
+        return await ownership.events(db, "item-1")
+
+    events = asyncio.run(scenario())
+    assert [event["version"] for event in events] == list(range(1, 11))
+
+
+def test_rebuild_rederives_heads_and_repairs_items():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["ownership"]
+        await trade_history(db, "item-1", snapshot_every=100)
+        await trade_history(db, "item-2", owners=("erin", "frank"), snapshot_every=100)
+        await db.items.insert_many([
+            {"item_id": "item-1", "owner_id": "dave"},
+            # Drifted from the log
+            {"item_id": "item-2", "owner_id": "mallory"},
+        ])
+        await db.ownership_heads.delete_many({})
+        dry_run = await ownership.rebuild(db, snapshot_every=2, batch_size=1)
+        applied = await ownership.rebuild(db, apply_to_items=True, snapshot_every=2)
+        return dry_run, applied, await db.items.find_one({"item_id": "item-2"}), \
+            await db.ownership_heads.find_one({"_id": "item-1"}), await db.ownership_snapshots.count_documents({})
+
+    dry_run, applied, item_2, head, snapshots = asyncio.run(scenario())
+    assert dry_run == {"items": 2, "events": 6, "snapshots": 3, "owner_mismatches": 1, "owners_fixed": 0}
+    assert applied["owners_fixed"] == 1
+    assert item_2["owner_id"] == "frank"
+    assert head["version"] == 4 and head["owner_id"] == "dave"
+    assert snapshots == 3
+
+
+def test_backfill_seeds_history_from_trades():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["ownership"]
+        await db.items.insert_one({"item_id": "item-1", "owner_id": "carol", "created_at": at(0), "share_percentage": 1.0})
+        await db.trades.insert_many([
+            {"trade_id": "t2", "timestamp": at(2), "items": [{"item_id": "item-1", "previous_owner": "bob", "new_owner": "carol"}]},
+            {"trade_id": "t1", "timestamp": at(1), "items": [{"item_id": "item-1", "previous_owner": "alice", "new_owner": "bob"}]},
+        ])
+        seeded = await ownership.backfill(db)
+        again = await ownership.backfill(db)
+        return seeded, again, await ownership.state_at(db, "item-1"), await ownership.owner_at(db, "item-1", at(1.5))
+
+    seeded, again, state, at_1_5 = asyncio.run(scenario())
+    assert (seeded, again) == (1, 0)
+    assert [o["owner_id"] for o in state["owners"]] == ["alice", "bob", "carol"]
+    assert at_1_5["owner_id"] == "bob"
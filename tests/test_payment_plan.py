@@ -0,0 +1,88 @@
+import asyncio
+import os
+import random
+from itertools import combinations
+
+import pytest
+
+import payment_plan
+
+
+def items(*values):
+    return [{"item_id": f"i{n}", "value": value} for n, value in enumerate(values)]
+
+
+def spent(result):
+    return {item["item_id"]: (round(fraction, 4), cents) for item, fraction, cents in result["items"]}
+
+
+def test_whole_items_cover_an_exact_amount():
+    result = payment_plan.plan(items(50.0, 30.0, 20.0, 15.5, 4.5), 40.0)
+    assert result["splits"] == 0
+    assert sum(cents for _, _, cents in result["items"]) == 4000
+    assert all(fraction == 1.0 for _, fraction, _ in result["items"])
+
+
+def test_one_item_is_split_for_the_remainder():
+    result = payment_plan.plan(items(100.0, 30.0, 20.0), 55.0)
+    # 30 + 20 whole, then 5 of the 100 rather than 55 of it
+    assert spent(result) == {"i1": (1.0, 3000), "i2": (1.0, 2000), "i0": (0.05, 500)}
+    assert result["splits"] == 1
+
+
+def test_owner_preferences_are_respected():
+    result = payment_plan.plan(items(10.0, 10.0, 10.0), 10.0, prefer=["i2"])
+    assert spent(result) == {"i2": (1.0, 1000)}
+
+    result = payment_plan.plan(items(100.0, 30.0, 20.0, 10.0), 55.0, no_split=["i0"])
+    assert spent(result) == {"i2": (1.0, 2000), "i3": (1.0, 1000), "i1": (0.8333, 2500)}
+
+    with pytest.raises(payment_plan.InsufficientValue):
+        payment_plan.plan(items(30.0, 20.0), 55.0)
+    with pytest.raises(payment_plan.InsufficientValue):
+        payment_plan.plan(items(30.0, 30.0), 45.0, no_split=["i0", "i1"])
+
+
+def test_identical_items_are_bundled():
+    assert payment_plan._bundles(13) == [1, 2, 4, 6]
+    result = payment_plan.plan(items(*[5.0] * 500), 1235.0)
+    assert result["splits"] == 0
+    assert len(result["items"]) == 247
+
+
+def test_no_split_whenever_an_exact_subset_exists():
+    rng = random.Random(3)
+    for _ in range(200):
+        values = [rng.randint(1, 40) / 2 for _ in range(rng.randint(1, 8))]
+        amount = rng.randint(1, int(sum(values) * 2)) / 2
+        exact = any(
+            sum(combo) == amount for size in range(1, len(values) + 1) for combo in combinations(values, size)
+        )
+        result = payment_plan.plan(items(*values), amount)
+        assert sum(cents for _, _, cents in result["items"]) == payment_plan.to_cents(amount)
+        assert result["splits"] == (0 if exact else 1)
+
+
+def test_endpoint_spends_only_the_payers_share(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "test")
+    server = pytest.importorskip("server")
+    from fastapi.testclient import TestClient
+
+    db = mongomock_motor.AsyncMongoMockClient()["plan"]
+    monkeypatch.setattr(server, "db", db)
+    asyncio.run(db.items.insert_many([
+        {"item_id": "half", "owner_id": "alice", "value": 100.0, "share_percentage": 0.5},
+        {"item_id": "whole", "owner_id": "alice", "value": 30.0},
+    ]))
+    client = TestClient(server.app)
+
+    response = client.post("/api/payments/plan", json={"payer_id": "alice", "amount": 90, "payee_id": "bob"})
+    assert response.status_code == 400
+
+    plan = client.post("/api/payments/plan", json={"payer_id": "alice", "amount": 55, "payee_id": "bob"}).json()
+    assert {entry["item_id"]: (entry["amount"], entry["fraction"]) for entry in plan["items"]} == {
+        "whole": (30.0, 1.0), "half": (25.0, 0.25),
+    }
+    assert {entry["item_id"]: entry["share_percentage"] for entry in plan["trade_items"]} == {"whole": 1.0, "half": 0.25}
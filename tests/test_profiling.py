@@ -0,0 +1,109 @@
+import asyncio
+import tracemalloc
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import profiling
+from profiling import ProfilingMiddleware
+
+TOKEN = "s3cret"
+
+
+class ListStore:
+    def __init__(self):
+        self.reports = []
+
+    async def save(self, report):
+        self.reports.append(report)
+
+
+def busy(seconds):
+    deadline = asyncio.get_event_loop().time() + seconds
+    total = 0
+    while asyncio.get_event_loop().time() < deadline:
+        total += sum(range(1000))
+    return total
+
+
+async def wait_on_database():
+    await asyncio.sleep(0.1)
+
+
+def make_client():
+    app = FastAPI()
+    held = []
+
+    @app.get("/slow")
+    async def slow():
+        await wait_on_database()
+        busy(0.1)
+        held.append([bytearray(1024) for _ in range(500)])
+        return {"ok": True}
+
+    store = ListStore()
+    app.add_middleware(ProfilingMiddleware, token=TOKEN, store=store, interval=0.002)
+    return TestClient(app), store
+
+
+@pytest.mark.parametrize("request_kwargs", [{}, {"headers": {"X-Profile": "wrong"}}, {"params": {"__profile": "nope"}}])
+def test_unflagged_requests_are_not_profiled(request_kwargs):
+    client, store = make_client()
+    response = client.get("/slow", **request_kwargs)
+    assert response.status_code == 200
+    assert "x-profile-id" not in response.headers
+    assert store.reports == []
+    assert not tracemalloc.is_tracing()
+
+
+@pytest.mark.parametrize("request_kwargs", [
+    {"headers": {"X-Profile": TOKEN}},
+    {"params": {"__profile": TOKEN, "page": "2"}},
+])
+def test_profile_attributes_cpu_waits_and_allocations(request_kwargs):
+    client, store = make_client()
+    response = client.get("/slow", **request_kwargs)
+    assert response.status_code == 200
+
+    [report] = store.reports
+    assert response.headers["x-profile-id"] == report["_id"]
+    assert report["status"] == 200
+    assert TOKEN not in report["query"]
+    assert report["samples"] > 5
+
+    stacks = [line.rsplit(" ", 1) for line in report["cpu_folded"].splitlines()]
+    on_cpu = sum(int(count) for stack, count in stacks if stack.startswith("on-cpu;") and "busy (" in stack)
+    waiting = sum(int(count) for stack, count in stacks if stack.startswith("off-cpu;") and "wait_on_database (" in stack)
+    assert 50_000 < on_cpu < 200_000
+    assert 50_000 < waiting < 200_000
+
+    assert report["alloc_peak_bytes"] >= 500 * 1024
+    assert any("test_profiling.py" in entry["line"] and entry["size"] >= 500 * 1024 for entry in report["alloc_top"])
+    assert "test_profiling.py" in report["alloc_folded"]
+    assert not tracemalloc.is_tracing()
+
+
+def test_folded_output_sorts_by_weight():
+    assert profiling.fold(profiling.Counter({("a", "b"): 2, ("a", "c"): 5})) == "a;c 5\na;b 2\n"
+
+
+def test_overlapping_requests_stop_tracing_after_the_last():
+    first, second = profiling.RequestProfiler(), profiling.RequestProfiler()
+    first._start_tracemalloc()
+    second._start_tracemalloc()
+    first._allocation_report()
+    assert tracemalloc.is_tracing()
+    second._allocation_report()
+    assert not tracemalloc.is_tracing()
+
+
+def test_tracing_started_elsewhere_is_left_running():
+    tracemalloc.start()
+    try:
+        profiler = profiling.RequestProfiler()
+        profiler._start_tracemalloc()
+        profiler._allocation_report()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+import ratelimit
+from ratelimit import Admission, Bucket, MemoryStore, RateLimited, RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_then_refill(clock):
+    limiter = RateLimiter(MemoryStore(), {"route": Bucket(rate=0.5, burst=2)})
+
+    async def scenario():
+        await limiter.check("route", "alice")
+        await limiter.check("route", "alice")
+        with pytest.raises(RateLimited) as exc:
+            await limiter.check("route", "alice")
+        assert exc.value.status_code == 429
+        assert exc.value.headers["Retry-After"] == "2"
+
+        # Other clients have their own bucket
+        await limiter.check("route", "bob")
+
+        clock[0] += 2
+        await limiter.check("route", "alice")
+
+    asyncio.run(scenario())
+
+
+def test_cost_is_charged_per_unit(clock):
+    limiter = RateLimiter(MemoryStore(), {"sync": Bucket(rate=1, burst=10)})
+
+    async def scenario():
+        await limiter.check("sync", "alice", cost=8)
+        with pytest.raises(RateLimited) as exc:
+            await limiter.check("sync", "alice", cost=5)
+        # Refused requests don't spend tokens
+        assert exc.value.headers["Retry-After"] == "3"
+        await limiter.check("sync", "alice", cost=2)
+
+    asyncio.run(scenario())
+
+
+def test_idle_buckets_are_pruned_when_full(clock):
+    store = MemoryStore(max_keys=2)
+    bucket = Bucket(rate=1, burst=1)
+
+    async def scenario():
+        await store.take("a", bucket)
+        clock[0] += 7200
+        await store.take("b", bucket)
+        await store.take("c", bucket)
+
+    asyncio.run(scenario())
+    assert set(store._buckets) == {"b", "c"}
+
+
+def test_admission_turns_away_when_saturated():
+    admission = Admission("upstream", max_concurrent=1, max_wait=0.05)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold():
+            async with admission.slot():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(RateLimited):
+            async with admission.slot():
+                pass
+        release.set()
+        await holder
+        async with admission.slot():
+            pass
+
+    asyncio.run(scenario())
+
+
+def test_memory_store_is_a_hard_capped_lru(clock):
+    store = MemoryStore(max_keys=3)
+    bucket = Bucket(rate=1, burst=1)
+
+    async def scenario():
+        for key in ("a", "b", "c"):
+            await store.take(key, bucket)
+        await store.take("a", bucket)  # a is now the most recent
+        await store.take("d", bucket)
+        assert list(store._buckets) == ["c", "a", "d"]
+        # Nothing is idle, yet a flood of fresh keys still can't grow the store
+        for n in range(100):
+            await store.take(f"spoofed-{n}", bucket)
+            assert len(store._buckets) <= 3
+
+    asyncio.run(scenario())
+    assert list(store._buckets) == ["spoofed-97", "spoofed-98", "spoofed-99"]
+
+
+def test_client_key_ignores_caller_supplied_ids():
+    import os
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "test")
+    server = pytest.importorskip("server")
+    from starlette.requests import Request
+
+    def request(headers):
+        return Request({"type": "http", "headers": [(k.encode(), v.encode()) for k, v in headers.items()],
+                        "client": ("203.0.113.7", 5000)})
+
+    assert server.client_key(request({"x-user-id": "someone-else"})) == "203.0.113.7"
+    token = server.token_issuer.issue({"user_id": "u1", "username": "bob"})
+    assert server.client_key(request({"authorization": f"Bearer {token}"})) == "u1"
+    with pytest.raises(server.auth.InvalidToken):
+        server.client_key(request({"authorization": "Bearer forged"}))
@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from changes import SETTLE_WINDOW, next_change_seq, stamp
+from realtime import EventHub, parties
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        collection, doc = queue.get_nowait()
+        events.append((collection, doc.get("trade_id") or doc.get("transaction_id")))
+    return events
+
+
+def test_parties_of_each_collection():
+    assert parties("trades", {"payer_id": "alice", "payee_id": "bob"}) == {"alice", "bob"}
+    assert parties("transactions", {"user_id": "alice"}) == {"alice"}
+
+
+def test_slow_subscriber_loses_oldest_events():
+    async def scenario():
+        hub = EventHub(db=None, queue_size=2)
+        queue = hub.subscribe("alice")
+        for n in range(3):
+            hub.publish("transactions", {"transaction_id": f"tx{n}", "user_id": "alice"})
+        return drain(queue)
+
+    assert asyncio.run(scenario()) == [("transactions", "tx1"), ("transactions", "tx2")]
+
+
+def test_polling_pushes_new_late_and_updated_documents_once():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["realtime"]
+        # Already there before the hub starts: not replayed
+        await db.trades.insert_one(stamp({"trade_id": "old", "payer_id": "alice", "payee_id": "bob"},
+                                         await next_change_seq(db)))
+        # Reserved now but written later, as a slow writer would
+        late_seq = await next_change_seq(db)
+
+        hub = EventHub(db, poll_interval=0.01)
+        alice, carol = hub.subscribe("alice"), hub.subscribe("carol")
+        poller = asyncio.create_task(hub._poll())
+        await asyncio.sleep(0.05)
+
+        await db.trades.insert_one(stamp({"trade_id": "t1", "payer_id": "alice", "payee_id": "bob"},
+                                         await next_change_seq(db)))
+        await db.transactions.insert_one(stamp({"transaction_id": "tx1", "user_id": "carol"},
+                                               await next_change_seq(db)))
+        await asyncio.sleep(0.05)
+        # Lands with a lower sequence than t1, but inside the settle window
+        await db.transactions.insert_one(stamp({"transaction_id": "tx-late", "user_id": "alice"}, late_seq))
+        await asyncio.sleep(0.05)
+        # An update restamps the trade, so it goes out again
+        await db.trades.update_one({"trade_id": "t1"}, {"$set": stamp({"status": "settled"},
+                                                                      await next_change_seq(db))})
+        # Older than the settle window and below the last sequence seen: never re-read
+        await db.transactions.insert_one(stamp({"transaction_id": "tx-stale", "user_id": "alice"}, 1,
+                                               datetime.utcnow() - 3 * SETTLE_WINDOW))
+        await asyncio.sleep(0.05)
+
+        poller.cancel()
+        return hub.mode, drain(alice), drain(carol)
+
+    mode, alice, carol = asyncio.run(scenario())
+    assert mode == "polling"
+    assert alice == [("trades", "t1"), ("transactions", "tx-late"), ("trades", "t1")]
+    assert carol == [("transactions", "tx1")]
+
+
+def test_polling_skips_what_happened_while_nobody_listened():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["realtime"]
+        hub = EventHub(db, poll_interval=0.01)
+        poller = asyncio.create_task(hub._poll())
+        await asyncio.sleep(0.02)
+        await db.transactions.insert_one(stamp({"transaction_id": "unheard", "user_id": "alice"},
+                                               await next_change_seq(db),
+                                               datetime.utcnow() - SETTLE_WINDOW - timedelta(seconds=1)))
+        queue = hub.subscribe("alice")
+        await asyncio.sleep(0.05)
+        await db.transactions.insert_one(stamp({"transaction_id": "heard", "user_id": "alice"},
+                                               await next_change_seq(db)))
+        await asyncio.sleep(0.05)
+        poller.cancel()
+        return drain(queue)
+
+    assert asyncio.run(scenario()) == [("transactions", "heard")]
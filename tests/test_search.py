@@ -0,0 +1,104 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from bson.decimal128 import Decimal128
+
+import money
+import search
+
+
+@pytest.mark.parametrize("sort, value", [
+    ("newest", datetime(2026, 3, 1, 12, 30, 15, 250000)),
+    ("value_asc", 19.99),
+    ("relevance", 1.0833333333333333),
+])
+def test_cursor_round_trips(sort, value):
+    assert search.decode_cursor(search.encode_cursor(sort, value, "item-9"), sort) == (value, "item-9")
+
+
+@pytest.mark.parametrize("cursor", ["", "not base64!", "bm9wZQ", search.encode_cursor("newest", 1, "x")[:-3]])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(ValueError):
+        search.decode_cursor(cursor, "newest")
+
+
+def test_cursor_is_tied_to_its_sort():
+    with pytest.raises(ValueError):
+        search.decode_cursor(search.encode_cursor("value_asc", 10.0, "x"), "value_desc")
+
+
+def test_facets_leave_out_their_own_filter():
+    clauses = search.filters(category="shoes", condition="good", min_value=10)
+    facets = search.facet_pipeline(None, clauses)[1]["$facet"]
+    assert facets["category"][0] == {"$match": {"$and": [{"condition": "good"}, {"value": {"$gte": Decimal128("10.00")}}]}}
+    assert facets["value"][0] == {"$match": {"$and": [{"category": "shoes"}, {"condition": "good"}]}}
+    assert facets["total"][0]["$match"]["$and"] == list(clauses.values())
+
+
+def test_text_search_opens_the_pipelines():
+    clauses = search.filters(category="shoes")
+    page = search.results_pipeline("nike", clauses, "relevance", 20)
+    assert page[0] == {"$match": {"$text": {"$search": "nike"}, "category": "shoes"}}
+    assert page[1] == {"$set": {"score": {"$meta": "textScore"}}}
+    assert search.facet_pipeline("nike", clauses)[0] == {"$match": {"$text": {"$search": "nike"}}}
+
+
+def test_keyset_pages_cover_every_match_once():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    rng = random.Random(1)
+    start = datetime(2026, 1, 1)
+
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["search"]
+        await db.items.insert_many([
+            {
+                "item_id": f"item-{i:03d}", "category": rng.choice(["shoes", "clothing"]),
+                "condition": rng.choice(["good", "new"]), "brand": rng.choice(["Nike", "Adidas"]),
+                # Repeated sort values make the item_id tie-break matter
+                "value": float(rng.randint(1, 20) * 50), "created_at": start + timedelta(hours=i % 10),
+            }
+            for i in range(120)
+        ])
+        clauses = search.filters(category="shoes")
+        pages = {}
+        # Value sorts compare Decimal128, which mongomock can't; see the test below
+        for sort in ("newest",):
+            field, _ = search.SORTS[sort]
+            seen, after = [], None
+            while True:
+                rows = await db.items.aggregate(search.results_pipeline(None, clauses, sort, 7, after)).to_list(None)
+                seen += [row["item_id"] for row in rows[:7]]
+                if len(rows) <= 7:
+                    break
+                after = search.decode_cursor(search.encode_cursor(sort, rows[6][field], rows[6]["item_id"]), sort)
+            pages[sort] = seen
+        facets = search.shape_facets((await db.items.aggregate(search.facet_pipeline(None, clauses)).to_list(1))[0])
+        expected = sorted(doc["item_id"] for doc in await db.items.find({"category": "shoes"}).to_list(None))
+        return pages, facets, expected
+
+    pages, facets, expected = asyncio.run(scenario())
+    for sort, seen in pages.items():
+        assert sorted(seen) == expected, sort
+        assert len(seen) == len(set(seen)), sort
+    assert facets["total"] == len(expected)
+    assert sum(bucket["count"] for bucket in facets["category"]) == 120
+    assert sum(bucket["count"] for bucket in facets["value"]) == len(expected)
+    assert facets["value"][-1]["max"] is None
+
+
+def test_value_bounds_and_cursors_match_stored_decimals():
+    stored = money.encode("items", {"item_id": "item-1", "value": 19.99})["value"]
+    read_back = money.load(stored)
+    assert stored == Decimal128("19.99") and read_back == 19.99
+
+    # An item priced exactly at either bound is kept
+    assert search.filters(min_value=19.99, max_value=19.99)["value"] == {"value": {"$gte": stored, "$lte": stored}}
+
+    for sort in ("value_asc", "value_desc"):
+        after = search.decode_cursor(search.encode_cursor(sort, read_back, "item-1"), sort)
+        keyset = search.results_pipeline(None, {}, sort, 7, after)[1]["$match"]["$or"]
+        op = "$gt" if sort == "value_asc" else "$lt"
+        # Ties on the stored value fall through to item_id instead of repeating or vanishing
+        assert keyset == [{"value": {op: stored}}, {"value": stored, "item_id": {op: "item-1"}}]
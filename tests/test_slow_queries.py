@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import slow_queries
+
+
+def command_events(request_id, command_name, command, took_ms):
+    started = SimpleNamespace(request_id=request_id, database_name="brail", command_name=command_name, command=command)
+    finished = SimpleNamespace(request_id=request_id, duration_micros=int(took_ms * 1000))
+    return started, finished
+
+
+COLLSCAN_PLAN = {
+    "queryPlanner": {"winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}},
+    "executionStats": {"nReturned": 3, "totalDocsExamined": 50_000, "totalKeysExamined": 0},
+}
+
+
+def test_values_are_dropped_from_shapes():
+    bob = slow_queries.shape("find", {"find": "users", "filter": {"username": {"$regex": "^bob$", "$options": "i"}}})
+    alice = slow_queries.shape("find", {"find": "users", "filter": {"username": {"$regex": "^alice$", "$options": "i"}}})
+    assert bob == alice
+    assert "bob" not in repr(bob)
+
+    trades = slow_queries.shape("find", {
+        "find": "trades", "filter": {"$or": [{"payer_id": "u1"}, {"payee_id": "u1"}]}, "sort": {"timestamp": -1},
+    })
+    assert trades["filter"] == {"$or": [{"payer_id": "?"}, {"payee_id": "?"}]}
+    assert trades["sort"] == {"timestamp": -1}
+    assert slow_queries.shape_id(trades) != slow_queries.shape_id({**trades, "sort": {"timestamp": 1}})
+
+    update = slow_queries.shape("update", {"update": "items", "updates": [{"q": {"item_id": "x"}, "u": {"$set": {}}}]})
+    assert update["filter"] == {"item_id": "?"}
+
+
+def test_plans_are_flagged():
+    plan = slow_queries.summarize_plan(COLLSCAN_PLAN)
+    assert plan["flags"] == ["collscan", "poor_selectivity", "in_memory_sort"]
+    assert plan["docs_examined"] == 50_000
+
+    indexed = slow_queries.summarize_plan({
+        "queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}},
+        "executionStats": {"nReturned": 3, "totalDocsExamined": 3, "totalKeysExamined": 3},
+    })
+    assert indexed["flags"] == []
+
+
+def test_writing_pipelines_are_never_explained():
+    merge = {"aggregate": "trades_archive", "pipeline": [{"$match": {}}, {"$merge": {"into": "x"}}]}
+    assert slow_queries.explain_command("aggregate", merge) is None
+    delete = {"delete": "items", "deletes": [{"q": {"item_id": "x"}, "limit": 1}]}
+    assert slow_queries.explain_command("delete", delete) == {"find": "items", "filter": {"item_id": "x"}}
+
+
+def test_slow_commands_are_counted_flushed_and_explained():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    listener = slow_queries.SlowQueryListener(threshold_ms=100, sample_rate=1.0)
+    for request_id, (name, took) in enumerate([("bob", 250), ("alice", 150), ("carol", 5)]):
+        started, finished = command_events(
+            request_id, "find", {"find": "users", "filter": {"username": {"$regex": f"^{name}$"}}}, took
+        )
+        listener.started(started)
+        listener.succeeded(finished)
+    started, finished = command_events(9, "insert", {"insert": "users", "documents": []}, 500)
+    listener.started(started)
+    listener.succeeded(finished)
+
+    explained = []
+
+    class Client:
+        def __getitem__(self, name):
+            async def command(spec):
+                explained.append(spec)
+                return COLLSCAN_PLAN
+            return SimpleNamespace(command=command)
+
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["slow"]
+        monitor = slow_queries.SlowQueryMonitor(Client(), db, listener)
+        await monitor.flush()
+        return await db.slow_queries.find(slow_queries.report_query(flagged=True)).to_list(None)
+
+    rows = asyncio.run(scenario())
+    assert len(rows) == 1
+    assert rows[0]["collection"] == "users"
+    assert rows[0]["count"] == 2
+    assert rows[0]["total_ms"] == pytest.approx(400)
+    assert rows[0]["max_ms"] == pytest.approx(250)
+    assert "collscan" in rows[0]["flags"]
+    # Both slow finds share a shape, so it is explained once
+    assert len(explained) == 1
+    assert explained[0]["verbosity"] == "executionStats"
@@ -0,0 +1,119 @@
+import random
+import uuid
+from datetime import datetime
+
+import pytest
+
+import tag_codec
+from tag_codec import TagCodecError, TagPayload, TagSignatureError
+from valuations import BRANDS, CATEGORIES, CONDITIONS, SUBCATEGORIES
+
+KEY = b"test-signing-key"
+
+
+def random_payload(rng: random.Random) -> TagPayload:
+    def text_or(table):
+        if rng.random() < 0.3:
+            return "".join(rng.choice("abcé漢 -") for _ in range(rng.randint(0, 40)))
+        return rng.choice(table)
+
+    fractional = rng.random() < 0.5
+    return TagPayload(
+        item_id=str(uuid.UUID(int=rng.getrandbits(128))),
+        owner_id=str(uuid.UUID(int=rng.getrandbits(128))),
+        category=text_or(CATEGORIES),
+        subcategory=text_or(SUBCATEGORIES),
+        brand=text_or(BRANDS) if rng.random() < 0.8 else None,
+        condition=rng.choice(CONDITIONS + (None,)),
+        value=rng.randint(0, 10_000_000) / 100,
+        is_fractional=fractional,
+        share_percentage=rng.randint(0, 10000) / 10000 if fractional or rng.random() < 0.3 else 1.0,
+        parent_item_id=str(uuid.uuid4()) if rng.random() < 0.3 else None,
+        timestamp=datetime(2025, 6, 1, 12, 30, 15),
+    )
+
+
+def expected_text(text):
+    raw = text.encode("utf-8")[:tag_codec.MAX_TEXT_BYTES]
+    return raw.decode("utf-8", "ignore")
+
+
+def test_round_trip():
+    rng = random.Random(1)
+    for _ in range(2000):
+        payload = random_payload(rng)
+        decoded = tag_codec.decode(tag_codec.encode(payload, KEY), KEY)
+
+        assert decoded.item_id == payload.item_id
+        assert decoded.owner_id == payload.owner_id
+        assert decoded.category == expected_text(payload.category)
+        assert decoded.subcategory == expected_text(payload.subcategory)
+        assert decoded.brand == (expected_text(payload.brand) if payload.brand else None)
+        assert decoded.condition == payload.condition
+        assert decoded.value == payload.value
+        assert decoded.is_fractional == payload.is_fractional
+        assert decoded.share_percentage == payload.share_percentage
+        assert decoded.parent_item_id == payload.parent_item_id
+        assert decoded.timestamp == payload.timestamp
+
+
+@pytest.mark.parametrize("share", [0.0, 0.4, 1.0])
+def test_non_fractional_share_round_trips(share):
+    # A whole item traded away keeps is_fractional=False but drops to a 0 share
+    payload = random_payload(random.Random(4))
+    payload = TagPayload(**{**payload.__dict__, "is_fractional": False, "share_percentage": share})
+    decoded = tag_codec.decode(tag_codec.encode(payload, KEY), KEY)
+
+    assert decoded.is_fractional is False
+    assert decoded.share_percentage == share
+
+
+def test_fits_ntag215_with_room_to_spare():
+    worst = TagPayload(
+        item_id=str(uuid.uuid4()),
+        owner_id=str(uuid.uuid4()),
+        category="x" * 100,
+        subcategory="y" * 100,
+        brand="z" * 100,
+        condition="new",
+        value=2 ** 40,
+        is_fractional=True,
+        share_percentage=0.3333,
+        parent_item_id=str(uuid.uuid4()),
+        timestamp=datetime(2099, 1, 1),
+    )
+    assert len(tag_codec.encode(worst, KEY)) < 180 < tag_codec.NTAG215_USER_BYTES // 2
+
+
+def test_tampering_is_detected():
+    payload = random_payload(random.Random(2))
+    data = bytearray(tag_codec.encode(payload, KEY))
+    data[40] ^= 0x01
+
+    with pytest.raises(TagCodecError):
+        tag_codec.decode(bytes(data), KEY)
+    with pytest.raises(TagSignatureError):
+        tag_codec.decode(tag_codec.encode(payload, KEY), b"another-key")
+
+
+def test_fuzzed_input_only_raises_codec_errors():
+    rng = random.Random(3)
+    valid = [tag_codec.encode(random_payload(rng), KEY) for _ in range(50)]
+
+    for _ in range(20000):
+        choice = rng.random()
+        if choice < 0.4:
+            data = bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 120)))
+        else:
+            data = bytearray(rng.choice(valid))
+            if choice < 0.7:
+                for _ in range(rng.randint(1, 4)):
+                    data[rng.randrange(len(data))] = rng.getrandbits(8)
+            else:
+                data = data[:rng.randrange(len(data))]
+            data = bytes(data)
+
+        try:
+            tag_codec.decode(data, KEY)
+        except TagCodecError:
+            pass
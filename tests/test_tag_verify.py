@@ -0,0 +1,100 @@
+import asyncio
+import base64
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import tag_codec
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+server = pytest.importorskip("server")
+from fastapi.testclient import TestClient  # noqa: E402
+
+KEY = b"tag-test-key"
+NOW = datetime.utcnow().replace(microsecond=0)
+
+
+def uid(name):
+    """Tags carry ids as packed UUIDs."""
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, name))
+
+
+def item(item_id, owner_id="alice", share=1.0, updated_at=None, value=10.0):
+    return {"item_id": uid(item_id), "owner_id": uid(owner_id), "category": "shoes", "subcategory": "sneakers",
+            "value": value, "share_percentage": share, "created_at": NOW - timedelta(days=1),
+            "updated_at": updated_at or NOW - timedelta(hours=1)}
+
+
+def tag(doc, **overrides):
+    fields = dict(item_id=doc["item_id"], owner_id=doc["owner_id"], category=doc["category"],
+                  subcategory=doc["subcategory"], value=doc["value"], share_percentage=doc["share_percentage"],
+                  timestamp=NOW)
+    fields.update(overrides)
+    return base64.b64encode(tag_codec.encode(tag_codec.TagPayload(**fields), KEY)).decode()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db = mongomock_motor.AsyncMongoMockClient()["verify"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setenv("TAG_SIGNING_KEY", KEY.decode())
+    return TestClient(server.app), db
+
+
+def verify(client, payloads, **options):
+    response = client.post("/api/items/verify", json={"payloads": payloads, **options})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_valid_tags_add_up(client):
+    api, db = client
+    docs = [item("a", value=10.0), item("b", value=2.5, share=0.5)]
+    asyncio.run(db.items.insert_many([dict(doc) for doc in docs]))
+    result = verify(api, [tag(doc) for doc in docs], expected_owner_id=uid("alice"))
+    assert result["all_valid"] is True
+    assert result["total_value"] == 12.5
+
+
+def test_each_rejection_reason(client):
+    api, db = client
+    docs = {
+        "owner": item("owner", owner_id="bob"),
+        "share": item("share", share=0.5),
+        "stale": item("stale", updated_at=NOW + timedelta(seconds=30)),
+        "old": item("old", updated_at=NOW - timedelta(hours=3)),
+    }
+    asyncio.run(db.items.insert_many([dict(doc) for doc in docs.values()]))
+    forged = tag_codec.encode(tag_codec.TagPayload(
+        item_id=uid("old"), owner_id=uid("alice"), category="shoes", subcategory="sneakers", value=10.0,
+        timestamp=NOW,
+    ), b"other-key")
+
+    result = verify(api, [
+        tag(docs["owner"], owner_id=uid("alice")),             # owner_mismatch: stored owner is bob
+        tag(docs["share"], share_percentage=1.0),              # share_mismatch: half was traded away
+        tag(docs["stale"]),                                    # stale: item changed after the tag was written
+        tag(docs["old"], timestamp=NOW - timedelta(hours=2)),  # expired: older than max_age_seconds
+        tag(docs["owner"], owner_id=uid("alice")),             # duplicate: same item scanned twice
+        tag(item("missing")),                                  # not_found
+        base64.b64encode(forged).decode(),                     # bad_signature
+        base64.b64encode(b"\x00\x01").decode(),                # malformed
+    ], max_age_seconds=600)
+
+    assert [v["reason"] for v in result["verdicts"]] == [
+        "owner_mismatch", "share_mismatch", "stale", "expired", "duplicate", "not_found", "bad_signature", "malformed",
+    ]
+    assert result["all_valid"] is False
+    assert result["total_value"] == 0
+
+
+def test_expected_owner_must_match(client):
+    api, db = client
+    doc = item("a")
+    asyncio.run(db.items.insert_one(dict(doc)))
+    result = verify(api, [tag(doc)], expected_owner_id=uid("bob"))
+    assert result["verdicts"][0]["reason"] == "owner_mismatch"
@@ -0,0 +1,53 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import trade_parties
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+T0 = datetime(2026, 1, 1)
+
+
+def trade(n, payer_id, payee_id):
+    return {"trade_id": f"t{n}", "payer_id": payer_id, "payee_id": payee_id, "total_value": 10.0 * n,
+            "timestamp": T0 + timedelta(hours=n), "items": [], "change_seq": n, "updated_at": T0}
+
+
+def test_entries_index_both_sides_once():
+    payer, payee = trade_parties.entries(trade(1, "alice", "bob"))
+    assert (payer["user_id"], payer["role"], payer["counterparty"]) == ("alice", "payer", "bob")
+    assert (payee["user_id"], payee["role"], payee["counterparty"]) == ("bob", "payee", "alice")
+    assert len(trade_parties.entries(trade(2, "alice", "alice"))) == 1
+
+
+def test_user_trades_read_through_entries():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["parties"]
+        for doc in (trade(3, "bob", "alice"), trade(1, "alice", "bob"), trade(2, "carol", "dave")):
+            await trade_parties.record(db, doc)
+            await db.trades.insert_one(doc)
+        # An entry whose trade write never happened
+        await trade_parties.record(db, trade(4, "alice", "carol"))
+        return [t["trade_id"] async for t in trade_parties.user_trades(db, "alice", batch_size=1)]
+
+    assert asyncio.run(scenario()) == ["t1", "t3"]
+
+
+def test_backfill_indexes_hot_and_archived_trades():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["parties"]
+        await db.trades.insert_many([trade(1, "alice", "bob"), trade(2, "bob", "bob")])
+        await db.trades_archive.insert_one(trade(0, "carol", "alice"))
+        counts = [await trade_parties.backfill(db, batch_size=1) for _ in range(2)]
+        return (
+            counts,
+            await db.trade_parties.count_documents({}),
+            [t["trade_id"] async for t in trade_parties.user_trades(db, "alice", "trades_archive")],
+        )
+
+    counts, entries, archived = asyncio.run(scenario())
+    assert counts == [3, 3]
+    assert entries == 3
+    assert archived == ["t0"]
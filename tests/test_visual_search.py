@@ -0,0 +1,172 @@
+import asyncio
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import visual_search
+from visual_search import VectorIndex
+
+
+def unit_rows(count, dim=visual_search.DIM, seed=0):
+    rows = np.random.default_rng(seed).random((count, dim), dtype=np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def brute_force(vectors, ids, query, k):
+    scores = vectors @ query
+    return [ids[i] for i in np.argsort(-scores)[:k]]
+
+
+def test_exact_search_matches_brute_force():
+    vectors = unit_rows(3000)
+    ids = [f"item-{i}" for i in range(len(vectors))]
+    index = VectorIndex()
+    for item_id, vector in zip(ids, vectors):
+        index.add(item_id, vector)
+
+    query = unit_rows(1, seed=1)[0]
+    results = index.search(query, k=5)
+    assert [item_id for item_id, _ in results] == brute_force(vectors, ids, query, 5)
+    assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+    assert "item-7" not in [item_id for item_id, _ in index.search(vectors[7], k=5, exclude="item-7")]
+
+
+def test_removed_rows_are_reused_and_never_returned():
+    vectors = unit_rows(10)
+    index = VectorIndex()
+    for i, vector in enumerate(vectors):
+        index.add(f"item-{i}", vector)
+    assert index.remove("item-3")
+    assert not index.remove("item-3")
+    assert "item-3" not in [item_id for item_id, _ in index.search(vectors[3], k=10)]
+
+    index.add("item-new", vectors[3])
+    assert len(index) == 10
+    assert len(index._ids) == 10
+    assert index.search(vectors[3], k=1)[0][0] == "item-new"
+
+
+def test_ivf_recall_and_incremental_updates():
+    rng = np.random.default_rng(2)
+    centres = unit_rows(50, seed=3)
+    vectors = centres[rng.integers(0, 50, 20000)] + rng.normal(0, 0.05, (20000, visual_search.DIM)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = [f"item-{i}" for i in range(len(vectors))]
+
+    index = VectorIndex(nprobe=8, ivf_min_rows=1000)
+    for item_id, vector in zip(ids, vectors):
+        index.add(item_id, vector)
+    asyncio.run(index.train())
+    assert index.centroids is not None
+    assert sum(len(members) for members in index._lists) == len(vectors)
+
+    queries = vectors[rng.choice(len(vectors), 50, replace=False)]
+    recall = np.mean([
+        len(set(item_id for item_id, _ in index.search(q, k=10)) & set(brute_force(vectors, ids, q, 10))) / 10
+        for q in queries
+    ])
+    assert recall >= 0.9
+
+    index.add("late", vectors[0])
+    assert "late" in [item_id for item_id, _ in index.search(vectors[0], k=3)]
+    index.remove("late")
+    assert sum(len(members) for members in index._lists) == len(vectors)
+
+
+def test_writes_during_training_are_filed():
+    vectors = unit_rows(2000)
+    index = VectorIndex(ivf_min_rows=1000)
+    for i, vector in enumerate(vectors[:1500]):
+        index.add(f"item-{i}", vector)
+
+    async def scenario():
+        training = asyncio.create_task(index.train())
+        await asyncio.sleep(0)
+        for i, vector in enumerate(vectors[1500:], start=1500):
+            index.add(f"item-{i}", vector)
+        index.remove("item-0")
+        await training
+
+    asyncio.run(scenario())
+    filed = set().union(*index._lists)
+    assert len(filed) == len(index) == 1999
+    assert index.search(vectors[1999], k=1)[0][0] == "item-1999"
+
+
+def test_photo_descriptors_rank_the_same_photo_first():
+    pytest.importorskip("PIL")
+    from .test_image_hash import photo
+
+    originals = [visual_search.photo_descriptor(photo(seed)) for seed in range(10)]
+    for vector in originals:
+        assert vector.shape == (visual_search.DIM,)
+        assert np.isclose(np.linalg.norm(vector), 1.0)
+
+    index = VectorIndex()
+    for seed, vector in enumerate(originals):
+        index.add(f"item-{seed}", vector)
+    resized = visual_search.photo_descriptor(photo(4, size=(320, 240), quality=50))
+    assert index.search(resized, k=1)[0][0] == "item-4"
+
+
+def test_load_and_refresh_follow_other_workers():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    vectors = unit_rows(4)
+
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["visual"]
+        now = datetime.utcnow()
+        for i in range(2):
+            await db.items.insert_one({
+                "item_id": f"item-{i}", "change_seq": i + 1, "updated_at": now,
+                "visual_descriptor": visual_search.to_bytes(vectors[i]),
+            })
+        await db.items.insert_one({"item_id": "unreadable", "change_seq": 3, "updated_at": now, "visual_descriptor": None})
+        await db.counters.insert_one({"_id": "change_seq", "seq": 3})
+
+        search = visual_search.VisualSearch(db)
+        await search.load()
+        loaded = len(search.index)
+
+        # Another worker indexes one item and deletes another
+        await db.items.insert_one({
+            "item_id": "item-2", "change_seq": 4, "updated_at": datetime.utcnow(),
+            "visual_descriptor": visual_search.to_bytes(vectors[2]),
+        })
+        await db.items.delete_one({"item_id": "item-0"})
+        await db.tombstones.insert_one({"collection": "items", "doc_id": "item-0", "deleted_at": datetime.utcnow()})
+        # An item traded away leaves a tombstone but still exists
+        await db.tombstones.insert_one({"collection": "items", "doc_id": "item-1", "deleted_at": datetime.utcnow()})
+        await search.refresh()
+        return loaded, search, await search.descriptor_of("item-2")
+
+    loaded, search, fetched = asyncio.run(scenario())
+    assert loaded == 2
+    assert "item-0" not in search.index
+    assert "item-1" in search.index
+    assert "item-2" in search.index
+    assert np.allclose(fetched, vectors[2])
+
+
+def test_backfilled_descriptors_reach_running_indexes():
+    pytest.importorskip("PIL")
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    from .test_image_hash import photo
+
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["visual"]
+        search = visual_search.VisualSearch(db)
+        await search.load()
+        await db.items.insert_many([
+            {"item_id": "item-0", "photo": photo(0)},
+            {"item_id": "unreadable", "photo": "not a photo"},
+        ])
+        described = await visual_search.backfill_descriptors(db)
+        await search.refresh()
+        return described, search
+
+    described, search = asyncio.run(scenario())
+    assert described == 2
+    assert "item-0" in search.index
+    assert "unreadable" not in search.index